@@ -0,0 +1,429 @@
+""" Batch Process Movies
+
+Run the full pipeline over many movies at once: ND2 conversion, image
+processing, feature detection, track linking, and diffusion / dwell time
+analysis. Takes a directory or a glob of ND2/TIF files.
+
+Tracks are linked in pixels, while diffusion and dwell times are analyzed
+in nm, so the camera pixel size (--pixel_size, nm per pixel) is required.
+
+Conversion is mostly I/O, so it runs on a small thread pool, while the
+CPU-heavy stages (processing through analysis) of each movie run on a pool
+of worker processes. A movie enters the process pool as soon as it is
+converted, so conversion of the next movies overlaps with the analysis of
+the previous ones.
+
+Usage:
+python batch_process.py --input movies/ --workers 8 --config config_test.json
+    --pixel_size 160
+
+Outputs, for each movie <name>:
+<name>.tif                          : converted movie (ND2 input only)
+<name>_processed.tif                : processed movie
+<name>_features.tif / .csv          : feature overlay movie and features
+<name>_tracks.csv                   : particle trajectories, in pixels
+<name>_tracks_diffusion_coeffs.csv  : diffusion coefficients
+<name>_tracks_dwell_times.csv       : particle dwell times
+
+"""
+
+import utils
+import argparse
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+import glob
+import os
+import sys
+import time
+
+
+def find_movies(pattern):
+    """ List the ND2/TIF movies in a directory or matching a glob
+
+    Inputs:
+    ----
+    pattern     : str
+                  directory, or glob pattern such as 'data/*.nd2'
+
+    Outputs:
+    ----
+    movies      : list
+                  sorted movie file names. Derived files written by this
+                  script (e.g. *_processed.tif) are skipped
+    """
+
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*')
+
+    derived = ('_processed.tif', '_features.tif')
+    movies = []
+    for file_name in sorted(glob.glob(pattern)):
+        if file_name.lower().endswith(derived):
+            continue
+        if os.path.splitext(file_name)[1].lower() in ('.nd2', '.tif',
+                                                      '.tiff'):
+            movies.append(file_name)
+
+    # an ND2 and its converted TIF are the same movie; keep the ND2
+    stems = {os.path.splitext(m)[0] for m in movies if m.endswith('.nd2')}
+    return [m for m in movies
+            if m.endswith('.nd2') or os.path.splitext(m)[0] not in stems]
+
+
+def convert_movie(movie, cache=None):
+    """ Conversion stage: ND2 -> TIF (TIF input is passed through)
+
+    Outputs:
+    ----
+    tif         : str
+                  TIF stack to process
+    """
+
+    stem, ext = os.path.splitext(movie)
+    if ext.lower() != '.nd2':
+        return movie
+
+    tif = stem + '.tif'
+    run_stage(cache, 'convert', [movie], {}, [tif],
+              utils.convert_ND2, movie, tif)
+    return tif
+
+
+def analyze_movie(tif, params, cache=None):
+    """ CPU stages of one movie: processing -> detection -> tracking ->
+    analysis
+
+    Inputs:
+    ----
+    tif         : str
+                  TIF stack to analyze
+    params      : dict
+                  blurIter, config, deltaT, max_disp, min_bound_frames,
+                  pixel_size, and optionally track_window, track_overlap,
+                  track_tiles and profile
+    cache       : utils.ArtifactCache
+                  if given, stages whose inputs and parameters are unchanged
+                  are restored from the cache instead of being re-run
+
+    Outputs:
+    ----
+    summary     : dict
+                  movie, number of features and trajectories, seconds
+                  spent, and the stages restored from the cache. With
+                  params['profile'], also the profiled stages of this movie
+    """
+
+    start = time.perf_counter()
+    if params.get('profile'):
+        # worker processes report their stages back with the summary
+        utils.PROFILER.reset()
+        utils.PROFILER.enable()
+    stem = os.path.splitext(tif)[0]
+    features = stem + '_features.csv'
+    tracks = stem + '_tracks.csv'
+    diffusion = tracks[:-4] + '_diffusion_coeffs.csv'
+    dwell_times = tracks[:-4] + '_dwell_times.csv'
+    cached = []
+
+    # processing and feature detection, in one pass
+    if run_stage(cache, 'detect', [tif],
+                 {'blurIter': params['blurIter'],
+                  'detector': utils.BLOB_DETECTOR_PARAMS},
+                 [stem + '_processed.tif', stem + '_features.tif', features],
+                 detect_features, tif, params['blurIter']):
+        cached.append('detect')
+
+    # track linking; tiles are tracked one after the other here, as the
+    # movies already run in parallel
+    window = params.get('track_window')
+    overlap = params.get('track_overlap', 10)
+    tiles = params.get('track_tiles')
+    track_params = {}
+    if window:
+        track_params.update(window=window, overlap=overlap)
+    if tiles:
+        track_params.update(tiles=tiles)
+    if run_stage(cache, 'track', [features, params['config']], track_params,
+                 [tracks], utils.track_csv, features, tracks,
+                 params['config'], window, overlap, None, tiles):
+        cached.append('track')
+
+    # analysis; the trajectories are only parsed if a stage needs them
+    if run_stage(cache, 'diffusion', [tracks],
+                 {'deltaT': params['deltaT'],
+                  'pixel_size': params['pixel_size']}, [diffusion],
+                 write_diffusion, tracks, diffusion, params):
+        cached.append('diffusion')
+
+    if run_stage(cache, 'dwelltime', [tracks],
+                 {'deltaT': params['deltaT'],
+                  'max_disp': params['max_disp'],
+                  'min_bound_frames': params['min_bound_frames'],
+                  'pixel_size': params['pixel_size']},
+                 [dwell_times], write_dwelltimes, tracks, dwell_times,
+                 params):
+        cached.append('dwelltime')
+
+    summary = {'movie': tif,
+               'features': count_rows(features),
+               'trajectories': count_rows(diffusion),
+               'seconds': time.perf_counter() - start,
+               'cached': cached}
+    if params.get('profile'):
+        summary['profile'] = utils.PROFILER.stages
+    return summary
+
+
+def run_stage(cache, stage, inputs, params, outputs, func, *args):
+    """ Run a stage through the cache, or directly if there is no cache
+
+    Returns True if the stage was restored from the cache.
+    """
+
+    if cache is None:
+        func(*args)
+        return False
+    return cache.run(stage, inputs, params, outputs, func, *args)
+
+
+def detect_features(tif, blurIter):
+    """ Processing and feature detection stage """
+
+    stem = os.path.splitext(tif)[0]
+    features = utils.process_and_extract_features(
+        tif, blurIter=blurIter,
+        processed_name=stem + '_processed.tif',
+        out_name=stem + '_features.tif')
+    utils.write_csv(features, stem + '_features.csv')
+
+
+def load_tracks(tracks, pixel_size):
+    """ Load btrack's space separated ID, t, x, y, ... track export
+
+    The tracks are in pixels; x and y are scaled by pixel_size (nm per
+    pixel) to the nm that calc_diffusion and calc_dwelltime expect.
+    """
+
+    table = utils.TrajectoryTable.from_csv(tracks, 0, delimiter=' ')
+    table.data[:, 2:4] *= pixel_size
+    return table
+
+
+def write_diffusion(tracks, file_out, params):
+    """ Diffusion coefficient stage """
+
+    table = load_tracks(tracks, params['pixel_size'])
+    _, diffusion = utils.calc_diffusion(table, 0, [2, 3], 'all',
+                                        params['deltaT'])
+    utils.write_csv([['Trajectory_ID', 'Diffusion_Coeff (um^2/s)']] +
+                    diffusion, file_out)
+
+
+def write_dwelltimes(tracks, file_out, params):
+    """ Dwell time stage """
+
+    table = load_tracks(tracks, params['pixel_size'])
+    dwell_times = utils.calc_all_dwelltimes(table, 0, [2, 3],
+                                            params['max_disp'],
+                                            params['min_bound_frames'],
+                                            params['deltaT'])
+    utils.write_csv([['Trajectory_ID', 'Dwell_Times (s)']] + dwell_times,
+                    file_out)
+
+
+def count_rows(file_name):
+    """ Number of data rows (lines minus the header) of a CSV file """
+
+    with open(file_name, 'r') as f:
+        return sum(1 for line in f) - 1
+
+
+def run_batch(movies, params, workers=1, io_workers=2, cache=None):
+    """ Schedule every movie through the pipeline
+
+    Inputs:
+    ----
+    movies      : list
+                  ND2/TIF files to process
+    params      : dict
+                  see analyze_movie
+    workers     : int
+                  number of processes for the CPU-bound stages
+    io_workers  : int
+                  number of threads for ND2 conversion
+    cache       : utils.ArtifactCache
+                  optional cache of stage outputs
+
+    Outputs:
+    ----
+    summaries   : list
+                  one summary dict per movie, in input order. Failed movies
+                  have an 'error' entry instead of results
+    """
+
+    summaries = {}
+    with ThreadPoolExecutor(max_workers=io_workers) as io_pool, \
+            ProcessPoolExecutor(max_workers=workers) as cpu_pool:
+        converting = {io_pool.submit(convert_movie, movie, cache): movie
+                      for movie in movies}
+        analyzing = {}
+        # hand each movie to the process pool as soon as it is converted
+        for future in as_completed(converting):
+            movie = converting[future]
+            try:
+                tif = future.result()
+            except (Exception, SystemExit) as err:
+                summaries[movie] = {'movie': movie, 'error': repr(err)}
+                continue
+            analyzing[cpu_pool.submit(analyze_movie, tif, params,
+                                      cache)] = movie
+
+        for future in as_completed(analyzing):
+            movie = analyzing[future]
+            try:
+                summaries[movie] = future.result()
+            except (Exception, SystemExit) as err:
+                summaries[movie] = {'movie': movie, 'error': repr(err)}
+
+    return [summaries[movie] for movie in movies]
+
+
+def main():
+
+    """ Main function for batch processing
+
+    Arguements are defined at the command line via argparse
+
+    """
+    parser = argparse.ArgumentParser(description='Run the pipeline over '
+                                                 'many movies')
+
+    parser.add_argument('--input',
+                        dest='pattern',
+                        type=str,
+                        required=True,
+                        help="Directory or glob of ND2/TIF movies")
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help="Processes for processing through analysis")
+    parser.add_argument('--io_workers',
+                        dest='io_workers',
+                        type=int,
+                        default=2,
+                        help="Threads for ND2 conversion")
+    parser.add_argument('--config',
+                        dest='config',
+                        type=str,
+                        default='config_test.json',
+                        help="btrack configuration file")
+    parser.add_argument('--track_window',
+                        dest='track_window',
+                        type=int,
+                        default=None,
+                        help="Track long movies in windows of this many "
+                             "frames (default: whole movie at once)")
+    parser.add_argument('--track_overlap',
+                        dest='track_overlap',
+                        type=int,
+                        default=10,
+                        help="Frames shared by consecutive tracking windows")
+    parser.add_argument('--track_tiles',
+                        dest='track_tiles',
+                        type=int,
+                        nargs=2,
+                        default=None,
+                        metavar=('NX', 'NY'),
+                        help="Track the field of view in NX x NY tiles")
+    parser.add_argument('--cache_dir',
+                        dest='cache_dir',
+                        type=str,
+                        default=None,
+                        help="Cache stage outputs here and skip unchanged "
+                             "stages on re-runs")
+    parser.add_argument('--cache_size',
+                        dest='cache_size',
+                        type=float,
+                        default=10,
+                        help="Cache size limit, in GB")
+    parser.add_argument('--blurIter',
+                        dest='blurIter',
+                        type=int,
+                        default=2,
+                        help="Gaussian blur iterations")
+    parser.add_argument('--delta_T',
+                        dest='deltaT',
+                        type=float,
+                        default=0.1,
+                        help="Time delay between frames, in seconds")
+    parser.add_argument('--bound_frames',
+                        dest='min_bound_frames',
+                        type=int,
+                        default=10,
+                        help="How many frames to consider a particle bound")
+    parser.add_argument('--max_disp',
+                        dest='max_disp',
+                        type=float,
+                        default=200,
+                        help="Max distance a particle can travel while "
+                             "bound, in nm")
+    parser.add_argument('--pixel_size',
+                        dest='pixel_size',
+                        type=float,
+                        required=True,
+                        help="Camera pixel size, in nm per pixel; tracks are "
+                             "in pixels and are scaled to nm for analysis")
+    utils.add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.profile:
+        # ND2 conversion is profiled here; the other stages in the workers
+        utils.PROFILER.enable(args.cprofile)
+
+    movies = find_movies(args.pattern)
+    if movies == []:
+        print("No ND2/TIF movies found in " + args.pattern)
+        sys.exit(1)
+
+    params = {'blurIter': args.blurIter,
+              'config': os.path.abspath(args.config),
+              'deltaT': args.deltaT,
+              'max_disp': args.max_disp,
+              'min_bound_frames': args.min_bound_frames,
+              'pixel_size': args.pixel_size,
+              'track_window': args.track_window,
+              'track_overlap': args.track_overlap,
+              'track_tiles': args.track_tiles,
+              'profile': args.profile}
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = utils.ArtifactCache(args.cache_dir,
+                                    int(args.cache_size * 2**30))
+
+    summaries = run_batch(movies, params, args.workers, args.io_workers,
+                          cache)
+
+    n_failed = 0
+    for summary in summaries:
+        if 'profile' in summary:
+            utils.PROFILER.merge(summary['profile'])
+        if 'error' in summary:
+            n_failed = n_failed + 1
+            print('FAILED ' + summary['movie'] + ': ' + summary['error'])
+        else:
+            print('{movie}: {features} features, {trajectories} '
+                  'trajectories in {seconds:.1f} s'.format(**summary) +
+                  ('  (cached: ' + ', '.join(summary['cached']) + ')'
+                   if summary['cached'] else ''))
+
+    if args.profile:
+        utils.PROFILER.write_report('batch_profile.json')
+
+    if n_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    main()
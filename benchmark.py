@@ -0,0 +1,491 @@
+""" Benchmark pipeline stages
+
+Times every pipeline stage on synthetic data, so that performance changes
+can be measured without the sample movies:
+
+read_tif, process_image, extract_features : on generated tif stacks
+track_csv                                 : on generated feature CSVs
+calc_diffusion, get_xy_coords,
+calc_dwelltime                            : on generated trajectory CSVs
+
+Generated particles are a mix of freely diffusing (Brownian) and bound
+ones. Each case runs in a fresh process, which reports its run time,
+throughput, the peak memory the stage allocates (traced in a second,
+untimed run; allocations made inside C++ libraries such as btrack are not
+seen) and the peak resident set size of the process. Results are appended
+to a JSON history file; with --check, a case that got slower than its
+previous run by more than --tolerance is reported as a regression and the
+script exits with 1.
+
+Usage:
+python benchmark.py
+python benchmark.py --rows 1000 100000 10000000 --stages calc_diffusion
+python benchmark.py --frames 200 --size 512 --workers 1 2 4 8 --check
+
+"""
+
+import utils
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import json
+import multiprocessing
+import numpy as np
+import os
+import subprocess
+import sys
+import tempfile
+import tifffile
+import time
+import tracemalloc
+
+IMAGE_STAGES = ['read_tif', 'process_image', 'extract_features']
+TRACK_STAGES = ['track_csv']
+TRAJECTORY_STAGES = ['calc_diffusion', 'get_xy_coords', 'calc_dwelltime']
+MIN_REGRESSION = 0.01  # seconds
+
+
+def make_stack(file_name, n_frames, size, n_particles=20, seed=0,
+               bound_fraction=0.3):
+    """ Write a synthetic 16bit tif stack with bright particles
+
+    A bound_fraction of the particles stays (nearly) in place, the others
+    diffuse.
+
+    Parameters:
+    file_name   : str
+                  name of the tif stack to write
+    n_frames    : int
+                  number of frames
+    size        : int
+                  frames are size x size pixels
+    n_particles : int
+                  number of particles per frame
+    seed        : int
+                  seed of the random number generator
+    bound_fraction : float
+                  fraction of bound particles
+
+    Outputs:
+    file_name   : str
+                  name of the written tif stack
+    """
+
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(5, size - 5, (n_particles, 2))
+    step = np.where(rng.random(n_particles) < bound_fraction, 0.1, 1)
+    with tifffile.TiffWriter(file_name) as tif:
+        for _ in range(n_frames):
+            frame = rng.poisson(100, (size, size)).astype(np.uint16)
+            positions = np.clip(positions + step[:, None] *
+                                rng.normal(0, 1, positions.shape),
+                                5, size - 5)
+            for x, y in positions.astype(int):
+                frame[y-2:y+3, x-2:x+3] += 2000
+            tif.write(frame, contiguous=True)
+
+    return file_name
+
+
+def make_features(file_name, n_frames, n_particles, size=400, seed=0):
+    """ Write a synthetic feature CSV (t, x, y, z), as extract_features
+
+    Outputs:
+    file_name   : str
+                  name of the written CSV
+    """
+
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(10, size - 10, (n_particles, 2))
+    rows = []
+    for t in range(n_frames):
+        positions = np.clip(positions + rng.normal(0, 1, positions.shape),
+                            10, size - 10)
+        rows.extend([t, int(x), int(y), 0] for x, y in positions)
+    utils.write_csv([['t', 'x', 'y', 'z']] + rows, file_name)
+
+    return file_name
+
+
+def make_trajectories(file_name, n_rows, traj_length=40, seed=0,
+                      bound_fraction=0.3, chunk_rows=1000000):
+    """ Write a synthetic trajectory CSV in the layout of sample_traj.csv
+
+    Free particles diffuse with D = 0.1 um^2/s at 0.1 s per frame; bound
+    ones jitter by a few nm. Rows are written in chunks, so files of 10^7
+    rows and more do not need to fit in memory.
+
+    Parameters:
+    file_name   : str
+                  name of the CSV to write
+    n_rows      : int
+                  number of rows (localizations)
+    traj_length : int
+                  rows per trajectory
+
+    Outputs:
+    file_name   : str
+                  name of the written CSV
+    """
+
+    rng = np.random.default_rng(seed)
+    header = ' ,Trajectory,Frame,x,y,z,m0,m1,m2,m3,m4,NPscore'
+    chunk_rows = chunk_rows - chunk_rows % traj_length
+    with open(file_name, 'w') as f:
+        f.write(header + '\n')
+        for first in range(0, n_rows, chunk_rows):
+            rows = np.arange(first, min(first + chunk_rows, n_rows))
+            traj = rows // traj_length
+            n_traj = traj[-1] - traj[0] + 1
+            bound = rng.random(n_traj) < bound_fraction
+            step = np.where(bound, 5, 1000 * np.sqrt(2 * 0.1 * 0.1))
+            xy = rng.normal(0, 1, (len(rows), 2)) * \
+                step[traj - traj[0], None]
+            # cumulative sum within each trajectory, from a random start
+            starts = rows % traj_length == 0
+            xy[starts] = rng.uniform(0, 50000, (np.sum(starts), 2))
+            xy = _cumsum_by_trajectory(xy, traj)
+            data = np.column_stack((rows + 1, traj + 1, rows % traj_length,
+                                    xy))
+            np.savetxt(f, data, delimiter=',',
+                       fmt='%d,%d,%d,%.3f,%.3f,0,0,0,0,0,0,0')
+
+    return file_name
+
+
+def _cumsum_by_trajectory(steps, traj):
+    """ Running sum of steps that restarts at every trajectory """
+
+    total = np.cumsum(steps, axis=0)
+    first = np.flatnonzero(np.append(True, traj[1:] != traj[:-1]))
+    offset = np.repeat(total[first] - steps[first], np.diff(
+        np.append(first, len(traj))), axis=0)
+
+    return total - offset
+
+
+def prepare_inputs(stages, args, data_dir):
+    """ Generate (or reuse, from data_dir) the inputs of every case
+
+    Outputs:
+    cases       : list of (stage, params) to run
+    """
+
+    cases = []
+    if any(stage in IMAGE_STAGES for stage in stages):
+        stack = os.path.join(data_dir, 'stack_{}x{}x{}.tif'.format(
+            args.n_frames, args.size, args.size))
+        if not os.path.exists(stack):
+            make_stack(stack, args.n_frames, args.size)
+        for stage in IMAGE_STAGES:
+            if stage not in stages:
+                continue
+            workers_list = [1] if stage == 'read_tif' else args.workers
+            for workers in workers_list:
+                cases.append((stage, {'stack': stack, 'workers': workers}))
+
+    if 'track_csv' in stages:
+        if not os.path.exists(args.config):
+            print('Skipping track_csv: no btrack config ' + args.config)
+        else:
+            features = os.path.join(data_dir, 'features_{}x{}.csv'.format(
+                args.n_frames, args.n_particles))
+            if not os.path.exists(features):
+                make_features(features, args.n_frames, args.n_particles)
+            for window in args.track_windows:
+                for tiles in args.track_tiles:
+                    params = {'features': features,
+                              'config': os.path.abspath(args.config)}
+                    if window:
+                        params['window'] = window
+                    if tiles > 1:
+                        params['tiles'] = tiles
+                    # windows and tiles are tracked on a process pool
+                    workers_list = args.workers if len(params) > 2 else [1]
+                    for workers in workers_list:
+                        if len(params) > 2:
+                            params = dict(params, workers=workers)
+                        cases.append(('track_csv', params))
+
+    for n_rows in args.rows:
+        trajectories = os.path.join(data_dir,
+                                    'traj_{}.csv'.format(n_rows))
+        for stage in TRAJECTORY_STAGES:
+            if stage not in stages:
+                continue
+            if not os.path.exists(trajectories):
+                make_trajectories(trajectories, n_rows)
+            cases.append((stage, {'trajectories': trajectories,
+                                  'rows': n_rows}))
+
+    return cases
+
+
+def setup_case(stage, params):
+    """ Prepare one case; returns (run, unit) where run() does the timed
+    work and returns the number of units processed """
+
+    if stage == 'read_tif':
+        def run():
+            return len(utils.read_tif(params['stack']))
+        return run, 'frames'
+
+    if stage == 'process_image':
+        out_name = params['stack'][:-4] + '_processed.tif'
+
+        def run():
+            return utils.process_image(params['stack'], blurIter=2,
+                                       out_name=out_name, keep_frames=False,
+                                       workers=params['workers'])
+        return run, 'frames'
+
+    if stage == 'extract_features':
+        frames = utils.read_tif(params['stack'])
+        out_name = params['stack'][:-4] + '_features.tif'
+
+        def run():
+            utils.extract_features(frames, out_name=out_name,
+                                   workers=params['workers'])
+            return len(frames)
+        return run, 'frames'
+
+    if stage == 'track_csv':
+        out = params['features'][:-4] + '_tracks.csv'
+
+        def run():
+            tiles = params.get('tiles')
+            utils.track_csv(params['features'], out, params['config'],
+                            params.get('window'),
+                            tiles=(tiles, tiles) if tiles else None,
+                            workers=params.get('workers'))
+            with open(params['features']) as f:
+                return sum(1 for line in f) - 1
+        return run, 'features'
+
+    if stage == 'calc_diffusion':
+        def run():
+            # includes parsing the file, as get_diffusion.py does
+            return len(utils.calc_diffusion(params['trajectories'], 1,
+                                            [3, 4])[1])
+        return run, 'trajectories'
+
+    table = utils.TrajectoryTable.from_csv(params['trajectories'])
+
+    if stage == 'get_xy_coords':
+        def run():
+            for traj_ID in table.traj_ids:
+                utils.get_xy_coords(table, 1, [3, 4], traj_ID)
+            return len(table.traj_ids)
+        return run, 'trajectories'
+
+    if stage == 'calc_dwelltime':
+        def run():
+            for traj_ID in table.traj_ids:
+                utils.calc_dwelltime(table.xy(traj_ID), 200, 10, 0.1)
+            return len(table.traj_ids)
+        return run, 'trajectories'
+
+    raise ValueError('Unknown stage ' + stage)
+
+
+def run_case(stage, params):
+    """ Run one case (in a fresh process) and measure it
+
+    Outputs:
+    result      : dict with the run time, throughput and peak memory
+    """
+
+    run, unit = setup_case(stage, params)
+    start = time.perf_counter()
+    n_units = run()
+    seconds = time.perf_counter() - start
+
+    # a second, untimed run traces the memory the stage allocates
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'stage': stage,
+            'params': {key: value for key, value in params.items()
+                       if key in ('workers', 'rows', 'window', 'tiles')},
+            'input': os.path.basename(list(params.values())[0]),
+            'seconds': seconds,
+            'rate': n_units / seconds,
+            'unit': unit + '/s',
+            'peak_mb': peak / 2**20,
+            'peak_rss_mb': utils.peak_rss_mb()}
+
+
+def find_regressions(results, history, tolerance):
+    """ Cases slower than in the latest earlier run by more than tolerance
+
+    Outputs:
+    regressions : list of (result, previous seconds)
+    """
+
+    regressions = []
+    for result in results:
+        for run in reversed(history):
+            previous = [old for old in run['results']
+                        if old['stage'] == result['stage'] and
+                        old['input'] == result['input'] and
+                        old['params'] == result['params']]
+            if previous:
+                slower = result['seconds'] - previous[0]['seconds']
+                # ignore timer noise of very short cases
+                if slower > tolerance * previous[0]['seconds'] and \
+                        slower > MIN_REGRESSION:
+                    regressions.append((result, previous[0]['seconds']))
+                break
+
+    return regressions
+
+
+def git_commit():
+    """ Current git commit of the repo, if known """
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+
+    """ Main function for benchmarking
+
+    Arguements are defined at the command line via argparse
+
+    """
+    parser = argparse.ArgumentParser(description='Benchmark pipeline stages')
+
+    parser.add_argument('--stages',
+                        dest='stages',
+                        nargs='+',
+                        default=IMAGE_STAGES + TRACK_STAGES +
+                        TRAJECTORY_STAGES,
+                        choices=IMAGE_STAGES + TRACK_STAGES +
+                        TRAJECTORY_STAGES,
+                        help="Stages to benchmark (default: all)")
+    parser.add_argument('--frames',
+                        dest='n_frames',
+                        type=int,
+                        default=100,
+                        help="Number of frames of the synthetic stack")
+    parser.add_argument('--size',
+                        dest='size',
+                        type=int,
+                        default=256,
+                        help="Frame width and height, in pixels")
+    parser.add_argument('--particles',
+                        dest='n_particles',
+                        type=int,
+                        default=50,
+                        help="Particles per frame of the synthetic features")
+    parser.add_argument('--rows',
+                        dest='rows',
+                        type=int,
+                        nargs='+',
+                        default=[1000, 100000],
+                        help="Sizes of the synthetic trajectory CSVs")
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        nargs='+',
+                        default=[1],
+                        help="Worker counts for the image stages")
+    parser.add_argument('--config',
+                        dest='config',
+                        type=str,
+                        default='config_test.json',
+                        help="btrack configuration file for track_csv")
+    parser.add_argument('--track_windows',
+                        dest='track_windows',
+                        type=int,
+                        nargs='+',
+                        default=[0],
+                        help="Tracking windows, in frames, for track_csv "
+                             "(0: whole movie)")
+    parser.add_argument('--track_tiles',
+                        dest='track_tiles',
+                        type=int,
+                        nargs='+',
+                        default=[1],
+                        help="Spatial tiles per side for track_csv (1: whole "
+                             "field of view)")
+    parser.add_argument('--data_dir',
+                        dest='data_dir',
+                        type=str,
+                        default=None,
+                        help="Keep generated inputs here and reuse them "
+                             "(default: a temporary directory)")
+    parser.add_argument('--history',
+                        dest='history',
+                        type=str,
+                        default='benchmark_history.json',
+                        help="JSON file the results are appended to")
+    parser.add_argument('--check',
+                        dest='check',
+                        action='store_true',
+                        help="Exit with 1 if a case regressed")
+    parser.add_argument('--tolerance',
+                        dest='tolerance',
+                        type=float,
+                        default=0.2,
+                        help="Allowed slow down before a case counts as a "
+                             "regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        os.makedirs(data_dir, exist_ok=True)
+        cases = prepare_inputs(args.stages, args, data_dir)
+
+        # a fresh process per case, so peak memory is measured per stage
+        results = []
+        spawn = multiprocessing.get_context('spawn')
+        for stage, params in cases:
+            with ProcessPoolExecutor(max_workers=1,
+                                     mp_context=spawn) as executor:
+                result = executor.submit(run_case, stage, params).result()
+            results.append(result)
+            # worker count, tracking window (w<frames>) and tiles (t<NxN>)
+            case = result['params']
+            setting = []
+            if 'workers' in case:
+                setting.append(str(case['workers']))
+            if 'window' in case:
+                setting.append('w{}'.format(case['window']))
+            if 'tiles' in case:
+                setting.append('t{0}x{0}'.format(case['tiles']))
+            print('{stage:17s} {input:28s} {setting:>9}  {seconds:8.3f} s '
+                  '{rate:12.1f} {unit:15s} {peak_mb:8.1f} MB'.format(
+                      setting=','.join(setting), **result))
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history, 'r') as f:
+            history = json.load(f)
+    regressions = find_regressions(results, history, args.tolerance)
+
+    history.append({'time': datetime.datetime.now().isoformat(),
+                    'commit': git_commit(),
+                    'numpy': np.__version__,
+                    'results': results})
+    with open(args.history, 'w') as f:
+        json.dump(history, f, indent=1)
+
+    for result, previous in regressions:
+        print('REGRESSION {} {}: {:.3f} s, was {:.3f} s'.format(
+            result['stage'], result['input'], result['seconds'], previous))
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    main()
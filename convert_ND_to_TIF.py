@@ -29,7 +29,10 @@ def main():
                         required=True,
                         help="File to be converted")
 
+    utils.add_profile_arguments(parser)
     args = parser.parse_args()
+    if args.profile:
+        utils.PROFILER.enable(args.cprofile)
 
     # convert file
     file_in = args.file_in
@@ -39,6 +42,9 @@ def main():
 
     print('Complete!')
 
+    if args.profile:
+        utils.PROFILER.write_report(file_out[:-4] + '_profile.json')
+
 if __name__ == '__main__':
 
     main()
@@ -0,0 +1,66 @@
+""" Convert a table between CSV and the binary (.npy) format
+
+Features, tracks and results CSVs can be stored as typed binary tables,
+which load without parsing text (and can be memory-mapped). This script
+converts in either direction, based on the extension of the input file.
+
+Usage:
+python convert_table.py --file sample_traj.csv
+python convert_table.py --file sample_traj.npy --out sample_traj_copy.csv
+
+"""
+
+import utils
+import argparse
+
+
+def main():
+
+    """ Main function for converting tables
+
+    Arguements are defined at the command line via argparse
+
+    utils.csv_to_npy / utils.npy_to_csv  : workhorses for this script
+
+    """
+    parser = argparse.ArgumentParser(description='Convert a table between '
+                                                 'CSV and binary (.npy)')
+
+    parser.add_argument('--file',
+                        dest='file_in',
+                        type=str,
+                        required=True,
+                        help="CSV or .npy file to be converted")
+    parser.add_argument('--out',
+                        dest='file_out',
+                        type=str,
+                        default=None,
+                        help="Output file; defaults to the input file with "
+                             "the other extension")
+    parser.add_argument('--delimiter',
+                        dest='delimiter',
+                        type=str,
+                        default=',',
+                        help="CSV column separator (btrack's tracks use ' ')")
+
+    utils.add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.profile:
+        utils.PROFILER.enable(args.cprofile)
+
+    if args.file_in.endswith('.npy'):
+        file_out = utils.npy_to_csv(args.file_in, args.file_out,
+                                    args.delimiter)
+    else:
+        file_out = utils.csv_to_npy(args.file_in, args.file_out,
+                                    args.delimiter)
+
+    print('Wrote ' + file_out)
+
+    if args.profile:
+        utils.PROFILER.write_report(file_out[:-4] + '_profile.json')
+
+
+if __name__ == '__main__':
+
+    main()
@@ -7,7 +7,6 @@ single particle trajectories
 
 import utils
 import argparse
-import csv
 import matplotlib.pyplot as plt
 import sys
 
@@ -32,35 +31,91 @@ def main():
                         help="File to be processed")
     parser.add_argument('--delta_T',
                         dest='deltaT',
-                        type=str,
+                        type=float,
                         required=True,
                         help="Time delay between frames, in seconds")
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=1,
+                        required=False,
+                        help="Number of processes to analyze trajectories")
+    parser.add_argument('--incremental',
+                        dest='incremental',
+                        action='store_true',
+                        help="Only re-analyze trajectories that received "
+                             "new rows since the last run")
+    parser.add_argument('--format',
+                        dest='out_format',
+                        choices=['csv', 'npy'],
+                        default='csv',
+                        help="Write the results as CSV or as a binary "
+                             "(.npy) table")
+    parser.add_argument('--chunk_rows',
+                        dest='chunk_rows',
+                        type=int,
+                        default=None,
+                        help="Stream the trajectory file this many rows at "
+                             "a time instead of loading it whole")
+    parser.add_argument('--bootstrap',
+                        dest='n_resamples',
+                        type=int,
+                        default=0,
+                        help="Number of bootstrap resamples for confidence "
+                             "intervals (0: none)")
+    utils.add_profile_arguments(parser)
     args = parser.parse_args()
+    if args.profile:
+        utils.PROFILER.enable(args.cprofile)
 
     # set-up
     file_in = args.file_in
-    file_out = file_in[:-4] + '_diffusion_coeffs.csv'
+    file_out = file_in[:-4] + '_diffusion_coeffs.' + args.out_format
     traj_ID = 'all'  # compute all diffusion coeffs; default
     query_column = 1
     result_columns = [3, 4]
     deltaT = args.deltaT  # exposure time, in seconds
 
-    traj_xy, diffusion = utils.calc_diffusion(file_in,
-                                              query_column,
-                                              result_columns,
-                                              traj_ID,
-                                              deltaT)
-
-    # write diffusion coeffs to CSV
+    def analyze(trajectories):
+        traj_xy, diffusion = utils.calc_diffusion(trajectories,
+                                                  query_column,
+                                                  result_columns,
+                                                  traj_ID,
+                                                  deltaT,
+                                                  args.workers)
+        return diffusion
+
+    if args.incremental:
+        # merge newly grown trajectories into the existing output
+        diffusion = utils.update_traj_results(
+            file_in, file_out, query_column, analyze,
+            params={'result_columns': result_columns, 'delta_T': deltaT})
+    elif args.chunk_rows is not None:
+        # memory is bounded by the chunk size, not the file size
+        diffusion = list(utils.stream_diffusion(file_in,
+                                                query_column,
+                                                result_columns,
+                                                deltaT,
+                                                args.chunk_rows))
+    else:
+        diffusion = analyze(file_in)
+
+    # write diffusion coeffs to file
     field_names = ['Trajectory_ID', 'Diffusion_Coeff (um^2/s)']
-
-    with open(file_out, 'w') as csvfile:
-        # creating a csv writer object
-        csvwriter = csv.writer(csvfile)
-
-        # writing the fields and data
-        csvwriter.writerow(field_names)
-        csvwriter.writerows(diffusion)
+    utils.write_results(diffusion, file_out, field_names)
+
+    # confidence intervals of the population's D
+    if args.n_resamples > 0:
+        values = utils.result_values(diffusion)
+        summary = [['Statistic', 'Estimate', 'CI_low', 'CI_high']]
+        for statistic in ['mean', 'median']:
+            estimate, low, high = utils.bootstrap_ci(values, statistic,
+                                                     args.n_resamples,
+                                                     workers=args.workers)
+            summary.append([statistic + '_D', estimate, low, high])
+            print('{} D = {:.4g} um^2/s (95% CI {:.4g} - {:.4g})'.format(
+                statistic, estimate, low, high))
+        utils.write_csv(summary, file_in[:-4] + '_diffusion_bootstrap.csv')
 
     # plot histogram of diffusion coeffs
     hist_out_file = file_in[:-4] + '_diffusion_coeffs_hist.png'
@@ -79,6 +134,9 @@ def main():
 
     plt.savefig(hist_out_file, bbox_inches='tight')
 
+    if args.profile:
+        utils.PROFILER.write_report(file_in[:-4] + '_profile.json')
+
 
 if __name__ == '__main__':
 
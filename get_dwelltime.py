@@ -3,14 +3,16 @@
 With a CSV file as the output, calculate particle dwell times for each
 trajectory
 
+Given several values of --max_disp, --bound_frames or --delta_T, dwell times
+are computed for every combination of them in a single pass (a sweep), and
+written as one table with a row per binding event, plus a summary table with
+a row per combination.
+
 """
 
 import utils
 import argparse
-import numpy as np
-import csv
 import matplotlib.pyplot as plt
-import sys
 
 
 def main():
@@ -20,6 +22,7 @@ def main():
     Arguements are defined at the command line via argparse
 
     utils.calc_diffusion  : Calculate diffusion coeffs
+    utils.sweep_dwelltimes  : Dwell times over grids of thresholds
 
     """
     # initialize argparser
@@ -33,89 +36,129 @@ def main():
     parser.add_argument('--delta_T',
                         dest='deltaT',
                         type=float,
+                        nargs='+',
                         required=False,
-                        help="Time between frames, in seconds")
+                        help="Time between frames, in seconds "
+                             "(default: 0.1)")
     parser.add_argument('--bound_frames',
                         dest='min_bound_frames',
                         type=int,
+                        nargs='+',
                         required=True,
                         help="How many frames to consider a particle bound")
     parser.add_argument('--max_disp',
                         dest='max_disp',
                         type=int,
+                        nargs='+',
                         required=True,
                         help="Max distance a particle can travel while bound")
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=1,
+                        required=False,
+                        help="Number of processes to analyze trajectories")
+    parser.add_argument('--incremental',
+                        dest='incremental',
+                        action='store_true',
+                        help="Only re-analyze trajectories that received "
+                             "new rows since the last run")
+    parser.add_argument('--format',
+                        dest='out_format',
+                        choices=['csv', 'npy'],
+                        default='csv',
+                        help="Write the results as CSV or as a binary "
+                             "(.npy) table")
+    parser.add_argument('--chunk_rows',
+                        dest='chunk_rows',
+                        type=int,
+                        default=None,
+                        help="Stream the trajectory file this many rows at "
+                             "a time instead of loading it whole")
+    parser.add_argument('--bootstrap',
+                        dest='n_resamples',
+                        type=int,
+                        default=0,
+                        help="Number of bootstrap resamples for confidence "
+                             "intervals (0: none)")
+    utils.add_profile_arguments(parser)
     args = parser.parse_args()
+    if args.profile:
+        utils.PROFILER.enable(args.cprofile)
 
     # set-up
     file_in = args.file_in
     query_column = 1  # column where trajectory IDs are located
     result_columns = [3, 4]  # columns where X & Y coords are located
-    frame_rate = args.deltaT  # exposure time, in seconds
-    min_bound_frames = args.min_bound_frames
-    max_disp = args.max_disp
-    file_out = file_in[:-4] + '_dwell_times.csv'
-
-    # first, generate a list of unique trajectories in the file
-    try:
-        traj_file = open(file_in, 'r')  # open file with traj info
-    except FileNotFoundError:
-        print("Could not find file " + file_in)
-        sys.exit(1)
-
-    header = None
-    all_trajs = []  # initialize empty list for trajectory IDs
-
-    # pull out all trajectory IDs
-    for line in traj_file:
-        if header is None:
-            header = line
-            continue
-        currLine = line.rstrip().split(',')
-        all_trajs.append(int(currLine[query_column]))
-
-    # convert to np array to use unique function
-    all_trajs = np.array(all_trajs)
-    all_trajs_unique = np.unique(all_trajs)  # yields only unique traj IDs
-
-    # now, loop through each trajectory to get its xy coords and then get its
-    # dwell time(s)
-    all_dwell_times = []  # where to store the final data
-    for traj_ID in np.nditer(all_trajs_unique):
-        traj_file.seek(0)  # reset file to the beginning!
-        xy_coords = utils.get_xy_coords(file_in,
-                                        query_column,
-                                        result_columns,
-                                        traj_ID)
-        # now, compute dwell times
-        dwell_time = utils.calc_dwelltime(xy_coords,
-                                          max_disp,
-                                          min_bound_frames,
-                                          frame_rate)
-        # handle cases where we may have multiple binding events (rare)
-        if dwell_time is not None:
-            if len(dwell_time) > 1:
-                for i in range(len(dwell_time)):
-                    # generate a new traj ID, using decimal points
-                    # note: assumes we'll never have > 10 events
-                    temp_traj_ID = float(str(traj_ID) + '.' + str(i+1))
-                    all_dwell_times.append([temp_traj_ID, dwell_time[i]])
-            else:
-                # not doing the below appends a list to the list
-                dwell_time = dwell_time[0]
-
-        all_dwell_times.append([int(traj_ID), dwell_time])
+    # exposure time, in seconds; calc_dwelltime's default if not given
+    frame_rates = args.deltaT or [0.1]
+
+    if len(args.max_disp) * len(args.min_bound_frames) * \
+            len(frame_rates) > 1:
+        if args.incremental or args.chunk_rows is not None or \
+                args.n_resamples > 0:
+            parser.error('--incremental, --chunk_rows and --bootstrap '
+                         'take single threshold values')
+        sweep(args, query_column, result_columns, frame_rates)
+        if args.profile:
+            utils.PROFILER.write_report(file_in[:-4] + '_profile.json')
+        return
+
+    frame_rate = frame_rates[0]
+    min_bound_frames = args.min_bound_frames[0]
+    max_disp = args.max_disp[0]
+    file_out = file_in[:-4] + '_dwell_times.' + args.out_format
+
+    # get the xy coords of each trajectory and then its dwell time(s)
+    def analyze(trajectories):
+        return utils.calc_all_dwelltimes(trajectories,
+                                         query_column,
+                                         result_columns,
+                                         max_disp,
+                                         min_bound_frames,
+                                         frame_rate,
+                                         args.workers)
+
+    if args.incremental:
+        # merge newly grown trajectories into the existing output
+        all_dwell_times = utils.update_traj_results(
+            file_in, file_out, query_column, analyze,
+            params={'result_columns': result_columns, 'max_disp': max_disp,
+                    'bound_frames': min_bound_frames,
+                    'delta_T': frame_rate})
+    elif args.chunk_rows is not None:
+        # memory is bounded by the chunk size, not the file size
+        all_dwell_times = list(utils.stream_dwelltimes(file_in,
+                                                       query_column,
+                                                       result_columns,
+                                                       max_disp,
+                                                       min_bound_frames,
+                                                       frame_rate,
+                                                       args.chunk_rows))
+    else:
+        # load the trajectories once; the analysis reuses the table
+        all_dwell_times = analyze(utils.TrajectoryTable.load(
+            file_in, query_column))
 
     # write the data to a file
     field_names = ['Trajectory_ID', 'Dwell_Times (s)']
-
-    with open(file_out, 'w') as csvfile:
-        # creating a csv writer object
-        csvwriter = csv.writer(csvfile)
-
-        # writing the fields and data
-        csvwriter.writerow(field_names)
-        csvwriter.writerows(all_dwell_times)
+    utils.write_results(all_dwell_times, file_out, field_names)
+
+    # confidence intervals of the dwell time distribution; an event needs
+    # more than min_bound_frames bound frames, so k_off is fit from the
+    # shortest dwell time that can be observed
+    if args.n_resamples > 0:
+        values = utils.result_values(all_dwell_times)
+        summary = [['Statistic', 'Estimate', 'CI_low', 'CI_high']]
+        for statistic in ['mean', 'median', 'k_off']:
+            estimate, low, high = utils.bootstrap_ci(
+                values, statistic, args.n_resamples,
+                t_min=(min_bound_frames + 1) * frame_rate,
+                workers=args.workers, frame_rate=frame_rate)
+            summary.append([statistic, estimate, low, high])
+            print('{} = {:.4g} (95% CI {:.4g} - {:.4g})'.format(
+                statistic, estimate, low, high))
+        utils.write_csv(summary, file_in[:-4] + '_dwell_times_bootstrap.csv')
 
     # plot the data
     hist_out_file = file_in[:-4] + '_dwell_times_hist.png'
@@ -141,6 +184,43 @@ def main():
     ax.set_ylabel('Events')
     plt.savefig(hist_out_file, bbox_inches='tight')
 
+    if args.profile:
+        utils.PROFILER.write_report(file_in[:-4] + '_profile.json')
+
+
+def sweep(args, query_column, result_columns, frame_rates):
+    """ Dwell times for every combination of the thresholds given """
+
+    file_in = args.file_in
+    events_out = file_in[:-4] + '_dwell_time_sweep.' + args.out_format
+    summary_out = file_in[:-4] + '_dwell_time_sweep_summary.' + \
+        args.out_format
+
+    trajectories = utils.TrajectoryTable.load(file_in, query_column)
+    events, summary = utils.sweep_dwelltimes(trajectories,
+                                             query_column,
+                                             result_columns,
+                                             args.max_disp,
+                                             args.min_bound_frames,
+                                             frame_rates,
+                                             args.workers)
+
+    params = ['Max_Disp', 'Min_Bound_Frames', 'Frame_Rate (s)']
+    utils.write_results(events, events_out,
+                        params + ['Trajectory_ID', 'Event',
+                                  'Dwell_Times (s)'])
+    utils.write_results(summary, summary_out,
+                        params + ['Bound_Fraction', 'N_Events',
+                                  'Mean_Dwell_Time (s)',
+                                  'Median_Dwell_Time (s)'])
+
+    print('{:>8s} {:>12s} {:>10s} {:>8s} {:>8s} {:>9s} {:>9s}'.format(
+        'max_disp', 'bound_frames', 'delta_T', 'bound', 'events', 'mean',
+        'median'))
+    for row in summary:
+        print('{:8g} {:12d} {:10g} {:8.3f} {:8d} {:9.4g} {:9.4g}'.format(
+            *row))
+
 
 if __name__ == '__main__':
 
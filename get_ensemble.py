@@ -0,0 +1,143 @@
+""" Get Ensemble Statistics
+
+With CSV files as outputs, calculate population-level statistics over every
+trajectory of a file: the ensemble-averaged MSD curve and the distribution of
+single-frame jump distances, fit with a mixture of diffusive populations.
+The file is read in a single streaming pass.
+
+"""
+
+import utils
+import argparse
+import matplotlib.pyplot as plt
+import numpy as np
+
+
+def main():
+
+    """ Main function for getting ensemble statistics
+
+    Arguements are defined at the command line via argparse
+
+    utils.ensemble_stats  : Accumulate the ensemble MSD and jump distances
+
+    """
+    # initialize argparser
+
+    parser = argparse.ArgumentParser(description='Get ensemble MSD and '
+                                                 'jump distance statistics')
+
+    parser.add_argument('--file',
+                        dest='file_in',
+                        type=str,
+                        required=True,
+                        help="File to be processed")
+    parser.add_argument('--delta_T',
+                        dest='deltaT',
+                        type=float,
+                        required=True,
+                        help="Time delay between frames, in seconds")
+    parser.add_argument('--max_lag',
+                        dest='max_lag',
+                        type=int,
+                        default=20,
+                        help="Largest lag of the ensemble MSD, in frames")
+    parser.add_argument('--max_jump',
+                        dest='max_jump',
+                        type=float,
+                        default=2,
+                        help="Largest jump distance histogrammed, in um")
+    parser.add_argument('--bins',
+                        dest='bins',
+                        type=int,
+                        default=400,
+                        help="Number of jump distance bins")
+    parser.add_argument('--components',
+                        dest='n_components',
+                        type=int,
+                        default=2,
+                        help="Number of diffusive populations to fit")
+    parser.add_argument('--chunk_rows',
+                        dest='chunk_rows',
+                        type=int,
+                        default=100000,
+                        help="Rows of the trajectory file read at a time")
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=1,
+                        required=False,
+                        help="Number of processes to analyze trajectories")
+    utils.add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.profile:
+        utils.PROFILER.enable(args.cprofile)
+
+    # set-up
+    file_in = args.file_in
+    query_column = 1
+    result_columns = [3, 4]
+    jump_edges = np.linspace(0, args.max_jump, args.bins + 1)
+
+    stats = utils.ensemble_stats(file_in,
+                                 query_column,
+                                 result_columns,
+                                 args.deltaT,
+                                 args.max_lag,
+                                 jump_edges,
+                                 args.chunk_rows,
+                                 args.workers)
+
+    # ensemble MSD curve and its fit
+    lags, msd, counts = stats.msd()
+    utils.write_csv([['Lag (s)', 'MSD (um^2)', 'N_displacements']] +
+                    [[lag, value, int(n)]
+                     for lag, value, n in zip(lags, msd, counts)],
+                    file_in[:-4] + '_ensemble_msd.csv')
+    D, alpha = stats.fit_msd()
+    print('{} trajectories; ensemble D = {:.4g} um^2/s, alpha = {:.3f}'
+          .format(stats.n_trajectories, D, alpha))
+
+    # jump distance distribution and its populations
+    centers, density = stats.jump_distribution()
+    utils.write_csv([['Jump_Distance (um)', 'Density (1/um)', 'Count']] +
+                    [[r, p, int(n)] for r, p, n in
+                     zip(centers, density, stats.jump_counts)],
+                    file_in[:-4] + '_jump_distances.csv')
+    D_pop, fractions = stats.fit_jump_distances(args.n_components)
+    utils.write_csv([['Population', 'Diffusion_Coeff (um^2/s)',
+                      'Fraction']] +
+                    [[i + 1, d, f] for i, (d, f) in
+                     enumerate(zip(D_pop, fractions))],
+                    file_in[:-4] + '_jump_distance_fits.csv')
+    for i, (d, f) in enumerate(zip(D_pop, fractions)):
+        print('population {}: D = {:.4g} um^2/s, fraction = {:.3f}'
+              .format(i + 1, d, f))
+
+    # plot the jump distances with the fitted populations
+    hist_out_file = file_in[:-4] + '_jump_distances_hist.png'
+    tau = args.deltaT
+    width = 3
+    height = 3
+    fig = plt.figure(figsize=(width, height), dpi=300)
+
+    ax = fig.add_subplot(1, 1, 1)
+
+    ax.bar(centers, density, width=np.diff(jump_edges), color='grey')
+    for d, f in zip(D_pop, fractions):
+        ax.plot(centers, f * centers / (2 * d * tau) *
+                np.exp(-centers**2 / (4 * d * tau)))
+
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.set_xlabel('Jump Distance (um)')
+    ax.set_ylabel('Density')
+    plt.savefig(hist_out_file, bbox_inches='tight')
+
+    if args.profile:
+        utils.PROFILER.write_report(file_in[:-4] + '_profile.json')
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,120 @@
+""" Get MSD Curves and Fits
+
+With a CSV file as an output, calculate the time-averaged mean squared
+displacement (MSD) curve of every single particle trajectory over all lags,
+and fit it for the diffusion coefficient D and the anomalous exponent alpha
+(alpha = 1 for free diffusion, < 1 for confined, > 1 for directed motion).
+
+"""
+
+import utils
+import argparse
+import matplotlib.pyplot as plt
+import numpy as np
+
+
+def main():
+
+    """ Main function for getting MSD curves and fits
+
+    Arguements are defined at the command line via argparse
+
+    utils.fit_msd   : Fit D and alpha to the MSD curves
+    utils.calc_msd  : MSD curves, exported with --curves
+
+    """
+    # initialize argparser
+
+    parser = argparse.ArgumentParser(description='Get MSD curves and fits')
+
+    parser.add_argument('--file',
+                        dest='file_in',
+                        type=str,
+                        required=True,
+                        help="File to be processed")
+    parser.add_argument('--delta_T',
+                        dest='deltaT',
+                        type=float,
+                        required=True,
+                        help="Time delay between frames, in seconds")
+    parser.add_argument('--fit_lags',
+                        dest='n_lags',
+                        type=int,
+                        default=4,
+                        help="Number of lags used to fit D and alpha")
+    parser.add_argument('--curves',
+                        dest='curves',
+                        action='store_true',
+                        help="Also export the MSD of every lag of every "
+                             "trajectory")
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=1,
+                        required=False,
+                        help="Number of processes to analyze trajectories")
+    parser.add_argument('--format',
+                        dest='out_format',
+                        choices=['csv', 'npy'],
+                        default='csv',
+                        help="Write the results as CSV or as a binary "
+                             "(.npy) table")
+    utils.add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.profile:
+        utils.PROFILER.enable(args.cprofile)
+
+    # set-up
+    file_in = args.file_in
+    file_out = file_in[:-4] + '_msd_fits.' + args.out_format
+    curves_out = file_in[:-4] + '_msd_curves.' + args.out_format
+    query_column = 1
+    result_columns = [3, 4]
+
+    # load the trajectories once; both analyses reuse the table
+    trajectories = utils.TrajectoryTable.load(file_in, query_column)
+
+    msd_fits = utils.fit_msd(trajectories,
+                             query_column,
+                             result_columns,
+                             args.deltaT,
+                             args.n_lags,
+                             args.workers)
+    utils.write_results(msd_fits, file_out,
+                        ['Trajectory_ID', 'Diffusion_Coeff (um^2/s)',
+                         'Alpha'])
+
+    if args.curves:
+        msd_curves = utils.calc_msd(trajectories,
+                                    query_column,
+                                    result_columns,
+                                    args.deltaT,
+                                    args.workers)
+        utils.write_results(msd_curves, curves_out,
+                            ['Trajectory_ID', 'Lag (s)', 'MSD (um^2)',
+                             'N_pairs'])
+
+    # plot histograms of D and alpha
+    hist_out_file = file_in[:-4] + '_msd_fits_hist.png'
+    fits = np.array(msd_fits, dtype=float).reshape(-1, 3)
+    fits = fits[~np.isnan(fits).any(axis=1)]
+    width = 6
+    height = 3
+    fig = plt.figure(figsize=(width, height), dpi=300)
+
+    for i, label in [(1, 'Diffusion Coeff (um^2/s)'), (2, 'Alpha')]:
+        ax = fig.add_subplot(1, 2, i)
+        ax.hist(fits[:, i], 50)
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.set_xlabel(label)
+
+    plt.savefig(hist_out_file, bbox_inches='tight')
+
+    if args.profile:
+        utils.PROFILER.write_report(file_in[:-4] + '_profile.json')
+
+
+if __name__ == '__main__':
+
+    main()
@@ -1,9 +1,8 @@
 """ Plot Diffusion Coeffs
 
 This script will be useful for plotting existing diffusion coefficient files.
-The calculation of diffusion coefficients can sometimes take ~10 min, depending
-on how many trajectories are being analyzed. If a user would rather configure
-plots on a pre-existing CSV files, they can do so here.
+If a user would rather configure plots on a pre-existing CSV files without
+recomputing the diffusion coefficients, they can do so here.
 
 Inputs:
 ---
@@ -1,9 +1,8 @@
 """ Plot Dwell Time
 
 This script will be useful for plotting existing dwell time files.
-The calculation of dwell times, similar to diffusion coefficients, can often
-take 10-30 min, depending on how many trajectories are analyzed. If a user
-would rather configure plots on a pre-existing CSV files, they can do so here.
+If a user would rather configure plots on a pre-existing CSV files without
+recomputing the dwell times, they can do so here.
 
 Inputs:
 ---
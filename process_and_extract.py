@@ -6,24 +6,29 @@ and extracting the XY coordinates of these features.
 """
 
 import utils
-import cv2 as cv
+import argparse
 
 def main():
     " Main function for processing images and extracting features"
 
-    # first, process the image and save the processed file
-    file_in = 'sample_SPT.tif'
-    result = utils.process_image(file_in, blurIter=2)
-    cv.waitKey(1000)  #wait for the file to be closed
+    parser = argparse.ArgumentParser(description='Process images and '
+                                                 'extract features')
+    utils.add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.profile:
+        utils.PROFILER.enable(args.cprofile)
 
-    # next, extract features (XY coordinates for eventual track linking)
-    file_in = 'out_processed.tif'
-    # get the frames to be processed as np arrays
-    processed_frames = utils.read_tif(file_in)
+    # process the image and extract features (XY coordinates for eventual
+    # track linking) in one pass; processed frames go straight to feature
+    # extraction, and the processed movie is saved along the way
+    file_in = 'sample_SPT.tif'
     # extract features will save a result.tif with keypoints
-    features = utils.extract_features(processed_frames)
+    features = utils.process_and_extract_features(
+        file_in, blurIter=2, processed_name='out_processed.tif')
     # write the features to a CSV file
     utils.write_csv(features)
+    if args.profile:
+        utils.PROFILER.write_report('results_profile.json')
 
 if __name__ == '__main__':
 
@@ -2,9 +2,9 @@
 
 python convert_ND2_to_TIF.py --file sample_SPT.nd2
 
-python get_diffusion.py --file sample_traj_crop.csv 
- 
-python get_diffusion.py --file sample_traj.csv # NOTE this one will take awhile
+python get_diffusion.py --file sample_traj_crop.csv --delta_T 0.1
+
+python get_diffusion.py --file sample_traj.csv --delta_T 0.1
 
 # Automated testing and pycodestyle verification
 
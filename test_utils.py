@@ -3,12 +3,17 @@
 """
 import utils
 import unittest
+import unittest.mock
 import sys
 import matplotlib.pyplot as plt
 import tifffile
 import os
+import tempfile
+import json
+import asyncio
 from nd2reader import ND2Reader
 import cv2 as cv
+import numpy as np
 
 
 # class TestUtils_convert_ND2(unittest.TestCase):
@@ -262,6 +267,1269 @@ import cv2 as cv
 #         self.assertEqual(xy_coords, expected)
 
 
+class TestUtils_calc_diffusion_groupby(unittest.TestCase):
+    """ Testing the single-pass, group-by calc_diffusion
+
+    """
+
+    def reference_diffusion(self, file_in, traj_ID, deltaT):
+        # brute-force MSD of a single trajectory, one row at a time
+        xy = []
+        with open(file_in, 'r') as traj_file:
+            next(traj_file)
+            for line in traj_file:
+                currLine = line.rstrip().split(',')
+                if int(currLine[1]) == traj_ID:
+                    xy.append([float(currLine[3]), float(currLine[4])])
+        xy = np.array(xy)/1000
+        r = np.sqrt(xy[:, 0]**2 + xy[:, 1]**2)
+        return np.mean(np.diff(r)**2)/(4 * deltaT)
+
+    def test_calc_diffusion_missingfile(self):
+        # check for missing file, throw an error
+        with self.assertRaises(SystemExit) as ex:
+            utils.calc_diffusion('crapFile.csv', 1, [3, 4])
+        self.assertEqual(ex.exception.code, 1)
+
+    def test_calc_diffusion_look_at_all_tracks(self):
+        # every trajectory is reported once, in ID order
+        traj_xy, diffusion = utils.calc_diffusion('sample_traj_crop.csv',
+                                                  1, [3, 4], 'all', 0.1)
+        self.assertEqual([ID for ID, D in diffusion], [1, 2, 3, 4])
+        self.assertEqual(traj_xy.shape, (45, 2))
+        for ID, D in diffusion:
+            expected = self.reference_diffusion('sample_traj_crop.csv',
+                                                ID, 0.1)
+            self.assertAlmostEqual(D, expected, places=15)
+
+    def test_calc_diffusion_all_matches_single_traj(self):
+        # the group-by pass agrees with analyzing trajectories one by one
+        traj_xy, diffusion = utils.calc_diffusion('sample_traj.csv',
+                                                  1, [3, 4], 'all', 0.1)
+        self.assertEqual(len(diffusion), 5778)
+        for ID, D in diffusion[::500]:
+            single_xy, single_D = utils.calc_diffusion('sample_traj.csv',
+                                                       1, [3, 4], ID, 0.1)
+            self.assertAlmostEqual(D, single_D, places=15)
+            self.assertAlmostEqual(
+                D, self.reference_diffusion('sample_traj.csv', ID, 0.1),
+                places=15)
+
+    def test_calc_diffusion_matches_sample_output(self):
+        # regression test against the published sample output
+        traj_xy, diffusion = utils.calc_diffusion('sample_traj.csv',
+                                                  1, [3, 4], 'all', 0.1)
+        expected = np.loadtxt(os.path.join('sample_outputs',
+                                           'sample_traj_diffusion_coeffs.csv'),
+                              delimiter=',', skiprows=1)
+        np.testing.assert_array_equal([ID for ID, D in diffusion],
+                                      expected[:, 0])
+        np.testing.assert_allclose([D for ID, D in diffusion],
+                                   expected[:, 1], rtol=1e-12)
+        self.assertAlmostEqual(diffusion[1][1], 9.458215036860498e-10,
+                               places=20)
+
+
+class TestUtils_TrajectoryTable(unittest.TestCase):
+    """ Testing the shared, columnar trajectory table
+
+    """
+
+    def setUp(self):
+        self.table = utils.TrajectoryTable.from_csv('sample_traj_crop.csv')
+
+    def test_trajectory_table_missingfile(self):
+        # check for missing file, throw an error
+        with self.assertRaises(SystemExit) as ex:
+            utils.TrajectoryTable.from_csv('crapFile.csv')
+        self.assertEqual(ex.exception.code, 1)
+
+    def test_trajectory_table_columns(self):
+        # the btrack header is kept and columns are typed
+        self.assertEqual(len(self.table), 45)
+        self.assertEqual(self.table.columns[1:5],
+                         ['Trajectory', 'Frame', 'x', 'y'])
+        self.assertEqual(self.table.trajectory.dtype, np.int64)
+        self.assertEqual(self.table.frame.dtype, np.int64)
+        np.testing.assert_array_equal(self.table.column('x'),
+                                      self.table.column(3))
+
+    def test_trajectory_table_offsets(self):
+        # rows are sorted by trajectory, with an offset index
+        table = utils.TrajectoryTable(['Trajectory', 'x'],
+                                      [[2, 1.0], [1, 2.0], [2, 3.0]], 0)
+        np.testing.assert_array_equal(table.traj_ids, [1, 2])
+        np.testing.assert_array_equal(table.starts, [0, 1])
+        np.testing.assert_array_equal(table.stops, [1, 3])
+        # file order is kept within a trajectory
+        np.testing.assert_array_equal(table.rows(2)[:, 1], [1.0, 3.0])
+        self.assertEqual(len(table.rows(7)), 0)
+
+    def test_trajectory_table_in_place_of_file(self):
+        # every analysis gives the same result from the table or the file
+        _, from_file = utils.calc_diffusion('sample_traj_crop.csv',
+                                            1, [3, 4])
+        _, from_table = utils.calc_diffusion(self.table, 1, [3, 4])
+        self.assertEqual(from_file, from_table)
+
+        np.testing.assert_array_equal(
+            utils.get_xy_coords('sample_traj_crop.csv', 1, [3, 4], 1),
+            utils.get_xy_coords(self.table, 1, [3, 4], 1))
+
+        self.assertEqual(
+            utils.calc_all_dwelltimes('sample_traj_crop.csv', 1, [3, 4],
+                                      5, 2, 0.1),
+            utils.calc_all_dwelltimes(self.table, 1, [3, 4], 5, 2, 0.1))
+
+    def test_get_xy_coords(self):
+        # check that I can extract xy coords
+        xy_coords = utils.get_xy_coords(self.table, 1, [3, 4], 1)
+        expected = [[170.202, 22.481],
+                    [169.726, 22.459],
+                    [169.192, 22.727],
+                    [165.64, 22.686]]
+        self.assertEqual(xy_coords.tolist(), expected)
+
+    def test_get_xy_coords_zero_copy(self):
+        # coordinates are a view into the table, not a copy
+        xy_coords = utils.get_xy_coords(self.table, 1, [3, 4], 4)
+        self.assertEqual(xy_coords.shape, (33, 2))
+        self.assertTrue(np.shares_memory(xy_coords, self.table.data))
+        # non-adjacent columns still work, as a copy
+        xz_coords = utils.get_xy_coords(self.table, 1, [5, 3], 4)
+        np.testing.assert_array_equal(xz_coords[:, 1], xy_coords[:, 0])
+
+
+class TestUtils_calc_dwelltime_kdtree(unittest.TestCase):
+    """
+    Tests for the KD-tree based dwell time detector
+    """
+
+    def reference_dwelltime(self, xy_data, max_disp, min_bound_frames,
+                            frame_rate):
+        # the original N x N distance matrix implementation
+        from scipy.spatial.distance import pdist, squareform
+        all_displacements = squareform(pdist(np.array(xy_data, dtype=float)))
+        dwell_times = []
+        curr_row = 0
+        while curr_row < len(xy_data):
+            n_bound = np.sum(all_displacements[:, curr_row] < max_disp)
+            if n_bound > min_bound_frames:
+                dwell_times.append(frame_rate * n_bound)
+                curr_row = curr_row + n_bound
+            else:
+                curr_row = curr_row + 1
+        return dwell_times or None
+
+    def test_calc_dwelltime_events(self):
+        # a single binding event spanning the whole track
+        some_xy = [['170.202', '22.481'],
+                   ['169.726', '22.459'],
+                   ['169.192', '22.727'],
+                   ['165.640', '22.686']]
+        self.assertEqual(utils.calc_dwelltime(some_xy, 200, 2, 0.1),
+                         [4*0.1])
+
+        # can we handle tracks with multiple binding events?
+        some_xy = [[3, 3], [3, 4], [3, 5], [4, 6], [5, 4], [100, 100],
+                   [200, 200], [250, 250], [251, 251], [251, 252],
+                   [251, 253], [300, 300], [350, 350]]
+        self.assertEqual(utils.calc_dwelltime(some_xy, 5, 2, 0.1),
+                         [5*0.1, 4*0.1])
+
+        # can we handle no binding events?
+        some_xy = [[3, 3], [3, 40], [3, 80], [4, 120], [5, 160]]
+        self.assertEqual(utils.calc_dwelltime(some_xy, 5, 2, 0.1), None)
+
+    def test_calc_dwelltime_strict_threshold(self):
+        # positions exactly max_disp away are not bound
+        some_xy = [[0, 0], [3, 4], [0, 5], [5, 0]]
+        self.assertEqual(utils.calc_dwelltime(some_xy, 5, 0, 0.1),
+                         [1*0.1, 3*0.1])
+
+    def test_calc_dwelltime_matches_distance_matrix(self):
+        # same output as the N x N implementation on real trajectories
+        table = utils.TrajectoryTable.from_csv('sample_traj.csv')
+        for max_disp, min_bound_frames in [(200, 10), (5, 3), (1, 2)]:
+            for traj_ID in table.traj_ids[::50]:
+                xy_data = table.xy(traj_ID)
+                self.assertEqual(
+                    utils.calc_dwelltime(xy_data, max_disp,
+                                         min_bound_frames, 0.1),
+                    self.reference_dwelltime(xy_data, max_disp,
+                                             min_bound_frames, 0.1))
+
+    def test_calc_dwelltime_sample_output(self):
+        # regression against the shipped sample dwell time output
+        all_dwell_times = utils.calc_all_dwelltimes('sample_traj.csv',
+                                                    1, [3, 4], 200, 10, 0.1)
+        expected = []
+        with open('sample_outputs/sample_traj_dwell_times.csv') as f:
+            next(f)
+            for line in f:
+                ID, dwell = line.rstrip().split(',')
+                expected.append([int(ID), float(dwell) if dwell else None])
+        self.assertEqual(all_dwell_times, expected)
+
+
+class TestUtils_map_trajectory_shards(unittest.TestCase):
+    """ Testing process-pool execution of per-trajectory analyses
+
+    """
+
+    def setUp(self):
+        self.table = utils.TrajectoryTable.from_csv('sample_traj.csv')
+
+    def test_trajectory_shards(self):
+        # shards hold whole trajectories, in order, as compact arrays
+        shards = utils._trajectory_shards(self.table, [3, 4], 8)
+        self.assertEqual(len(shards), 8)
+        traj_ids = np.concatenate([ids for ids, offsets, xy in shards])
+        np.testing.assert_array_equal(traj_ids, self.table.traj_ids)
+        for ids, offsets, xy in shards:
+            self.assertEqual(len(offsets), len(ids) + 1)
+            self.assertEqual(offsets[-1], len(xy))
+            self.assertEqual(xy.shape[1], 2)
+
+    def test_parallel_diffusion(self):
+        # same results, in the same order, as the serial run
+        _, serial = utils.calc_diffusion(self.table, 1, [3, 4])
+        _, parallel = utils.calc_diffusion(self.table, 1, [3, 4],
+                                           workers=2)
+        self.assertEqual(serial, parallel)
+
+    def test_parallel_dwelltime(self):
+        # same results, in the same order, as the serial run
+        serial = utils.calc_all_dwelltimes(self.table, 1, [3, 4], 2, 5, 0.1)
+        parallel = utils.calc_all_dwelltimes(self.table, 1, [3, 4], 2, 5,
+                                             0.1, workers=2)
+        self.assertEqual(serial, parallel)
+
+
+def make_synthetic_stack(file_name, n_frames=5, size=64, seed=0):
+    # write a small 16bit tif stack with a few bright spots per frame
+    rng = np.random.default_rng(seed)
+    frames = rng.integers(0, 20, (n_frames, size, size)).astype(np.uint16)
+    for frame in frames:
+        for x, y in rng.integers(8, size - 8, (3, 2)):
+            frame[y-2:y+3, x-2:x+3] = 3000
+    tifffile.imwrite(file_name, frames)
+    return frames
+
+
+class TestUtils_streaming_images(unittest.TestCase):
+    '''
+    Tests for the frame-by-frame image pipeline
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.stack = os.path.join(self.tmp_dir.name, 'stack.tif')
+        self.frames = make_synthetic_stack(self.stack)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def out(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def test_iter_tif(self):
+        # frames come out one at a time, identical to read_tif
+        frames = utils.iter_tif(self.stack)
+        self.assertFalse(isinstance(frames, (list, np.ndarray)))
+        np.testing.assert_array_equal(np.array(list(frames)), self.frames)
+        np.testing.assert_array_equal(utils.read_tif(self.stack),
+                                      self.frames)
+
+    def test_memmap_tif(self):
+        # contiguous stacks are memory-mapped, frames are zero-copy views
+        frames = utils.read_tif(self.stack, mmap=True)
+        self.assertIsInstance(frames, np.memmap)
+        np.testing.assert_array_equal(frames, self.frames)
+        self.assertTrue(np.shares_memory(frames[3], frames))
+
+        # read-only frames can still be annotated
+        features = utils.extract_features(frames,
+                                          out_name=self.out('features.tif'))
+        self.assertEqual(features, utils.extract_features(
+            self.frames.copy(), out_name=self.out('features_copy.tif')))
+
+    def test_memmap_tif_compressed(self):
+        # compressed stacks fall back to lazily decoded frames
+        compressed = self.out('compressed.tif')
+        tifffile.imwrite(compressed, self.frames, compression='zlib')
+        with utils.memmap_tif(compressed) as frames:
+            self.assertIsInstance(frames, utils.TifFrames)
+            self.assertEqual(len(frames), 5)
+            np.testing.assert_array_equal(frames[-1], self.frames[4])
+            np.testing.assert_array_equal(frames[2], self.frames[2])
+            np.testing.assert_array_equal(np.array(list(frames)),
+                                          self.frames)
+            with self.assertRaises(IndexError):
+                frames[5]
+
+    def test_process_image_streaming(self):
+        # streamed output matches filtering every frame up front
+        expected = [utils._filter_frame(f, 2) for f in self.frames]
+        results = utils.process_image(self.stack, blurIter=2,
+                                      out_name=self.out('processed.tif'))
+        np.testing.assert_array_equal(np.array(results), expected)
+        n_frames = utils.process_image(self.stack, blurIter=2,
+                                       out_name=self.out('streamed.tif'),
+                                       keep_frames=False)
+        self.assertEqual(n_frames, 5)
+        np.testing.assert_array_equal(
+            utils.read_tif(self.out('streamed.tif')), expected)
+
+    def test_process_image_parallel(self):
+        # threaded filtering writes the same frames, in order
+        serial = utils.process_image(self.stack, blurIter=2,
+                                     out_name=self.out('serial.tif'))
+        parallel = utils.process_image(self.stack, blurIter=2,
+                                       out_name=self.out('parallel.tif'),
+                                       workers=3)
+        np.testing.assert_array_equal(np.array(serial), np.array(parallel))
+        np.testing.assert_array_equal(
+            utils.read_tif(self.out('parallel.tif')), np.array(serial))
+
+    def test_extract_features_parallel(self):
+        # threaded detection gives an identical feature table
+        frames = np.array([utils._filter_frame(f, 2) for f in self.frames])
+        serial = utils.extract_features(frames.copy(),
+                                        out_name=self.out('serial.tif'))
+        parallel = utils.extract_features(frames.copy(),
+                                          out_name=self.out('parallel.tif'),
+                                          workers=3)
+        self.assertEqual(serial, parallel)
+        np.testing.assert_array_equal(utils.read_tif(self.out('serial.tif')),
+                                      utils.read_tif(self.out('parallel.tif')))
+
+    def test_write_tif(self):
+        # frames from a generator end up in one contiguous stack
+        out_name = self.out('written.tif')
+        last, n_frames, seconds = utils.write_tif(iter(self.frames),
+                                                  out_name)
+        self.assertEqual(n_frames, 5)
+        np.testing.assert_array_equal(last, self.frames[-1])
+        np.testing.assert_array_equal(utils.read_tif(out_name), self.frames)
+        self.assertIsInstance(utils.memmap_tif(out_name), np.memmap)
+
+        # BigTIFF output reads back the same
+        utils.write_tif(iter(self.frames), out_name, bigtiff=True)
+        with tifffile.TiffFile(out_name) as tif:
+            self.assertTrue(tif.is_bigtiff)
+        np.testing.assert_array_equal(utils.read_tif(out_name, mmap=True),
+                                      self.frames)
+
+    def test_convert_ND2_missingfile(self):
+        # check for missing file, throw an error
+        with self.assertRaises(SystemExit) as ex:
+            utils.convert_ND2(self.out('crapFile.nd2'),
+                              self.out('crapFile.tif'), [0])
+        self.assertEqual(ex.exception.code, 1)
+
+    def test_needs_bigtiff(self):
+        # BigTIFF is only switched on close to the 4 GB limit
+        self.assertFalse(utils._needs_bigtiff(2048 * 2048 * 2 * 500))
+        self.assertTrue(utils._needs_bigtiff(2048 * 2048 * 2 * 1000))
+
+    def test_process_and_extract_features(self):
+        # the fused pipeline matches processing, re-reading and extracting
+        utils.process_image(self.stack, blurIter=2,
+                            out_name=self.out('processed.tif'),
+                            keep_frames=False)
+        expected = utils.extract_features(
+            utils.read_tif(self.out('processed.tif')),
+            out_name=self.out('features.tif'))
+
+        fused = utils.process_and_extract_features(
+            self.stack, blurIter=2, out_name=self.out('fused.tif'))
+        self.assertEqual(fused, expected)
+        self.assertFalse(os.path.exists(self.out('fused_processed.tif')))
+
+        # optional side output of the processed (not annotated) stack
+        fused = utils.process_and_extract_features(
+            self.stack, blurIter=2,
+            processed_name=self.out('fused_processed.tif'),
+            out_name=self.out('fused.tif'), workers=2)
+        self.assertEqual(fused, expected)
+        np.testing.assert_array_equal(
+            utils.read_tif(self.out('fused_processed.tif')),
+            utils.read_tif(self.out('processed.tif')))
+
+    def test_process_image_missingfile(self):
+        # check for missing file, throw an error
+        with self.assertRaises(SystemExit) as ex:
+            utils.process_image(self.out('crapFile.tif'),
+                                out_name=self.out('processed.tif'))
+        self.assertEqual(ex.exception.code, 1)
+
+    def test_extract_features_generator(self):
+        # a generator pipeline gives the same features as a list of frames
+        from_list = utils.extract_features(
+            [utils._filter_frame(f, 2) for f in self.frames],
+            out_name=self.out('features_list.tif'))
+        from_stream = utils.extract_features(
+            utils.filter_frames(utils.iter_tif(self.stack), 2),
+            out_name=self.out('features_stream.tif'))
+        self.assertEqual(from_list, from_stream)
+        self.assertGreater(len(from_list), 1)
+        self.assertEqual(len(utils.read_tif(self.out('features_stream.tif'))),
+                         5)
+
+
+class TestUtils_batch_process(unittest.TestCase):
+    '''
+    Tests for finding and scheduling movies in batch mode
+    '''
+    def test_find_movies(self):
+        # ND2/TIF movies are found; derived stacks and converted ND2s not
+        import batch_process
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            names = ['a.nd2', 'a.tif', 'b.tif', 'b_processed.tif',
+                     'b_features.tif', 'c.TIF', 'notes.txt']
+            for name in names:
+                open(os.path.join(tmp_dir, name), 'w').close()
+            expected = [os.path.join(tmp_dir, name)
+                        for name in ['a.nd2', 'b.tif', 'c.TIF']]
+            self.assertEqual(batch_process.find_movies(tmp_dir), expected)
+            self.assertEqual(
+                batch_process.find_movies(os.path.join(tmp_dir, '*.nd2')),
+                expected[:1])
+
+    def test_run_batch_reports_failures(self):
+        # a broken movie is reported without stopping the batch
+        import batch_process
+        params = {'blurIter': 2, 'config': 'config_test.json',
+                  'deltaT': 0.1, 'max_disp': 200, 'min_bound_frames': 10,
+                  'pixel_size': 160}
+        summaries = batch_process.run_batch(['crapFile.tif'], params, 1, 1)
+        self.assertEqual(summaries[0]['movie'], 'crapFile.tif')
+        self.assertEqual(summaries[0]['error'], 'SystemExit(1)')
+
+    def test_load_tracks_in_nm(self):
+        # btrack's pixel coordinates are scaled to nm; IDs and frames not
+        import batch_process
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tracks = os.path.join(tmp_dir, 'tracks.csv')
+            with open(tracks, 'w') as f:
+                f.write('ID t x y z\n1 0 1.5 2 0\n1 1 2.5 2 0\n')
+            table = batch_process.load_tracks(tracks, 160)
+        np.testing.assert_array_equal(table.data, [[1, 0, 240, 320, 0],
+                                                   [1, 1, 400, 320, 0]])
+
+
+class TestUtils_ArtifactCache(unittest.TestCase):
+    '''
+    Tests for the content-hash cache of pipeline artifacts
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = utils.ArtifactCache(self.path('cache'))
+        self.calls = 0
+        with open(self.path('in.csv'), 'w') as f:
+            f.write('t,x,y\n0,1,2\n')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def stage(self, text):
+        # a stage writing one output file and counting its runs
+        self.calls = self.calls + 1
+        with open(self.path('out.csv'), 'w') as f:
+            f.write(text)
+
+    def run_stage(self, params, text='result'):
+        return self.cache.run('stage', [self.path('in.csv')], params,
+                              [self.path('out.csv')], self.stage, text)
+
+    def test_cache_skips_unchanged_stage(self):
+        # the second run restores the output instead of recomputing it
+        self.assertFalse(self.run_stage({'max_disp': 200}))
+        os.remove(self.path('out.csv'))
+        self.assertTrue(self.run_stage({'max_disp': 200}, 'other'))
+        self.assertEqual(self.calls, 1)
+        with open(self.path('out.csv')) as f:
+            self.assertEqual(f.read(), 'result')
+
+    def test_cache_key_changes(self):
+        # new parameters or new input content re-run the stage
+        self.run_stage({'max_disp': 200})
+        self.assertFalse(self.run_stage({'max_disp': 100}))
+        with open(self.path('in.csv'), 'a') as f:
+            f.write('1,2,3\n')
+        self.assertFalse(self.run_stage({'max_disp': 200}))
+        self.assertEqual(self.calls, 3)
+
+    def test_cache_lru_eviction(self):
+        # the least recently used entry goes once the cache is too big
+        self.cache.max_bytes = 2 * len('result')
+        self.run_stage({'max_disp': 1})
+        self.run_stage({'max_disp': 2})
+        os.utime(os.path.join(self.cache.cache_dir,
+                              self.cache.key('stage', [self.path('in.csv')],
+                                             {'max_disp': 1})), (0, 0))
+        self.run_stage({'max_disp': 3})
+        entries = [name for name in os.listdir(self.cache.cache_dir)
+                   if name.startswith('stage-')]
+        self.assertEqual(len(entries), 2)
+        self.assertFalse(self.run_stage({'max_disp': 1}))
+        self.assertTrue(self.run_stage({'max_disp': 3}))
+
+    def test_cache_restored_output_not_rehashed(self):
+        # a restored output keeps its mtime and its recorded digest
+        self.run_stage({'max_disp': 200})
+        mtime = os.stat(self.path('out.csv')).st_mtime_ns
+        digest = self.cache.file_hash(self.path('out.csv'))
+        os.remove(self.path('out.csv'))
+        self.assertTrue(self.run_stage({'max_disp': 200}))
+        self.assertEqual(os.stat(self.path('out.csv')).st_mtime_ns, mtime)
+        with unittest.mock.patch.object(utils.hashlib, 'sha256',
+                                        wraps=utils.hashlib.sha256) as sha:
+            self.assertEqual(self.cache.file_hash(self.path('out.csv')),
+                             digest)
+        # only the memo's file name is hashed, not the content
+        self.assertEqual(sha.call_count, 1)
+
+    def test_cache_missing_output_not_stored(self):
+        # a stage that writes no output (e.g. no tracks) is not cached
+        def no_output():
+            self.calls = self.calls + 1
+        for i in range(2):
+            self.assertFalse(self.cache.run('stage', [self.path('in.csv')],
+                                            {}, [self.path('out.csv')],
+                                            no_output))
+        self.assertEqual(self.calls, 2)
+        self.assertFalse(os.path.exists(self.path('out.csv')))
+
+
+class TestUtils_incremental(unittest.TestCase):
+    '''
+    Tests for incremental re-analysis of a growing trajectory file
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_in = os.path.join(self.tmp_dir.name, 'traj.csv')
+        self.file_out = os.path.join(self.tmp_dir.name, 'traj_D.csv')
+        self.state = os.path.join(self.tmp_dir.name, 'traj_D.state.npz')
+        with open('sample_traj_crop.csv', 'r') as f:
+            # only newline-terminated rows count as complete
+            self.lines = [line.rstrip('\n') + '\n' for line in f]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, text, mode='w'):
+        with open(self.file_in, mode) as f:
+            f.write(text)
+
+    def diffusion(self, table):
+        return utils.calc_diffusion(table, 1, [3, 4])[1]
+
+    def test_load_updates_appended_rows(self):
+        # a partial last line waits for the next update
+        self.write(''.join(self.lines[:20]) + self.lines[20][:5])
+        table, changed, fresh = utils.load_trajectory_updates(self.file_in,
+                                                              self.state)
+        self.assertTrue(fresh)
+        self.assertEqual(len(table), 19)
+
+        self.write(self.lines[20][5:] + ''.join(self.lines[21:]), 'a')
+        table, changed, fresh = utils.load_trajectory_updates(self.file_in,
+                                                              self.state)
+        full = utils.TrajectoryTable.from_csv('sample_traj_crop.csv')
+        self.assertFalse(fresh)
+        np.testing.assert_array_equal(table.data, full.data)
+        new_IDs = {int(line.split(',')[1]) for line in self.lines[20:]}
+        self.assertEqual(set(changed), new_IDs)
+
+    def test_load_updates_rewritten_file(self):
+        # a file that was replaced rather than appended to is re-read
+        self.write(''.join(self.lines))
+        utils.load_trajectory_updates(self.file_in, self.state)
+        self.write(''.join(self.lines[:10]))
+        table, changed, fresh = utils.load_trajectory_updates(self.file_in,
+                                                              self.state)
+        self.assertTrue(fresh)
+        self.assertEqual(len(table), 9)
+
+    def test_update_traj_results_matches_full_run(self):
+        self.write(''.join(self.lines[:20]))
+        rows = utils.update_traj_results(self.file_in, self.file_out, 1,
+                                         self.diffusion)
+        utils.write_csv([['Trajectory_ID', 'D']] + rows, self.file_out)
+
+        self.write(''.join(self.lines[20:]), 'a')
+        rows = utils.update_traj_results(self.file_in, self.file_out, 1,
+                                         self.diffusion)
+        expected = self.diffusion('sample_traj_crop.csv')
+        self.assertEqual([row[0] for row in rows],
+                         [row[0] for row in expected])
+        np.testing.assert_allclose([row[1] for row in rows],
+                                   [row[1] for row in expected])
+
+    def test_update_traj_results_parameter_change(self):
+        # results made with other parameters are not merged into
+        self.write(''.join(self.lines[:20]))
+        rows = utils.update_traj_results(
+            self.file_in, self.file_out, 1, self.diffusion,
+            params={'delta_T': 0.1})
+        utils.write_csv([['Trajectory_ID', 'D']] + rows, self.file_out)
+
+        self.write(''.join(self.lines[20:]), 'a')
+
+        def diffusion(table):
+            return utils.calc_diffusion(table, 1, [3, 4], 'all', 0.2)[1]
+        rows = utils.update_traj_results(self.file_in, self.file_out, 1,
+                                         diffusion, params={'delta_T': 0.2})
+        expected = diffusion('sample_traj_crop.csv')
+        self.assertEqual([row[0] for row in rows],
+                         [row[0] for row in expected])
+        np.testing.assert_allclose([row[1] for row in rows],
+                                   [row[1] for row in expected])
+
+        # so are changes of the ID column or delimiter
+        table, changed, fresh = utils.load_trajectory_updates(
+            self.file_in, self.state, 1, params={'delta_T': 0.2})
+        self.assertFalse(fresh)
+        table, changed, fresh = utils.load_trajectory_updates(
+            self.file_in, self.state, 0, params={'delta_T': 0.2})
+        self.assertTrue(fresh)
+
+    def test_merge_traj_results(self):
+        merged = utils.merge_traj_results([[1, 0.5], [2, 0.25], [3, 1.0]],
+                                          [[2, 0.75], [4, 2.0]], [2, 4])
+        self.assertEqual(merged, [[1, 0.5], [2, 0.75], [3, 1.0], [4, 2.0]])
+
+
+class TestUtils_binary_tables(unittest.TestCase):
+    '''
+    Tests for the binary (.npy) table format and the CSV converters
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def test_trajectory_round_trip(self):
+        # CSV -> npy -> CSV keeps every value, and the npy is memory mapped
+        csv_table = utils.TrajectoryTable.from_csv('sample_traj_crop.csv')
+        utils.csv_to_npy('sample_traj_crop.csv', self.path('traj.npy'))
+        npy_table = utils.TrajectoryTable.from_npy(self.path('traj.npy'))
+        self.assertEqual(npy_table.columns, csv_table.columns)
+        np.testing.assert_array_equal(npy_table.data, csv_table.data)
+        base = npy_table.data
+        while base.base is not None and not isinstance(base, np.memmap):
+            base = base.base
+        self.assertIsInstance(base, np.memmap)
+
+        utils.npy_to_csv(self.path('traj.npy'), self.path('traj.csv'))
+        np.testing.assert_array_equal(
+            utils.TrajectoryTable.from_csv(self.path('traj.csv')).data,
+            csv_table.data)
+
+    def test_analysis_accepts_npy(self):
+        utils.csv_to_npy('sample_traj_crop.csv', self.path('traj.npy'))
+        self.assertEqual(
+            utils.calc_diffusion(self.path('traj.npy'), 1, [3, 4])[1],
+            utils.calc_diffusion('sample_traj_crop.csv', 1, [3, 4])[1])
+
+    def test_results_round_trip(self):
+        # missing results and multi-event lists survive the binary format
+        rows = [[1, None], [2.1, 0.5], [2.2, 1.5], [2, [0.5, 1.5]],
+                [3, 3.3000000000000003]]
+        header = ['Trajectory_ID', 'Dwell_Times (s)']
+        utils.write_results(rows, self.path('dwell.npy'), header)
+        self.assertEqual(utils.read_traj_results(self.path('dwell.npy')),
+                         (header, rows))
+
+        utils.write_results(rows, self.path('dwell.csv'), header)
+        utils.csv_to_npy(self.path('dwell.csv'), self.path('copy.npy'))
+        utils.npy_to_csv(self.path('copy.npy'), self.path('copy.csv'))
+        with open(self.path('dwell.csv')) as f1, \
+                open(self.path('copy.csv')) as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_multi_column_results(self):
+        # numeric rows of more than two columns are written as they are
+        rows = [[1, 0.5, 1.0], [2, np.nan, 0.75]]
+        header = ['Trajectory_ID', 'Diffusion_Coeff (um^2/s)', 'Alpha']
+        utils.write_results(rows, self.path('fits.npy'), header)
+        columns, data = utils.read_table(self.path('fits.npy'))
+        self.assertEqual(columns, header)
+        np.testing.assert_array_equal(data, rows)
+
+        utils.write_results(rows, self.path('fits.csv'), header)
+        with open(self.path('fits.csv')) as f:
+            self.assertEqual(f.read().splitlines(),
+                             [','.join(header), '1,0.5,1.0', '2,nan,0.75'])
+
+
+class TestUtils_streaming_trajectories(unittest.TestCase):
+    '''
+    Tests for reading trajectory files in chunks of whole trajectories
+    '''
+    def test_chunks_hold_complete_trajectories(self):
+        # a tiny chunk size splits every trajectory across chunks
+        full = utils.TrajectoryTable.from_csv('sample_traj_crop.csv')
+        tables = list(utils.iter_trajectory_chunks('sample_traj_crop.csv',
+                                                   chunk_rows=4))
+        self.assertEqual([traj for t in tables for traj in t.traj_ids],
+                         list(full.traj_ids))
+        for table in tables:
+            for traj in table.traj_ids:
+                np.testing.assert_array_equal(table.rows(traj),
+                                              full.rows(traj))
+        np.testing.assert_array_equal(
+            np.concatenate([t.data for t in tables]), full.data)
+
+    def test_stream_matches_full_analysis(self):
+        for chunk_rows in [1, 50, 100000]:
+            self.assertEqual(
+                list(utils.stream_diffusion('sample_traj.csv', 1, [3, 4],
+                                            chunk_rows=chunk_rows)),
+                utils.calc_diffusion('sample_traj.csv', 1, [3, 4])[1])
+        self.assertEqual(
+            list(utils.stream_dwelltimes('sample_traj.csv', 1, [3, 4], 200,
+                                         10, chunk_rows=500)),
+            utils.calc_all_dwelltimes('sample_traj.csv', 1, [3, 4], 200, 10))
+
+    def test_interleaved_trajectories(self):
+        # rows of a trajectory must be contiguous to be streamed
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_in = os.path.join(tmp_dir, 'traj.csv')
+            with open(file_in, 'w') as f:
+                f.write('i,Trajectory,x,y\n0,1,0,0\n1,2,0,0\n2,1,1,1\n')
+            with self.assertRaises(SystemExit):
+                list(utils.iter_trajectory_chunks(file_in, chunk_rows=2))
+
+
+class TestUtils_msd(unittest.TestCase):
+    '''
+    Tests for the multi-lag MSD curves and their fits
+    '''
+    def setUp(self):
+        self.table = utils.TrajectoryTable.from_csv('sample_traj_crop.csv')
+
+    def test_fft_msd_matches_lag_loop(self):
+        xy = self.table.data[:, 3:5] / 1000
+        msd, n_pairs = utils._msd_fft(xy, self.table.starts,
+                                      self.table.stops)
+        for start, stop in zip(self.table.starts, self.table.stops):
+            r = xy[start:stop]
+            N = len(r)
+            expected = [np.mean(np.sum((r[m:] - r[:N - m])**2, axis=1))
+                        for m in range(N)]
+            np.testing.assert_allclose(msd[start:stop], expected,
+                                       rtol=1e-6, atol=1e-12)
+            np.testing.assert_array_equal(n_pairs[start:stop],
+                                          np.arange(N, 0, -1))
+
+    def test_msd_curves(self):
+        curves = utils.calc_msd(self.table, 1, [3, 4], deltaT=0.1)
+        self.assertEqual(len(curves), len(self.table) -
+                         len(self.table.traj_ids))
+        self.assertEqual(curves[0][:2], [1, 0.1])
+
+    def test_fit_brownian_motion(self):
+        # free diffusion with D = 0.5 um^2/s gives alpha close to 1
+        rng = np.random.default_rng(0)
+        steps = rng.normal(0, np.sqrt(2 * 0.5 * 0.1), (100, 200, 2))
+        data = np.zeros((100 * 200, 5))
+        data[:, 1] = np.repeat(np.arange(100), 200)
+        data[:, 3:5] = 1000 * np.cumsum(steps, axis=1).reshape(-1, 2)
+        table = utils.TrajectoryTable(['', 'Trajectory', 'Frame', 'x', 'y'],
+                                      data)
+        fits = np.array(utils.fit_msd(table, 1, [3, 4], 0.1, 4))
+        self.assertAlmostEqual(np.median(fits[:, 1]), 0.5, delta=0.05)
+        self.assertAlmostEqual(np.median(fits[:, 2]), 1, delta=0.1)
+
+
+class TestUtils_EnsembleStats(unittest.TestCase):
+    '''
+    Tests for the ensemble MSD and jump distance accumulators
+    '''
+    def make_table(self, D, n_steps=30, deltaT=0.1, seed=0):
+        # one free-diffusing trajectory per entry of D (um^2/s), in nm
+        rng = np.random.default_rng(seed)
+        steps = rng.normal(0, 1, (len(D), n_steps, 2)) * \
+            np.sqrt(2 * np.asarray(D) * deltaT)[:, None, None]
+        data = np.zeros((len(D) * n_steps, 5))
+        data[:, 1] = np.repeat(np.arange(len(D)), n_steps)
+        data[:, 3:5] = 1000 * np.cumsum(steps, axis=1).reshape(-1, 2)
+        return utils.TrajectoryTable(['', 'Trajectory', 'Frame', 'x', 'y'],
+                                     data)
+
+    def test_ensemble_msd_matches_direct_average(self):
+        table = utils.TrajectoryTable.from_csv('sample_traj_crop.csv')
+        stats = utils.ensemble_stats(table, 1, [3, 4], max_lag=3)
+        lags, msd, counts = stats.msd()
+        for lag in range(1, 4):
+            sq = [np.sum((xy[lag:] - xy[:-lag])**2, axis=1) for xy in
+                  (table.xy(traj) / 1000 for traj in table.traj_ids)]
+            sq = np.concatenate(sq)
+            self.assertEqual(counts[lag - 1], len(sq))
+            self.assertAlmostEqual(msd[lag - 1], sq.mean())
+
+    def test_merged_chunks_match_single_pass(self):
+        stats = utils.ensemble_stats('sample_traj.csv', 1, [3, 4])
+        chunked = utils.ensemble_stats('sample_traj.csv', 1, [3, 4],
+                                       chunk_rows=1000, workers=2)
+        self.assertEqual(chunked.n_trajectories, 5778)
+        np.testing.assert_array_equal(chunked.msd_count, stats.msd_count)
+        np.testing.assert_array_equal(chunked.jump_counts,
+                                      stats.jump_counts)
+        np.testing.assert_allclose(chunked.msd_sum, stats.msd_sum)
+
+    def test_two_population_fit(self):
+        D = np.where(np.arange(2000) % 10 < 3, 0.05, 1.0)
+        stats = utils.EnsembleStats(jump_edges=np.linspace(0, 3, 601))
+        stats.add_table(self.make_table(D))
+        D_fit, fractions = stats.fit_jump_distances(2)
+        np.testing.assert_allclose(D_fit, [0.05, 1.0], rtol=0.1)
+        np.testing.assert_allclose(fractions, [0.3, 0.7], atol=0.03)
+
+    def test_merge_incompatible(self):
+        with self.assertRaises(ValueError):
+            utils.EnsembleStats(max_lag=5).merge(utils.EnsembleStats())
+
+
+class TestUtils_bootstrap(unittest.TestCase):
+    '''
+    Tests for the vectorized bootstrap confidence intervals
+    '''
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.dwell_times = 1 + rng.exponential(2, 5000)  # k_off = 0.5
+
+    def test_estimates_and_intervals(self):
+        for statistic, expected in [('mean', 3), ('median', 1 + 2 * np.log(2)),
+                                    ('k_off', 0.5)]:
+            estimate, low, high = utils.bootstrap_ci(
+                self.dwell_times, statistic, 500, t_min=1)
+            self.assertLess(low, estimate)
+            self.assertLess(estimate, high)
+            self.assertLess(low, expected)
+            self.assertLess(expected, high)
+        self.assertEqual(
+            utils.bootstrap_ci(self.dwell_times, 'median', 10)[0],
+            np.median(self.dwell_times))
+
+    def test_seeded_determinism(self):
+        # the same seed gives the same interval on any number of workers
+        single = utils.bootstrap_ci(self.dwell_times, 'mean', 200, seed=3,
+                                    batch_size=50)
+        pooled = utils.bootstrap_ci(self.dwell_times, 'mean', 200, seed=3,
+                                    batch_size=50, workers=2)
+        self.assertEqual(single, pooled)
+        self.assertNotEqual(single, utils.bootstrap_ci(
+            self.dwell_times, 'mean', 200, seed=4, batch_size=50))
+
+    def test_k_off_recovered_from_detected_dwells(self):
+        # exponential dwells, seen in whole frames: each event stays at
+        # its own spot for a geometric number of frames
+        k_off, frame_rate, min_bound_frames = 2, 0.1, 3
+        rng = np.random.default_rng(1)
+        n_frames = rng.geometric(1 - np.exp(-k_off * frame_rate), 4000)
+        xy = np.repeat(np.arange(len(n_frames)) * 1000., n_frames)
+        xy = np.column_stack([xy, np.zeros(len(xy))])
+        dwell_times = utils.calc_dwelltime(xy, 200, min_bound_frames,
+                                           frame_rate)
+        self.assertEqual(len(dwell_times),
+                         np.count_nonzero(n_frames > min_bound_frames))
+
+        # the shortest dwell the detector reports is min_bound_frames + 1
+        t_min = (min_bound_frames + 1) * frame_rate
+        self.assertAlmostEqual(min(dwell_times), t_min)
+        estimate, low, high = utils.bootstrap_ci(
+            dwell_times, 'k_off', 500, t_min=t_min, frame_rate=frame_rate)
+        self.assertLess(low, k_off)
+        self.assertLess(k_off, high)
+        self.assertAlmostEqual(estimate, k_off, delta=0.1)
+
+        # truncating at min_bound_frames biases k_off low
+        estimate, low, high = utils.bootstrap_ci(
+            dwell_times, 'k_off', 500, t_min=t_min - frame_rate,
+            frame_rate=frame_rate)
+        self.assertLess(high, k_off)
+
+    def test_result_values(self):
+        rows = [[1, None], [2.1, 0.5], [2.2, 1.5], [2, [0.5, 1.5]], [3, 2.0]]
+        np.testing.assert_array_equal(utils.result_values(rows),
+                                      [0.5, 1.5, 2.0])
+
+
+class TestUtils_benchmark(unittest.TestCase):
+    '''
+    Tests for the benchmark suite's data generators and regression check
+    '''
+    def test_make_trajectories(self):
+        import benchmark
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_name = os.path.join(tmp_dir, 'traj.csv')
+            benchmark.make_trajectories(file_name, 1000, traj_length=40,
+                                        chunk_rows=120)
+            table = utils.TrajectoryTable.from_csv(file_name)
+        self.assertEqual(len(table), 1000)
+        self.assertEqual(len(table.traj_ids), 25)
+        np.testing.assert_array_equal(table.frame[:41],
+                                      list(range(40)) + [0])
+        # trajectories start anywhere but only take small steps
+        steps = np.diff(table.xy(3), axis=0)
+        self.assertLess(np.abs(steps).max(), 1000)
+
+    def test_find_regressions(self):
+        import benchmark
+        old = {'stage': 'calc_diffusion', 'input': 'traj_1000.csv',
+               'params': {'rows': 1000}, 'seconds': 1.0}
+        history = [{'results': [dict(old, seconds=0.1)]},
+                   {'results': [old]}]
+        faster = dict(old, seconds=1.1)
+        slower = dict(old, seconds=1.5)
+        self.assertEqual(benchmark.find_regressions([faster], history, 0.2),
+                         [])
+        self.assertEqual(benchmark.find_regressions([slower], history, 0.2),
+                         [(slower, 1.0)])
+
+
+class TestUtils_Profiler(unittest.TestCase):
+    '''
+    Tests for the per-stage timers and counters
+    '''
+    def setUp(self):
+        self.profiler = utils.PROFILER
+        self.profiler.reset()
+
+    def tearDown(self):
+        self.profiler.enabled = False
+        self.profiler.reset()
+
+    def test_disabled(self):
+        xy = np.zeros((20, 2))
+        utils.calc_dwelltime(xy, 200, 10)
+        self.assertEqual(self.profiler.stages, {})
+
+    def test_stages_and_counters(self):
+        self.profiler.enable()
+        traj = utils.TrajectoryTable.from_csv('sample_traj_crop.csv')
+        utils.calc_all_dwelltimes(traj, 1, [3, 4], 200, 10)
+        stages = self.profiler.stages
+        self.assertEqual(stages['TrajectoryTable.from_csv']['calls'], 1)
+        self.assertEqual(
+            stages['TrajectoryTable.from_csv']['counters']['rows'],
+            len(traj))
+        record = stages['calc_all_dwelltimes']
+        self.assertEqual(record['counters']['trajectories'],
+                         len(traj.traj_ids))
+        # calc_dwelltime runs once per trajectory, nested in the analysis
+        self.assertEqual(stages['calc_dwelltime']['calls'],
+                         len(traj.traj_ids))
+        self.assertLessEqual(stages['calc_dwelltime']['seconds'],
+                             record['seconds'])
+        self.assertGreater(record['peak_rss_mb'], 0)
+
+    def test_nested_and_generator_stages(self):
+        @utils.profiled('outer')
+        def outer(depth):
+            if depth > 0:
+                outer(depth - 1)
+            utils.PROFILER.count('items')
+
+        @utils.profiled('stream')
+        def stream():
+            for i in range(3):
+                utils.PROFILER.count('items')
+                yield i
+
+        self.profiler.enable()
+        outer(2)
+        self.assertEqual(list(stream()), [0, 1, 2])
+        stages = self.profiler.stages
+        self.assertEqual(stages['outer']['calls'], 3)
+        self.assertEqual(stages['outer']['counters'], {'items': 3})
+        # a generator is one call, however many items it yields
+        self.assertEqual(stages['stream']['calls'], 1)
+        self.assertEqual(stages['stream']['counters'], {'items': 3})
+
+    def test_merge_and_report(self):
+        record = {'calls': 2, 'seconds': 1.0, 'peak_rss_mb': 10.0,
+                  'counters': {'rows': 100}}
+        self.profiler.merge({'a': record, 'b': dict(record, seconds=3.0)})
+        self.profiler.merge({'a': record})
+        report = self.profiler.report()
+        self.assertEqual(list(report), ['b', 'a'])
+        self.assertEqual(report['a']['calls'], 4)
+        self.assertEqual(report['a']['rates'], {'rows/s': 100.0})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_name = os.path.join(tmp_dir, 'profile.json')
+            self.profiler.write_report(file_name)
+            with open(file_name) as f:
+                self.assertEqual(json.load(f), report)
+
+
+class TestUtils_sweep_dwelltimes(unittest.TestCase):
+    '''
+    Tests for the dwell time threshold sweep
+    '''
+    def test_matches_calc_dwelltime(self):
+        # integer positions put some distances exactly on the threshold
+        rng = np.random.default_rng(0)
+        xy = np.cumsum(rng.integers(-3, 4, size=(300, 2)), axis=0)
+        max_disps = [0, 3, 5, 10]
+        min_bound_frames = [2, 5, 10]
+        bound = utils._dwelltime_sweep_shard(
+            (np.array([7]), np.array([0, len(xy)]), xy), max_disps,
+            min_bound_frames)
+        for k, traj_ID, events in bound:
+            max_disp = max_disps[k // len(min_bound_frames)]
+            min_frames = min_bound_frames[k % len(min_bound_frames)]
+            expected = utils.calc_dwelltime(xy, max_disp, min_frames, 1)
+            if max_disp <= 0:
+                self.assertIsNone(expected)
+            self.assertEqual(traj_ID, 7)
+            self.assertEqual(events, expected or [])
+
+    def test_long_stationary_trajectory(self):
+        # a particle bound for the whole movie is queried once per scan,
+        # not once per position
+        n_frames = 20000
+        xy = np.random.default_rng(0).normal(0, 5, (n_frames, 2))
+        queries = []
+
+        class CountingTree(utils.cKDTree):
+            def query_ball_point(self, *args, **kwargs):
+                queries.append(args[0])
+                return super().query_ball_point(*args, **kwargs)
+
+        with unittest.mock.patch.object(utils, 'cKDTree', CountingTree):
+            bound = utils._dwelltime_sweep_shard(
+                (np.array([1]), np.array([0, n_frames]), xy), [100, 200],
+                [3, 10])
+        self.assertEqual([events for _, _, events in bound],
+                         [[n_frames]] * 4)
+        # the min_bound_frames scans share the counts of each max_disp
+        self.assertEqual(len(queries), 2)
+
+    def test_matches_calc_all_dwelltimes(self):
+        traj = utils.TrajectoryTable.from_csv('sample_traj_crop.csv')
+        events, summary = utils.sweep_dwelltimes(traj, 1, [3, 4],
+                                                 [100, 300], [3, 10],
+                                                 [0.1, 0.05])
+        self.assertEqual([row[:3] for row in summary],
+                         [[m, b, f] for m in [100, 300] for b in [3, 10]
+                          for f in [0.1, 0.05]])
+        for max_disp, min_frames, frame_rate, bound, n, mean, _ in summary:
+            rows = utils.calc_all_dwelltimes(traj, 1, [3, 4], max_disp,
+                                             min_frames, frame_rate)
+            expected = utils.result_values(rows)
+            swept = [row[5] for row in events
+                     if row[:3] == [max_disp, min_frames, frame_rate]]
+            self.assertEqual(sorted(swept), sorted(expected))
+            self.assertEqual(n, len(expected))
+            n_bound = sum(1 for ID, dwell in rows
+                          if dwell is not None and ID == int(ID))
+            self.assertAlmostEqual(bound, n_bound / len(traj.traj_ids))
+
+
+class TestUtils_live_analysis(unittest.TestCase):
+    '''
+    Tests for the live analysis of a growing trajectory file
+    '''
+    def setUp(self):
+        self.table = utils.TrajectoryTable.from_csv('sample_traj_crop.csv')
+        _, self.diffusion = utils.calc_diffusion(self.table, 1, [3, 4],
+                                                 'all', 0.1)
+        self.dwell_times = utils.calc_all_dwelltimes(self.table, 1, [3, 4],
+                                                     200, 3, 0.1)
+
+    def assert_matches(self, stats):
+        np.testing.assert_allclose(np.array(stats.diffusion(), dtype=float),
+                                   np.array(self.diffusion, dtype=float),
+                                   rtol=1e-12)
+        self.assertEqual(stats.dwelltimes(), self.dwell_times)
+
+    def test_batches(self):
+        data = np.loadtxt('sample_traj_crop.csv', delimiter=',', skiprows=1)
+        stats = utils.LiveTrajectoryStats(0.1, 200, 3)
+        for batch in np.array_split(data, [1, 7, 20, 21, 40]):
+            stats.add_rows(batch)
+        self.assert_matches(stats)
+        summary = stats.summary(bins=5)
+        self.assertEqual(summary['rows'], len(data))
+        self.assertEqual(summary['trajectories'], len(self.table.traj_ids))
+        self.assertEqual(sum(summary['dwell_time']['counts']),
+                         summary['binding_events'])
+
+    def test_watch_growing_file(self):
+        with open('sample_traj_crop.csv', 'rb') as f:
+            content = f.read() + b'\n'
+
+        async def run(file_name):
+            published = []
+
+            async def write():
+                # appends end in the middle of lines
+                with open(file_name, 'wb') as f:
+                    for start in range(0, len(content), 97):
+                        f.write(content[start:start + 97])
+                        f.flush()
+                        await asyncio.sleep(0.01)
+
+            stats = utils.LiveTrajectoryStats(0.1, 200, 3)
+            writer = asyncio.ensure_future(write())
+            await utils.watch_trajectories(
+                file_name, stats, lambda s: published.append(s.n_rows),
+                interval=0, poll_interval=0.005, idle_timeout=0.5)
+            await writer
+            return stats, published
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stats, published = asyncio.run(run(os.path.join(tmp_dir,
+                                                            'traj.csv')))
+        self.assert_matches(stats)
+        self.assertGreater(len(published), 2)
+        self.assertEqual(published[-1], len(self.table))
+
+
+class TestUtils_windowed_tracking(unittest.TestCase):
+    '''
+    Tests for tracking long movies in overlapping windows and wide fields
+    of view in overlapping tiles
+    '''
+    def test_infer_volume(self):
+        columns = ['t', 'x', 'y', 'z']
+        data = np.array([[0, 20.5, 13.2, 0], [1, 381.7, 377, 0]])
+        self.assertEqual(utils._infer_volume(columns, data),
+                         ((20, 382), (13, 377), (0, 1)))
+        self.assertEqual(utils._infer_volume(columns[:3], data[:, :3]),
+                         ((20, 382), (13, 377), (0, 1)))
+
+    def test_regions_cover_every_feature_once(self):
+        rng = np.random.default_rng(0)
+        data = np.column_stack([rng.integers(0, 50, 2000),
+                                rng.uniform(0, 400, (2000, 2)),
+                                np.zeros(2000)])
+        columns = ['t', 'x', 'y', 'z']
+        volume = utils._infer_volume(columns, data)
+        regions = utils._tracking_regions(columns, data, volume, window=15,
+                                          overlap=4, tiles=(3, 2),
+                                          tile_overlap=20)
+        in_core = np.zeros(len(data), dtype=int)
+        for rows, _, core in regions:
+            inside = np.ones(len(data), dtype=bool)
+            for column, (low, high) in zip([0, 1, 2], core):
+                inside &= (data[:, column] >= low) & (data[:, column] < high)
+            # a region holds its core and the overlaps around it
+            self.assertTrue(set(np.flatnonzero(inside)) <= set(rows))
+            in_core += inside
+        np.testing.assert_array_equal(in_core, 1)
+
+    def make_nearby_features(self, file_name, n_frames=40, seed=1):
+        # a grid of particles 18 px apart drifting together; each frame
+        # lists them in a new order, so rows of one particle do not line up
+        # across windows
+        rng = np.random.default_rng(seed)
+        grid_x, grid_y = np.meshgrid(np.arange(6) * 18 + 20.,
+                                     np.arange(4) * 18 + 20.)
+        positions = np.column_stack([grid_x.ravel(), grid_y.ravel()])
+        rows = []
+        for t in range(n_frames):
+            positions = positions + [4, 1] + rng.normal(0, 0.5,
+                                                        positions.shape)
+            rows.extend([t, round(x, 2), round(y, 2), 0]
+                        for x, y in rng.permutation(positions))
+        utils.write_csv([['t', 'x', 'y', 'z']] + rows, file_name)
+
+    def partition(self, out):
+        # the (t, x, y) of the features of each track, without dummies
+        properties = utils.btrack.constants.DEFAULT_EXPORT_PROPERTIES
+        tracks = np.loadtxt(out, skiprows=1, ndmin=2)
+        tracks = tracks[tracks[:, properties.index('dummy')] == 0]
+        return {frozenset(map(tuple, tracks[tracks[:, 0] == ID, 1:4]))
+                for ID in np.unique(tracks[:, 0])}
+
+    def assert_match_whole_movie(self, features, n_features, options):
+        # regions keep every feature and find the tracks of one session,
+        # which may leave out features of the last frame
+        out = features[:-4] + '_tracks.csv'
+        utils.track_csv(features, out, 'config_test.json')
+        whole = self.partition(out)
+        in_whole = set().union(*whole)
+        self.assertEqual(len(in_whole) < n_features,
+                         utils._btrack_drops_objects('config_test.json'))
+        first = None
+        for kwargs in options:
+            utils.track_csv(features, out, 'config_test.json', **kwargs)
+            tracks = self.partition(out)
+            self.assertEqual(len(set().union(*tracks)), n_features)
+            self.assertEqual({track & in_whole for track in tracks}, whole)
+            # tracks are numbered the same whatever the regions
+            if first is None:
+                first = np.loadtxt(out, skiprows=1)
+            np.testing.assert_array_equal(np.loadtxt(out, skiprows=1),
+                                          first)
+
+    def test_windows_and_tiles_match_whole_movie(self):
+        import benchmark
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            features = os.path.join(tmp_dir, 'features.csv')
+            # a few well separated particles for 50 frames
+            benchmark.make_features(features, 50, 8)
+            self.assert_match_whole_movie(
+                features, 50 * 8,
+                [{'workers': 1},
+                 {'window': 15, 'overlap': 4},
+                 {'tiles': (3, 2), 'tile_overlap': 20, 'workers': 2},
+                 {'window': 20, 'tiles': (2, 2)}])
+
+    def test_whole_movie_is_one_btrack_session(self):
+        # without windows, tiles or workers, btrack's own export is written
+        import benchmark
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            features = os.path.join(tmp_dir, 'features.csv')
+            out = os.path.join(tmp_dir, 'tracks.csv')
+            benchmark.make_features(features, 20, 4)
+            with unittest.mock.patch.object(utils.btrack.dataio,
+                                            'export_CSV') as export_CSV, \
+                    unittest.mock.patch.object(utils, '_track_regions') \
+                    as track_regions:
+                utils.track_csv(features, out, 'config_test.json')
+            export_CSV.assert_called_once()
+            track_regions.assert_not_called()
+
+    def test_no_features(self):
+        # a movie without features still gets a (header only) tracks CSV
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            features = os.path.join(tmp_dir, 'features.csv')
+            out = os.path.join(tmp_dir, 'tracks.csv')
+            utils.write_csv([['t', 'x', 'y', 'z']], features)
+            for options in [{}, {'window': 10, 'overlap': 2,
+                                 'tiles': (2, 2)}]:
+                utils.track_csv(features, out, 'config_test.json',
+                                **options)
+                with open(out) as f:
+                    self.assertEqual(f.read().split(), list(
+                        utils.btrack.constants.DEFAULT_EXPORT_PROPERTIES))
+
+    def test_nearby_particles_match_whole_movie(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            features = os.path.join(tmp_dir, 'features.csv')
+            self.make_nearby_features(features)
+            self.assert_match_whole_movie(
+                features, 40 * 24,
+                [{'window': 15, 'overlap': 4},
+                 {'window': 10, 'overlap': 3, 'tiles': (2, 2),
+                  'tile_overlap': 20}])
+            self.assertEqual(len(self.partition(features[:-4] +
+                                                '_tracks.csv')), 24)
+
+
 class TestUtils_process_image(unittest.TestCase):
     '''
     Tests for the functionality of image processing
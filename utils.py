@@ -7,15 +7,48 @@ in the format of tif stacks. Conversion, extraction and analysis of raw data
 is enabled by computer vision, image processing, and data format libraries.
 
 Functions included:
+Profiler / PROFILER : Per-stage timers and counters, enabled with --profile
+peak_rss_mb()       : Peak resident memory of the process, in MB
 convert_ND2()       : Conversion of ND2 files to tif stacks
+write_tif()         : Streams frames into a tif stack with one open writer
 calc_diffusion()      : Calculates diffusion coefficient from extracted features
+calc_msd()          : Time-averaged MSD curves over all lags, computed via FFT
+fit_msd()           : Fits D and the anomalous exponent alpha to MSD curves
 calc_dwelltime()    : Calculate dwell times of extracted signal features
+calc_all_dwelltimes() : Calculate dwell times of every trajectory in a file
+sweep_dwelltimes()  : Dwell times over a grid of thresholds, in one pass
 get_xy_coords()     : Get xy_coords of extracted signal features
+TrajectoryTable     : Trajectory CSV loaded once into sorted, typed arrays
+load_trajectory_updates() : Parses only the rows appended to a trajectory CSV
+merge_traj_results()  : Merges re-analyzed trajectories into earlier results
+update_traj_results() : Re-analyzes only trajectories that grew since last run
+map_trajectory_shards() : Runs a per-trajectory analysis on a process pool
+iter_trajectory_chunks() : Reads trajectory files in chunks of whole tracks
+stream_diffusion()  : calc_diffusion over a file streamed in chunks
+stream_dwelltimes() : calc_all_dwelltimes over a file streamed in chunks
+EnsembleStats       : Mergeable ensemble MSD and jump distance accumulators
+ensemble_stats()    : Accumulates EnsembleStats over a file in one pass
+LiveTrajectoryStats : Per-trajectory D and dwell times updated row by row
+tail_csv()          : Async generator of the rows appended to a CSV
+watch_trajectories() : Live analysis of a growing trajectory file
+bootstrap_ci()      : Bootstrap confidence intervals of mean, median or k_off
+result_values()     : Numeric values of per-trajectory results
 process_image()     : Processes numpy arrays using opencv
+filter_frames()     : Lazily applies the process_image filters to frames
 track_csv()             : Uses bayesian tracking package to analyze data
 extract_features()   : Extracts signal features from processed frames
+process_and_extract_features() : Processes frames straight into
+                                 extract_features
 read_tif()                : Reads tif stacks and returns as a list of numpy arrays
+iter_tif()          : Reads tif stacks one frame at a time
+memmap_tif()        : Opens tif stacks as memory-mapped / lazily read frames
 write_csv()             : Writes CSV files with given data
+write_table()       : Writes numeric tables in a typed, memory-mappable format
+read_table()        : Reads (memory-maps) tables written by write_table
+csv_to_npy()        : Converts features/tracks/results CSVs to binary tables
+npy_to_csv()        : Converts binary tables back to CSV
+write_results()     : Writes per-trajectory results as CSV or binary
+ArtifactCache       : Content-hash cache of intermediate pipeline artifacts
 
 """
 
@@ -29,19 +62,283 @@ import csv
 import btrack
 from btrack.dataio import import_CSV
 import math
-from scipy.spatial.distance import pdist, squareform
+import ast
+import io
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from itertools import chain, groupby, islice, repeat
+from scipy.spatial import cKDTree
+import asyncio
+import cProfile
+import functools
+import inspect
+import pstats
+import resource
+from contextlib import contextmanager
+
+
+class Profiler:
+    """ Timers and counters around the utils stages
+
+    Stages (the functions decorated with @profiled) record their number of
+    calls, inclusive wall time and the peak RSS of the process when they
+    finish. Counters (frames, rows, trajectories, features, bytes read and
+    written, ...) are added to the innermost running stage with count().
+
+    The profiler is off by default. While it is off, a profiled function
+    costs one attribute check per call and count() returns straight away,
+    so the overhead is negligible. The entry scripts turn it on with
+    --profile; the global instance is PROFILER. Stages running in several
+    threads at once are tracked separately, each with its own stack.
+
+    Attributes:
+    enabled        : whether stages are being recorded
+    stages         : stage name -> {'calls', 'seconds', 'peak_rss_mb',
+                     'counters'}
+    cprofile_stage : name of a stage to also run under cProfile
+    """
 
-def convert_ND2(file_in, file_out, frame_range='all'):
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self.cprofile_stage = None
+        self._cprofile = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _active(self):
+        """ Stack of the stages running in the current thread """
+
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def enable(self, cprofile_stage=None):
+        """ Start recording; optionally cProfile one stage """
+
+        self.enabled = True
+        self.cprofile_stage = cprofile_stage
+        if cprofile_stage is not None:
+            self._cprofile = cProfile.Profile()
+
+    def reset(self):
+        """ Forget the recorded stages, e.g. in a worker process """
+
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, new_call=True):
+        """ Time a block of code as (one call of) stage name
+
+        With new_call=False the time is added to the last call instead,
+        e.g. for every item of a stream after the first.
+        """
+
+        with self._lock:
+            record = self.stages.setdefault(name, {'calls': 0,
+                                                   'seconds': 0.0,
+                                                   'peak_rss_mb': 0.0,
+                                                   'counters': {}})
+        # only the outermost call of a stage is timed and cProfiled
+        active = self._active
+        outermost = name not in active
+        profile = (outermost and name == self.cprofile_stage and
+                   threading.current_thread() is threading.main_thread())
+        active.append(name)
+        if profile:
+            self._cprofile.enable()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            if profile:
+                self._cprofile.disable()
+            active.pop()
+            with self._lock:
+                record['calls'] += int(new_call)
+                if outermost:
+                    record['seconds'] += seconds
+                record['peak_rss_mb'] = max(record['peak_rss_mb'],
+                                            peak_rss_mb())
+
+    def count(self, counter, n=1):
+        """ Add n to a counter of the innermost running stage """
+
+        if not self.enabled:
+            return
+        active = self._active
+        if not active:
+            return
+        with self._lock:
+            counters = self.stages[active[-1]]['counters']
+            counters[counter] = counters.get(counter, 0) + n
+
+    def count_file(self, counter, file_name):
+        """ Add the size of a file to a byte counter, e.g. 'bytes_read' """
+
+        if self.enabled and os.path.exists(file_name):
+            self.count(counter, os.path.getsize(file_name))
+
+    def merge(self, stages):
+        """ Add the stages of another profiler's report (e.g. a worker's) """
+
+        for name, other in stages.items():
+            record = self.stages.setdefault(name, {'calls': 0,
+                                                   'seconds': 0.0,
+                                                   'peak_rss_mb': 0.0,
+                                                   'counters': {}})
+            record['calls'] += other['calls']
+            record['seconds'] += other['seconds']
+            record['peak_rss_mb'] = max(record['peak_rss_mb'],
+                                        other['peak_rss_mb'])
+            for counter, n in other['counters'].items():
+                record['counters'][counter] = \
+                    record['counters'].get(counter, 0) + n
+
+    def report(self):
+        """ Per-stage summary with throughputs (counter per second)
+
+        Outputs:
+        report     : dict of stage name -> calls, seconds, peak RSS,
+                     counters and rates, slowest stage first
+        """
+
+        report = {}
+        for name, record in sorted(self.stages.items(),
+                                   key=lambda item: -item[1]['seconds']):
+            seconds = record['seconds']
+            report[name] = dict(record, rates={
+                counter + '/s': n / seconds if seconds > 0 else None
+                for counter, n in record['counters'].items()})
+
+        return report
+
+    def write_report(self, file_name):
+        """ Write the report as JSON, print it as text, and dump the
+        cProfile stats (to <file_name>.prof) if a stage was cProfiled """
+
+        report = self.report()
+        with open(file_name, 'w') as f:
+            json.dump(report, f, indent=1)
+
+        print('\n{:28s} {:>6s} {:>9s} {:>9s}  {}'.format(
+            'stage', 'calls', 'seconds', 'peak MB', 'throughput'))
+        for name, record in report.items():
+            rates = ', '.join('{:.4g} {}'.format(rate, counter)
+                              for counter, rate in record['rates'].items()
+                              if rate is not None)
+            print('{:28s} {:6d} {:9.3f} {:9.1f}  {}'.format(
+                name, record['calls'], record['seconds'],
+                record['peak_rss_mb'], rates))
+        print('Profile written to ' + file_name)
+
+        if self._cprofile is not None:
+            prof_file = os.path.splitext(file_name)[0] + '.prof'
+            self._cprofile.dump_stats(prof_file)
+            print('\ncProfile of ' + self.cprofile_stage + ' written to ' +
+                  prof_file)
+            pstats.Stats(self._cprofile).sort_stats(
+                'cumulative').print_stats(15)
+        elif report:
+            print('For details of the slowest stage, re-run with '
+                  '--cprofile ' + next(iter(report)))
+
+
+PROFILER = Profiler()
+
+
+def profiled(name):
+    """ Decorator recording every call of a function as stage name """
+
+    def decorate(func):
+        if inspect.isgeneratorfunction(func):
+            return _profiled_generator(name, func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+            with PROFILER.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+
+def _profiled_generator(name, func):
+    """ profiled() for generators: only the time spent producing items,
+    not the time the consumer spends between items, counts """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not PROFILER.enabled:
+            yield from func(*args, **kwargs)
+            return
+        items = func(*args, **kwargs)
+        first = True
+        while True:
+            with PROFILER.stage(name, new_call=first):
+                first = False
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    return wrapper
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process so far, in MB """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def add_profile_arguments(parser):
+    """ Add the --profile and --cprofile options of the entry scripts """
+
+    parser.add_argument('--profile',
+                        dest='profile',
+                        action='store_true',
+                        help="Report time, throughput and memory of each "
+                             "stage")
+    parser.add_argument('--cprofile',
+                        dest='cprofile',
+                        type=str,
+                        default=None,
+                        help="With --profile, also run this stage under "
+                             "cProfile")
+
+
+@profiled('convert_ND2')
+def convert_ND2(file_in, file_out, frame_range='all', bigtiff=None):
     """ Because ND2s are a pain to work with, convert to TIF
 
     ND2 is Nikon's proprietary image format. Most image/plotting packages
     can't read the data, so we need to have a function written to convert these
     to a TIF file
 
+    The ND2 is opened once and frames are streamed into a single open
+    TiffWriter, so each frame is written contiguously at the end of the
+    output file instead of re-opening the growing file for every frame.
+
     Parameters:
     file_in     : ND2 image to be processed
     file_out    : Name of the output TIF
     frame_range : Frame range to iterate over; defaults to 'all'
+    bigtiff     : Write a BigTIFF, needed for files over 4 GB. By default,
+                  BigTIFF is used only when the output would be that large
 
     outputs:
     img_out    : converted TIF file
@@ -54,36 +351,556 @@ def convert_ND2(file_in, file_out, frame_range='all'):
         print("Could not find file " + file_in)
         sys.exit(1)
 
-    # read the image into memory; this generates an img object
-    img = ND2Reader(file_in)
     img.iter_axes = 'z'  # t (time) oddly does not work; z-steps instead
 
     # handle cases where we want to process all frames
     if frame_range == 'all':
         frame_range = range(img.sizes['z'])
 
-    for index, frame in enumerate(frame_range):
-        if index == 0:
-            print('Processing frames[0.', end='')
-            output_img = np.array(img[frame], dtype='uint16')
-            tifffile.imwrite(file_out, output_img)
-        else:
-            print('.', end='')
-            # take frame and store as np array
-            output_img = np.array(img[frame], dtype='uint16')
-            tifffile.imwrite(file_out, output_img, append=True)
-    print('.' + str(frame) +
-          ']     Done. Curr frame is: ' +
-          str(frame) + '    ')
-    img.close()
+    if bigtiff is None:
+        frame_bytes = img.sizes['x'] * img.sizes['y'] * 2  # uint16
+        bigtiff = _needs_bigtiff(frame_bytes * len(frame_range))
+
+    # take each frame and store as np array, one at a time
+    frames = (np.array(img[frame], dtype='uint16') for frame in frame_range)
+
+    print('Processing frames[', end='')
+    try:
+        output_img, n_frames, seconds = write_tif(frames, file_out, bigtiff,
+                                                  progress=True)
+    finally:
+        img.close()
+    print(']     Done. ' + _throughput(n_frames, output_img, seconds))
+    PROFILER.count_file('bytes_read', file_in)
 
     return output_img
 
 
+@profiled('write_tif')
+def write_tif(frames, file_out, bigtiff=False, progress=False):
+    """ Stream frames into a tif stack through a single open TiffWriter
+
+    Parameters:
+    frames      : iterable of numpy arrays, consumed one at a time
+    file_out    : name of the output TIF
+    bigtiff     : write a BigTIFF (needed for files over 4 GB)
+    progress    : print a '.' for every frame written
+
+    outputs:
+    last_frame  : the last frame written (None if there were no frames)
+    n_frames    : number of frames written
+    seconds     : time spent reading and writing the frames
+    """
+
+    start = time.perf_counter()
+    last_frame = None
+    n_frames = 0
+    with tifffile.TiffWriter(file_out, bigtiff=bigtiff) as tif:
+        for frame in frames:
+            tif.write(frame, contiguous=True)
+            last_frame = frame
+            n_frames = n_frames + 1
+            if progress:
+                print('.', end='', flush=True)
+    PROFILER.count('frames', n_frames)
+    PROFILER.count_file('bytes_written', file_out)
+
+    return last_frame, n_frames, time.perf_counter() - start
+
+
+def _needs_bigtiff(n_bytes):
+    """ Whether a stack of n_bytes of image data needs BigTIFF """
+    # leave some headroom below 4 GB for tags and page offsets
+    return n_bytes > 2**32 - 2**25
+
+
+def _throughput(n_frames, frame, seconds):
+    """ Format frames/s and MB/s for a stack of n_frames like frame """
+    if n_frames == 0 or seconds <= 0:
+        return '0 frames'
+    n_bytes = n_frames * frame.nbytes
+    return '{} frames in {:.1f} s ({:.1f} frames/s, {:.1f} MB/s)'.format(
+        n_frames, seconds, n_frames / seconds, n_bytes / seconds / 1e6)
+
+
+class TrajectoryTable:
+    """ Columnar trajectory table, loaded once and shared between analyses
+
+    A btrack-style trajectory CSV (Trajectory, Frame, x, y, z, m0..m4,
+    NPscore) is parsed a single time into typed arrays. Rows are sorted by
+    trajectory (keeping file order within each trajectory) and an offset
+    index records where each trajectory starts and stops, so the diffusion,
+    dwell time and coordinate functions can accept a table in place of a
+    file name and skip re-parsing the file.
+
+    Attributes:
+    columns      : list of column names, in file order
+    data         : (N, len(columns)) float array of all values, sorted by
+                   trajectory. Column indices match the CSV's
+    query_column : column containing the trajectory IDs
+    trajectory   : int array of trajectory IDs, one per row
+    frame        : int array of frame numbers, one per row (if present)
+    traj_ids     : sorted, unique trajectory IDs
+    starts       : index of the first row of each trajectory
+    stops        : index one past the last row of each trajectory
+    """
+
+    def __init__(self, columns, data, query_column=1):
+        data = np.asarray(data, dtype=np.float64).reshape(-1, len(columns))
+        traj_ids = data[:, query_column].astype(np.int64)
+        order, unique_ids, starts, stops = _group_by_trajectory(traj_ids)
+        if np.all(order[1:] > order[:-1]):
+            # already grouped (e.g. a saved table); keep data as a view,
+            # which leaves a memory-mapped file unread until it is used
+            order = slice(None)
+
+        self.columns = list(columns)
+        self.data = data[order]
+        self.query_column = query_column
+        self.trajectory = traj_ids[order]
+        self.frame = None
+        if 'Frame' in self.columns:
+            self.frame = self.column('Frame').astype(np.int64)
+        self.traj_ids = unique_ids
+        self.starts = starts
+        self.stops = stops
+        # trajectory ID -> position in traj_ids, for O(1) lookups
+        self._positions = dict(zip(unique_ids.tolist(),
+                                   range(len(unique_ids))))
+
+    @classmethod
+    @profiled('TrajectoryTable.from_csv')
+    def from_csv(cls, file_in, query_column=1, delimiter=','):
+        """ Parse a trajectory CSV into a TrajectoryTable
+
+        Parameters:
+        file_in      : str
+                       trajectory file to process
+        query_column : int
+                       column containing the trajectory IDs
+        delimiter    : str
+                       column separator; btrack's export_CSV uses ' '
+
+        Outputs:
+        table        : TrajectoryTable
+        """
+
+        columns, data = _read_csv_table(file_in, delimiter)
+        PROFILER.count('rows', len(data))
+        PROFILER.count_file('bytes_read', file_in)
+        return cls(columns, data, query_column)
+
+    @classmethod
+    @profiled('TrajectoryTable.from_npy')
+    def from_npy(cls, file_in, query_column=1, mmap=True):
+        """ Load a TrajectoryTable saved by to_npy (or csv_to_npy)
+
+        Nothing is parsed: with mmap the rows are memory-mapped from the
+        file, and a table saved grouped by query_column is used in place
+        without being copied.
+        """
+
+        columns, data = read_table(file_in, mmap)
+        PROFILER.count('rows', len(data))
+        return cls(columns, data, query_column)
+
+    @classmethod
+    def load(cls, file_in, query_column=1, delimiter=','):
+        """ Load a trajectory file, binary (.npy) or text (CSV) """
+
+        if file_in.endswith('.npy'):
+            return cls.from_npy(file_in, query_column)
+        return cls.from_csv(file_in, query_column, delimiter)
+
+    def to_npy(self, file_out):
+        """ Save the table in the binary format read by from_npy """
+
+        write_table(file_out, self.columns, self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def column(self, column):
+        """ Return one column, by index or by name, as a view """
+
+        if isinstance(column, str):
+            column = self.columns.index(column)
+        return self.data[:, column]
+
+    def rows(self, traj_ID):
+        """ Return the rows of a single trajectory as a view
+
+        The lookup is O(1) and no data is copied. An unknown trajectory ID
+        yields an empty array.
+        """
+
+        pos = self._positions.get(int(traj_ID))
+        if pos is None:
+            return self.data[:0]
+        return self.data[self.starts[pos]:self.stops[pos]]
+
+    def xy(self, traj_ID, result_columns=(3, 4)):
+        """ Return the X & Y columns of a single trajectory
+
+        Evenly spaced columns (e.g. [3, 4]) are returned as a zero-copy
+        view into the table; any other selection is a copy.
+        """
+
+        return self.rows(traj_ID)[:, _column_selector(result_columns)]
+
+    def group_by(self, query_column):
+        """ Return a table grouped by query_column (self if already is) """
+
+        if query_column == self.query_column:
+            return self
+        return TrajectoryTable(self.columns, self.data, query_column)
+
+    def select(self, traj_IDs):
+        """ Return a table holding only the given trajectories """
+
+        positions = [self._positions[int(traj)] for traj in traj_IDs
+                     if int(traj) in self._positions]
+        rows = [np.arange(self.starts[pos], self.stops[pos])
+                for pos in positions]
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        return TrajectoryTable(self.columns, self.data[rows],
+                               self.query_column)
+
+
+@profiled('load_trajectory_updates')
+def load_trajectory_updates(file_in, state_file, query_column=1,
+                            delimiter=',', params=None):
+    """ Load a growing trajectory file, parsing only newly appended rows
+
+    The rows parsed so far are kept in state_file (a .npz) together with
+    the byte offset reached in file_in. Each call parses only the complete
+    lines appended since the previous call. If file_in was rewritten
+    rather than appended to (it shrank, or the bytes before the offset
+    changed), the state was saved with another query_column, delimiter or
+    params, or there is no usable state, the whole file is parsed.
+
+    Parameters:
+    file_in      : str
+                   trajectory file to process
+    state_file   : str
+                   .npz file remembering the rows and offset already parsed
+    query_column : int
+                   column containing the trajectory IDs
+    delimiter    : str
+                   column separator
+    params       : dict
+                   analysis parameters (JSON serializable) the results
+                   kept alongside the state depend on
+
+    Outputs:
+    table        : TrajectoryTable of every row parsed so far
+    changed      : IDs of the trajectories that received new rows (all of
+                   them when the file was parsed from the start)
+    fresh        : True if the file was parsed from the start
+    """
+
+    if file_in.endswith('.npy'):
+        print("Incremental updates need a CSV trajectory file, not " +
+              file_in)
+        sys.exit(1)
+
+    try:
+        traj_file = open(file_in, 'rb')
+    except FileNotFoundError:
+        print("Could not find file " + file_in)
+        sys.exit(1)
+
+    settings = json.dumps({'query_column': query_column,
+                           'delimiter': delimiter,
+                           'params': params}, sort_keys=True)
+    with traj_file:
+        state = _load_state(state_file)
+        fresh = state is None or \
+            str(state.get('settings')) != settings or \
+            _file_fingerprint(traj_file, int(state['offset'])) != \
+            str(state['fingerprint'])
+        if fresh:
+            traj_file.seek(0)
+            header = traj_file.readline().decode()
+            columns = [name.strip() for name in header.split(delimiter)]
+            old_data = np.zeros((0, len(columns)))
+        else:
+            columns = [str(name) for name in state['columns']]
+            old_data = state['data']
+            traj_file.seek(int(state['offset']))
+
+        # only parse complete lines; a partly written last line waits for
+        # the next call
+        start = traj_file.tell()
+        chunk = traj_file.read()
+        chunk = chunk[:chunk.rfind(b'\n') + 1]
+        new_data = np.zeros((0, len(columns)))
+        if chunk.strip():
+            new_data = np.loadtxt(io.StringIO(chunk.decode()),
+                                  delimiter=delimiter, ndmin=2)
+        offset = start + len(chunk)
+        PROFILER.count('rows', len(new_data))
+        PROFILER.count('bytes_read', len(chunk))
+        fingerprint = _file_fingerprint(traj_file, offset)
+
+    table = TrajectoryTable(columns, np.concatenate((old_data, new_data)),
+                            query_column)
+    changed = np.unique(new_data[:, query_column].astype(np.int64))
+    if fresh:
+        changed = table.traj_ids
+
+    _save_state(state_file, columns=np.array(columns), data=table.data,
+                offset=offset, fingerprint=fingerprint, settings=settings)
+
+    return table, changed, fresh
+
+
+def _file_fingerprint(open_file, offset):
+    """ Identify the first offset bytes of a file without reading it all
+
+    Uses the byte count plus the first and last 4 kB before offset, which
+    is enough to tell an appended-to file from a rewritten one.
+    """
+
+    open_file.seek(0, os.SEEK_END)
+    if open_file.tell() < offset:
+        return ''  # the file shrank
+    open_file.seek(0)
+    head = open_file.read(min(offset, 4096))
+    open_file.seek(max(offset - 4096, 0))
+    tail = open_file.read(offset - max(offset - 4096, 0))
+    digest = hashlib.sha256(str(offset).encode() + head + tail)
+    return digest.hexdigest()
+
+
+def _load_state(state_file):
+    """ Load an incremental-analysis state file, or None if unusable """
+    try:
+        with np.load(state_file, allow_pickle=False) as state:
+            return dict(state)
+    except (FileNotFoundError, ValueError, OSError, KeyError):
+        return None
+
+
+def _save_state(state_file, **arrays):
+    """ Atomically write an incremental-analysis state file """
+    tmp_name = state_file + '.' + str(os.getpid()) + '.tmp.npz'
+    np.savez(tmp_name, **arrays)
+    os.replace(tmp_name, state_file)
+
+
+def update_traj_results(file_in, file_out, query_column, analyze,
+                        delimiter=',', params=None):
+    """ Incrementally update a per-trajectory results file
+
+    Only the trajectories that received new rows since the last update of
+    file_out are re-analyzed; their results replace the old ones and every
+    other trajectory keeps its earlier result. The parsed rows and the
+    position reached in file_in are kept in <file_out>.state.npz, together
+    with query_column, delimiter and params. If any of them changed, every
+    trajectory is re-analyzed.
+
+    Parameters:
+    file_in      : str
+                   growing trajectory file
+    file_out     : str
+                   results CSV from the previous update (if any)
+    query_column : int
+                   column containing the trajectory IDs
+    analyze      : function
+                   called with a TrajectoryTable of the changed
+                   trajectories; returns their [trajectory ID, result] rows
+    delimiter    : str
+                   column separator of file_in
+    params       : dict
+                   parameters of analyze (JSON serializable), e.g. max_disp
+
+    Outputs:
+    rows         : [trajectory ID, result] rows of every trajectory
+    """
+
+    state_file = os.path.splitext(file_out)[0] + '.state.npz'
+    if not os.path.exists(file_out) and os.path.exists(state_file):
+        os.remove(state_file)  # results are gone; start over
+
+    table, changed, fresh = load_trajectory_updates(file_in, state_file,
+                                                    query_column, delimiter,
+                                                    params)
+    new_rows = analyze(table.select(changed))
+    if fresh:
+        return new_rows
+
+    _, old_rows = read_traj_results(file_out)
+    return merge_traj_results(old_rows, new_rows, changed)
+
+
+def read_traj_results(file_name):
+    """ Read a per-trajectory results CSV (e.g. *_dwell_times.csv)
+
+    Values are converted back to numbers: IDs to int or float, results to
+    float, None (empty cell) or a list of floats.
+
+    Binary (.npy) results written by write_results are read as well.
+
+    Outputs:
+    header       : the header row, or None if the file does not exist
+    rows         : list of [trajectory ID, result]
+    """
+
+    if file_name.endswith('.npy'):
+        if not os.path.exists(file_name):
+            return None, []
+        header, data = read_table(file_name)
+        return header, _results_from_array(data)
+
+    try:
+        results_file = open(file_name, 'r')
+    except FileNotFoundError:
+        return None, []
+
+    with results_file:
+        reader = csv.reader(results_file)
+        header = next(reader, None)
+        rows = [[_parse_value(ID), _parse_value(value)]
+                for ID, value in reader]
+
+    return header, rows
+
+
+def _parse_value(text):
+    """ Turn a CSV cell written by csv.writer back into a Python value """
+    if text == '':
+        return None
+    for number in (int, float):
+        try:
+            return number(text)
+        except ValueError:
+            pass
+    return ast.literal_eval(text)  # e.g. a list of dwell times
+
+
+def write_results(rows, file_name, header):
+    """ Write per-trajectory results as CSV, or binary if file_name is .npy
+
+    In the binary format a missing result (None) is stored as NaN. The row
+    holding the list of all binding events of a trajectory is stored as NaN
+    too, and rebuilt from the rows with decimal IDs that precede it.
+    Results with more than two columns (e.g. MSD fits, dwell time sweeps)
+    must be numeric, and are written as they are.
+
+    Parameters:
+    rows         : list of [trajectory ID, result], or of numeric rows with
+                   one value per column of header
+    file_name    : str
+                   output file; .npy for binary, anything else for CSV
+    header       : list of the column names
+    """
+
+    if file_name.endswith('.npy'):
+        if len(header) == 2:
+            rows = _results_to_array(rows)
+        write_table(file_name, header, rows)
+    else:
+        write_csv([header] + list(rows), file_name)
+
+
+def _results_to_array(rows):
+    """ Pack [trajectory ID, result] rows into an (N, 2) float array """
+
+    data = np.full((len(rows), 2), np.nan)
+    for i, (ID, value) in enumerate(rows):
+        data[i, 0] = ID
+        if value is not None and not isinstance(value, list):
+            data[i, 1] = value
+
+    return data
+
+
+def _results_from_array(data):
+    """ Unpack an array written by _results_to_array into result rows """
+
+    rows = []
+    events = []  # dwell times of the current trajectory's decimal IDs
+    for ID, value in np.asarray(data).tolist():
+        if ID != int(ID):
+            events.append(value)
+            rows.append([ID, value])
+            continue
+        if np.isnan(value):
+            value = events if events else None
+        rows.append([int(ID), value])
+        events = []
+
+    return rows
+
+
+def merge_traj_results(old_rows, new_rows, changed):
+    """ Replace the results of changed trajectories in a results list
+
+    Rows of the old results belonging to a changed trajectory (including
+    the decimal IDs of extra binding events) are dropped, the new rows are
+    added, and everything is ordered by trajectory ID, keeping the order of
+    the rows within a trajectory.
+    """
+
+    changed = set(int(traj) for traj in changed)
+    rows = [row for row in old_rows if int(row[0]) not in changed]
+    rows = rows + list(new_rows)
+    rows.sort(key=lambda row: int(row[0]))
+
+    return rows
+
+
+def _read_csv_table(file_in, delimiter=','):
+    """ Parse a numeric CSV with a header row into (columns, data) """
+
+    try:
+        with open(file_in, 'r') as table_file:
+            header = table_file.readline()
+            columns = [name.strip() for name in header.split(delimiter)]
+            data = np.loadtxt(table_file, delimiter=delimiter, ndmin=2)
+    except FileNotFoundError:
+        print("Could not find file " + file_in)
+        sys.exit(1)
+
+    return columns, data.reshape(-1, len(columns))
+
+
+def _count_table(table):
+    """ Count the rows and trajectories of a table towards the stage """
+
+    PROFILER.count('rows', len(table))
+    PROFILER.count('trajectories', len(table.traj_ids))
+
+
+def _column_selector(columns):
+    """ Turn a list of column indices into a slice when possible
+
+    Basic slicing returns a view, while a list of indices forces numpy
+    to copy the selected columns.
+    """
+
+    columns = list(columns)
+    step = columns[1] - columns[0] if len(columns) > 1 else 1
+    if step > 0 and columns == list(range(columns[0],
+                                          columns[-1] + 1, step)):
+        return slice(columns[0], columns[-1] + 1, step)
+    return columns
+
+
+def _as_trajectory_table(file_in, query_column):
+    """ Accept either a file name or a TrajectoryTable """
+
+    if isinstance(file_in, TrajectoryTable):
+        return file_in.group_by(query_column)
+    return TrajectoryTable.load(file_in, query_column)
+
+
+@profiled('calc_diffusion')
 def calc_diffusion(file_in, query_column, result_columns,
-                   traj_ID='all', deltaT=0.1):
+                   traj_ID='all', deltaT=0.1, workers=1):
     """ Calculate diffusion coefficients of particles
-    
+
     Diffusion can be calculated using the simple equation:
                             MSD = 4*D*deltaT
     where D is the diffusion coeff and deltaT is the time delay between frames.
@@ -92,254 +909,1494 @@ def calc_diffusion(file_in, query_column, result_columns,
     would therefore be a straight line. We could get into more complicated
     fitting, but for the sake of simplicity we'll just assume Brownian.
 
+    The trajectory file is parsed once into columns, and the MSD of every
+    trajectory is computed in a single vectorized group-by pass, so runtime
+    grows linearly with the number of rows.
+
     Parameters:
-    file_in          : trajectory file to process
+    file_in          : trajectory file to process, or a TrajectoryTable
     query_column     : column containing the trajectory IDs
     result_columns   : columns containing the X and Y coordinates, respectively
     traj_ID          : trajectories to analyze. By default, all are analyzed
     delta_T          : exposure time, in seconds. By default, deltaT=0.1
+    workers          : number of processes to shard trajectories across.
+                       By default, workers=1 (no process pool)
 
     Outputs:
-    dataOut          : X & Y coordinates of the particle while it exists
-                       Note: This may be unnecessary & may bog down processing;
-                       will likely edit to remove later
+    dataOut          : X & Y coordinates of the analyzed rows, as an (N, 2)
+                       array grouped by trajectory
     diffusion_coeffs : A list of lists containing the trajectory ID and its
-                       diffusion coefficient
+                       diffusion coefficient. If a single traj_ID is given,
+                       only its diffusion coefficient is returned
 
     """
 
-    # check that the file exists
-    try:
-        traj_file = open(file_in, 'r') # open file with traj info
-    except FileNotFoundError:
-        print("Could not find file " + file_in)
+    table = _as_trajectory_table(file_in, query_column)
+
+    if traj_ID != 'all':
+        PROFILER.count('trajectories')
+        # analyze a single trajectory
+        dataOut = table.xy(traj_ID, result_columns)
+        MSD = _msd_by_trajectory(dataOut / 1000, [0], [len(dataOut)])
+        diffusion_coeffs = float(MSD[0] / (4 * float(deltaT)))
+        return dataOut, diffusion_coeffs
+
+    dataOut = table.data[:, _column_selector(result_columns)]
+    _count_table(table)
+    diffusion_coeffs = map_trajectory_shards(_diffusion_shard, table,
+                                             result_columns, workers,
+                                             float(deltaT))
+
+    return dataOut, diffusion_coeffs
+
+
+def _diffusion_shard(shard, deltaT):
+    """ Diffusion coefficients of one shard of trajectories
+
+    Parameters:
+    shard            : (traj_ids, offsets, xy_data) tuple, see
+                       map_trajectory_shards
+    deltaT           : exposure time, in seconds
+
+    Outputs:
+    diffusion_coeffs : list of [trajectory ID, diffusion coeff]
+    """
+
+    traj_ids, offsets, xy_data = shard
+
+    # calculate mean squared displacement (MSD) for each trajectory
+    MSD = _msd_by_trajectory(xy_data / 1000,  # converting from nm to um
+                             offsets[:-1], offsets[1:])
+
+    # diffusion can now be computed
+    traj_diff = MSD / (4 * deltaT)
+
+    return [[int(traj), float(diff)]
+            for traj, diff in zip(traj_ids, traj_diff)]
+
+
+def _group_by_trajectory(traj_ids):
+    """ Build a group-by index over an array of trajectory IDs
+
+    Rows keep their file order within each trajectory (stable sort).
+
+    Parameters:
+    traj_ids    : array of trajectory IDs, one per row
+
+    Outputs:
+    order       : permutation that sorts the rows by trajectory
+    unique_ids  : sorted, unique trajectory IDs
+    starts      : index of the first sorted row of each trajectory
+    stops       : index one past the last sorted row of each trajectory
+    """
+
+    order = np.argsort(traj_ids, kind='stable')
+    unique_ids, starts = np.unique(traj_ids[order], return_index=True)
+    stops = np.append(starts[1:], len(traj_ids))
+
+    return order, unique_ids, starts, stops
+
+
+def _msd_by_trajectory(xy_data, starts, stops):
+    """ Lag-1 mean squared displacement of every trajectory at once
+
+    Parameters:
+    xy_data     : (N, 2) array of coordinates, grouped by trajectory
+    starts      : index of the first row of each trajectory
+    stops       : index one past the last row of each trajectory
+
+    Outputs:
+    MSD         : array with one MSD per trajectory; NaN for trajectories
+                  with fewer than two points
+    """
+
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    if len(starts) == 0 or len(xy_data) == 0:
+        return np.full(len(starts), np.nan)
+
+    r = np.sqrt(xy_data[:, 0]**2 + xy_data[:, 1]**2)
+    # r(t + dt) - r(t), padded so every trajectory start is a valid index
+    diff_sq = np.append(np.diff(r)**2, 0)
+    # steps that jump from one trajectory to the next are not displacements
+    diff_sq[starts[1:] - 1] = 0
+
+    sum_sq = np.add.reduceat(diff_sq, starts)
+    n_steps = stops - starts - 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        MSD = sum_sq / n_steps
+    MSD[n_steps < 1] = np.nan
+
+    return MSD
+
+
+@profiled('calc_msd')
+def calc_msd(file_in, query_column, result_columns, deltaT=0.1, workers=1):
+    """ Time-averaged MSD curve of every trajectory, over all lags
+
+    MSD(tau) is averaged over every pair of points tau apart in a
+    trajectory, using true 2D displacements. All lags are computed at once
+    with the FFT algorithm (see _msd_fft), in O(N log N) per trajectory.
+
+    Parameters:
+    file_in          : trajectory file to process, or a TrajectoryTable
+    query_column     : column containing the trajectory IDs
+    result_columns   : columns containing the X and Y coordinates (nm)
+    deltaT           : time delay between frames, in seconds
+    workers          : number of processes to shard trajectories across
+
+    Outputs:
+    msd_curves       : list of [trajectory ID, lag (s), MSD (um^2), number
+                       of point pairs averaged], lags 1 to N-1 of every
+                       trajectory of N points
+    """
+
+    table = _as_trajectory_table(file_in, query_column)
+    _count_table(table)
+
+    return map_trajectory_shards(_msd_curve_shard, table, result_columns,
+                                 workers, float(deltaT))
+
+
+@profiled('fit_msd')
+def fit_msd(file_in, query_column, result_columns, deltaT=0.1, n_lags=4,
+            workers=1):
+    """ Fit D and the anomalous exponent alpha to each trajectory's MSD
+
+    Over the first n_lags lags of each MSD curve (see calc_msd):
+        MSD = 4*D*tau + offset     (linear; the offset absorbs the
+                                    localization error)
+        MSD = 4*K*tau**alpha       (fit on a log-log scale)
+    Trajectories with fewer than n_lags + 1 points are fit on the lags
+    they have; with fewer than 3 points the fits are NaN.
+
+    Parameters:
+    file_in          : trajectory file to process, or a TrajectoryTable
+    query_column     : column containing the trajectory IDs
+    result_columns   : columns containing the X and Y coordinates (nm)
+    deltaT           : time delay between frames, in seconds
+    n_lags           : number of lags to fit
+    workers          : number of processes to shard trajectories across
+
+    Outputs:
+    msd_fits         : list of [trajectory ID, D (um^2/s), alpha]
+    """
+
+    table = _as_trajectory_table(file_in, query_column)
+    _count_table(table)
+
+    return map_trajectory_shards(_msd_fit_shard, table, result_columns,
+                                 workers, float(deltaT), int(n_lags))
+
+
+def _msd_curve_shard(shard, deltaT):
+    """ MSD curves of one shard of trajectories, see calc_msd """
+
+    traj_ids, offsets, xy_data = shard
+    starts = offsets[:-1]
+    msd, n_pairs = _msd_fft(xy_data / 1000, starts, offsets[1:])
+
+    # lag of every row relative to its trajectory start
+    lags = np.arange(len(msd)) - np.repeat(starts, np.diff(offsets))
+    curve = lags > 0
+    IDs = np.repeat(traj_ids, np.diff(offsets))
+
+    return [[int(traj), lag * deltaT, value, int(n)]
+            for traj, lag, value, n in zip(IDs[curve].tolist(),
+                                           lags[curve].tolist(),
+                                           msd[curve].tolist(),
+                                           n_pairs[curve].tolist())]
+
+
+def _msd_fit_shard(shard, deltaT, n_lags):
+    """ MSD fits of one shard of trajectories, see fit_msd """
+
+    traj_ids, offsets, xy_data = shard
+    msd, _ = _msd_fft(xy_data / 1000, offsets[:-1], offsets[1:])
+    D, alpha = _fit_msd_curves(msd, offsets[:-1], offsets[1:], deltaT,
+                               n_lags)
+
+    return [[int(traj), float(d), float(a)]
+            for traj, d, a in zip(traj_ids, D, alpha)]
+
+
+def _msd_fft(xy_data, starts, stops):
+    """ MSD at every lag of every trajectory, using FFTs
+
+    For a trajectory r_0 .. r_{N-1}, MSD(m) = S1(m) - 2*S2(m) with
+        S1(m) = sum_k (|r_k|^2 + |r_{k+m}|^2) / (N - m)   (prefix sums)
+        S2(m) = sum_k r_k . r_{k+m} / (N - m)             (autocorrelation)
+    where k runs from 0 to N-m-1. The autocorrelation of every lag comes
+    from one zero-padded FFT, so a trajectory costs O(N log N) instead of
+    the O(N^2) of looping over lags. Trajectories are batched by padded
+    FFT size, so all trajectories of similar length share one FFT call.
+
+    Parameters:
+    xy_data     : (N, 2) array of coordinates, grouped by trajectory
+    starts      : index of the first row of each trajectory
+    stops       : index one past the last row of each trajectory
+
+    Outputs:
+    msd         : array aligned with xy_data; msd[starts[i] + m] is the
+                  MSD of trajectory i at lag m
+    n_pairs     : number of point pairs averaged for each of those values
+    """
+
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(stops, dtype=np.int64) - starts
+    msd = np.full(len(xy_data), np.nan)
+    n_pairs = np.zeros(len(xy_data), dtype=np.int64)
+    if len(starts) == 0:
+        return msd, n_pairs
+
+    # padding to >= 2N keeps the circular FFT correlation from wrapping
+    sizes = 2 ** np.ceil(np.log2(2 * lengths)).astype(np.int64)
+    for size in np.unique(sizes):
+        batch = np.flatnonzero(sizes == size)
+        N = lengths[batch, None]
+        lag = np.arange(N.max())[None, :]
+        valid = lag < N
+        rows = np.where(valid, starts[batch, None] + lag, 0)
+
+        # positions relative to the first point, zero past each end
+        r = xy_data[rows] - xy_data[starts[batch]][:, None, :]
+        r[~valid] = 0
+
+        spectrum = np.fft.rfft(r, n=size, axis=1)
+        S2 = np.fft.irfft(spectrum.real**2 + spectrum.imag**2, n=size,
+                          axis=1)[:, :lag.shape[1]].sum(axis=2)
+
+        sq = (r**2).sum(axis=2)
+        prefix = np.zeros((len(batch), lag.shape[1] + 1))
+        np.cumsum(sq, axis=1, out=prefix[:, 1:])
+        head = np.take_along_axis(prefix, np.where(valid, N - lag, 0), 1)
+        tail = np.take_along_axis(prefix, N, 1) - \
+            np.take_along_axis(prefix, np.where(valid, lag, 0), 1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            curves = (head + tail - 2 * S2) / (N - lag)
+        msd[rows[valid]] = curves[valid]
+        n_pairs[rows[valid]] = (N - lag)[valid]
+
+    return msd, n_pairs
+
+
+def _fit_msd_curves(msd, starts, stops, deltaT, n_lags):
+    """ Least-squares fits of the first n_lags lags of every MSD curve
+
+    Outputs:
+    D           : slope / 4 of the linear fit, per trajectory
+    alpha       : slope of the log-log fit, per trajectory
+    """
+
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(stops, dtype=np.int64) - starts
+    lag = np.arange(1, n_lags + 1)[None, :]
+    valid = lag < lengths[:, None]
+    y = msd[np.where(valid, starts[:, None] + lag, 0)]
+    tau = lag * deltaT
+
+    D = _masked_slope(tau, y, valid) / 4
+    with np.errstate(divide='ignore', invalid='ignore'):
+        positive = valid & (y > 0)
+        alpha = _masked_slope(np.log(tau), np.log(np.where(positive, y, 1)),
+                              positive)
+
+    return D, alpha
+
+
+def _masked_slope(x, y, mask):
+    """ Slope of a straight-line fit to each row, using masked points only
+    (NaN if a row has fewer than 2 points) """
+
+    x = np.broadcast_to(x, mask.shape)
+    n = mask.sum(axis=1)
+    Sx = np.where(mask, x, 0).sum(axis=1)
+    Sy = np.where(mask, y, 0).sum(axis=1)
+    Sxx = np.where(mask, x * x, 0).sum(axis=1)
+    Sxy = np.where(mask, x * y, 0).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n * Sxy - Sx * Sy) / (n * Sxx - Sx**2)
+    slope[n < 2] = np.nan
+
+    return slope
+
+
+@profiled('calc_dwelltime')
+def calc_dwelltime(xy_data, max_disp, min_bound_frames, frame_rate=0.1):
+    """ Calculate particle dwell time
+
+    The number of bound frames of an event is the number of positions in the
+    trajectory that lie within max_disp of the position where the event
+    starts. Distances are only computed for positions near the frames
+    visited, using a KD-tree, so long trajectories do not need an N x N
+    distance matrix.
+
+    Inputs:
+    ----
+    xy_data           : list or numpy array
+                       list of xy coordinates for each particle
+    max_disp         : int
+                       maxium displacement a particle travels between frames
+    min_bound_frames : int
+                       minimum number of frames a particle can be bound for;
+                       removes spurrious binding events/false positives
+    frame_rate       : int
+                       time delay between each frame, in seconds.
+                       Defaults to 0.1 sec
+
+    Outputs:
+    ----
+    dwell_times     : int
+                      particle dwell time
+
+    """
+
+    xy_data = np.asarray(xy_data, dtype=np.float64)
+    if len(xy_data) == 0 or max_disp <= 0:
+        return None
+
+    bound_frames = _scan_binding_events(cKDTree(xy_data), xy_data, max_disp,
+                                        min_bound_frames)
+
+    # now, turn the number of bound frames into an actual dwell time
+    dwell_times = [frame_rate * n_bound for n_bound in bound_frames]
+
+    if dwell_times == []:
+        return None
+
+    return dwell_times
+
+
+@profiled('get_xy_coords')
+def get_xy_coords(file_in, query_column, result_columns, traj_ID):
+    ''' Helper function for extracting a particle's XY coordinates
+
+    With a given CSV file containing trajectory info, loop through all of the
+    tracks and extract their XY coordinates.
+
+    Parameters:
+    file_in          : str or TrajectoryTable
+                       trajectory file to process, or an already loaded table
+    query_column     : int
+                       column containing the trajectory IDs
+    result_columns   : int
+                       columns containing the X and Y coordinates, respectively
+    traj_ID          : int
+                       trajectory to analyze (note: unlike calc_diffusion, this
+                       only calls a signel trajectory at a time)
+
+    Outputs:
+    xy_coords          : numpy array
+                         X & Y coordinates of the particle while it exists.
+                         When file_in is a TrajectoryTable this is a view
+                         into the table, found in O(1) through its index
+    '''
+
+    table = _as_trajectory_table(file_in, query_column)
+    xy_coords = table.xy(traj_ID, result_columns)
+
+    return xy_coords
+
+
+@profiled('calc_all_dwelltimes')
+def calc_all_dwelltimes(file_in, query_column, result_columns, max_disp,
+                        min_bound_frames, frame_rate=0.1, workers=1):
+    ''' Calculate the dwell time(s) of every trajectory in a file
+
+    Parameters:
+    file_in          : str or TrajectoryTable
+                       trajectory file to process, or an already loaded table
+    query_column     : int
+                       column containing the trajectory IDs
+    result_columns   : int
+                       columns containing the X and Y coordinates, respectively
+    max_disp         : int
+                       maxium displacement a particle travels between frames
+    min_bound_frames : int
+                       minimum number of frames a particle can be bound for
+    frame_rate       : int
+                       time delay between each frame, in seconds
+    workers          : int
+                       number of processes to shard trajectories across
+
+    Outputs:
+    all_dwell_times  : list
+                       [trajectory ID, dwell time] for every trajectory. Dwell
+                       time is None for trajectories that never bind; extra
+                       binding events are listed with decimal trajectory IDs
+    '''
+
+    table = _as_trajectory_table(file_in, query_column)
+    _count_table(table)
+
+    return map_trajectory_shards(_dwelltime_shard, table, result_columns,
+                                 workers, max_disp, min_bound_frames,
+                                 frame_rate)
+
+
+def _dwelltime_shard(shard, max_disp, min_bound_frames, frame_rate):
+    ''' Dwell times of one shard of trajectories
+
+    Parameters:
+    shard            : (traj_ids, offsets, xy_data) tuple, see
+                       map_trajectory_shards
+    max_disp, min_bound_frames, frame_rate : see calc_dwelltime
+
+    Outputs:
+    all_dwell_times  : list of [trajectory ID, dwell time], as returned by
+                       calc_all_dwelltimes
+    '''
+
+    traj_ids, offsets, xy_data = shard
+
+    all_dwell_times = []  # where to store the final data
+    for i, traj_ID in enumerate(traj_ids):
+        xy_coords = xy_data[offsets[i]:offsets[i + 1]]
+        # now, compute dwell times
+        dwell_time = calc_dwelltime(xy_coords,
+                                    max_disp,
+                                    min_bound_frames,
+                                    frame_rate)
+        all_dwell_times.extend(_dwelltime_rows(traj_ID, dwell_time))
+
+    return all_dwell_times
+
+
+def _dwelltime_rows(traj_ID, dwell_time):
+    ''' Format the dwell time(s) of one trajectory as output rows '''
+
+    rows = []
+    # handle cases where we may have multiple binding events (rare)
+    if dwell_time is not None:
+        if len(dwell_time) > 1:
+            for i in range(len(dwell_time)):
+                # generate a new traj ID, using decimal points
+                # note: assumes we'll never have > 10 events
+                temp_traj_ID = float(str(traj_ID) + '.' + str(i+1))
+                rows.append([temp_traj_ID, dwell_time[i]])
+        else:
+            # not doing the below appends a list to the list
+            dwell_time = dwell_time[0]
+
+    rows.append([int(traj_ID), dwell_time])
+
+    return rows
+
+
+def _scan_binding_events(tree, xy_data, max_disp, min_bound_frames,
+                         counts=None):
+    """ Bound frames of each binding event of one trajectory
+
+    Parameters:
+    tree             : cKDTree of xy_data
+    xy_data          : numpy array of the trajectory's xy coordinates
+    max_disp, min_bound_frames : see calc_dwelltime
+    counts           : dict of row -> number of positions within max_disp
+                       of it, filled in as rows are visited. Scans with
+                       other min_bound_frames (and the same max_disp) can
+                       share it
+
+    Outputs:
+    bound_frames     : list of the number of bound frames of each event
+    """
+
+    if counts is None:
+        counts = {}
+
+    # a particle is bound to the position of curr_row for every frame that
+    # lies within max_disp of it. Rather than building the full N x N
+    # distance matrix, only the rows we actually visit are queried against
+    # a KD-tree, so memory stays O(N)
+    # the tree search is inclusive (<=); pad the radius slightly and apply
+    # the strict cut on the exact distances below
+    search_radius = max_disp * (1 + 1e-9)
+
+    bound_frames = []  # number of bound frames of each binding event
+    curr_row = 0
+    while curr_row < len(xy_data):
+        n_bound = counts.get(curr_row)
+        if n_bound is None:
+            candidates = tree.query_ball_point(xy_data[curr_row],
+                                               search_radius)
+            disp = np.sqrt(np.sum((xy_data[candidates] -
+                                   xy_data[curr_row])**2, axis=1))
+            n_bound = int(np.count_nonzero(disp < max_disp))
+            counts[curr_row] = n_bound
+
+        if n_bound > min_bound_frames:
+            bound_frames.append(n_bound)
+            curr_row = curr_row + n_bound
+        else:
+            curr_row = curr_row + 1
+
+    return bound_frames
+
+
+@profiled('sweep_dwelltimes')
+def sweep_dwelltimes(file_in, query_column, result_columns, max_disps,
+                     min_bound_frames, frame_rates=(0.1,), workers=1):
+    ''' Dwell times of every trajectory for every combination of thresholds
+
+    Equivalent to calling calc_all_dwelltimes once per combination of
+    max_disp, min_bound_frames and frame_rate, but the trajectories are
+    loaded once and each trajectory's KD-tree is built once. For each
+    max_disp, the number of positions within reach of a visited position
+    is remembered, so the scans for further min_bound_frames only query
+    positions no earlier scan visited. As in calc_dwelltime, only the
+    positions a scan lands on are queried, so long bound trajectories
+    stay linear in time and memory. The frame rate just scales the dwell
+    times.
+
+    Parameters:
+    file_in          : str or TrajectoryTable
+                       trajectory file to process, or an already loaded table
+    query_column     : int
+                       column containing the trajectory IDs
+    result_columns   : int
+                       columns containing the X and Y coordinates, respectively
+    max_disps        : list
+                       values of max_disp to sweep
+    min_bound_frames : list
+                       values of min_bound_frames to sweep
+    frame_rates      : list
+                       values of frame_rate to sweep, in seconds
+    workers          : int
+                       number of processes to shard trajectories across
+
+    Outputs:
+    events           : list of [max_disp, min_bound_frames, frame_rate,
+                       trajectory ID, event, dwell time], one row per
+                       binding event (numbered from 1 within a trajectory),
+                       grouped by combination in the order of the grids
+    summary          : list of [max_disp, min_bound_frames, frame_rate,
+                       fraction of trajectories bound, number of events,
+                       mean dwell time, median dwell time], one row per
+                       combination. The mean and median are NaN without
+                       events
+    '''
+
+    table = _as_trajectory_table(file_in, query_column)
+    _count_table(table)
+    n_trajectories = len(table.traj_ids)
+
+    # number of bound frames of the events of every trajectory, for every
+    # (max_disp, min_bound_frames) pair k; the shards return them by
+    # trajectory, a stable sort groups them by pair
+    bound = map_trajectory_shards(_dwelltime_sweep_shard, table,
+                                  result_columns, workers, list(max_disps),
+                                  list(min_bound_frames))
+    bound.sort(key=lambda row: row[0])
+    by_pair = {k: [(traj_ID, n_bound) for _, traj_ID, n_bound in rows]
+               for k, rows in groupby(bound, key=lambda row: row[0])}
+
+    events = []
+    summary = []
+    pairs = [(max_disp, min_frames) for max_disp in max_disps
+             for min_frames in min_bound_frames]
+    for k, (max_disp, min_frames) in enumerate(pairs):
+        for frame_rate in frame_rates:
+            params = [max_disp, min_frames, frame_rate]
+            n_bound_trajectories = 0
+            dwell_times = []
+            for traj_ID, n_bound in by_pair.get(k, []):
+                if n_bound:
+                    n_bound_trajectories = n_bound_trajectories + 1
+                for event, frames in enumerate(n_bound):
+                    dwell_time = frame_rate * frames
+                    dwell_times.append(dwell_time)
+                    events.append(params + [int(traj_ID), event + 1,
+                                            dwell_time])
+            if dwell_times == []:
+                mean = median = np.nan
+            else:
+                mean = float(np.mean(dwell_times))
+                median = float(np.median(dwell_times))
+            summary.append(params + [
+                n_bound_trajectories / max(n_trajectories, 1),
+                len(dwell_times), mean, median])
+
+    return events, summary
+
+
+def _dwelltime_sweep_shard(shard, max_disps, min_bound_frames):
+    ''' Bound frames of the events of one shard of trajectories
+
+    Parameters:
+    shard            : (traj_ids, offsets, xy_data) tuple, see
+                       map_trajectory_shards
+    max_disps, min_bound_frames : see sweep_dwelltimes
+
+    Outputs:
+    bound            : list of [k, trajectory ID, list of the bound frames
+                       of each event], with k the index of the
+                       (max_disp, min_bound_frames) pair
+    '''
+
+    traj_ids, offsets, xy_data = shard
+
+    bound = []
+    for i, traj_ID in enumerate(traj_ids):
+        xy_coords = xy_data[offsets[i]:offsets[i + 1]]
+        tree = cKDTree(xy_coords) if len(xy_coords) else None
+        for j, max_disp in enumerate(max_disps):
+            counts = {}
+            for b, min_frames in enumerate(min_bound_frames):
+                k = j * len(min_bound_frames) + b
+                if max_disp <= 0 or tree is None:
+                    bound.append([k, traj_ID, []])
+                else:
+                    bound.append([k, traj_ID, _scan_binding_events(
+                        tree, xy_coords, max_disp, min_frames, counts)])
+
+    return bound
+
+
+def _binding_events(counts, min_bound_frames):
+    ''' Bound frames of each binding event, given the bound counts
+
+    The same scan as calc_dwelltime: an event starts at the first position
+    with more than min_bound_frames positions in reach and the scan resumes
+    after its bound frames. Only positions that can start an event are
+    visited.
+    '''
+
+    starts = np.flatnonzero(counts > min_bound_frames)
+    events = []
+    curr_row = 0
+    while True:
+        i = np.searchsorted(starts, curr_row)
+        if i == len(starts):
+            return events
+        curr_row = starts[i]
+        n_bound = int(counts[curr_row])
+        events.append(n_bound)
+        curr_row = curr_row + n_bound
+
+
+def map_trajectory_shards(shard_func, table, result_columns, workers=1,
+                          *args):
+    ''' Run a per-trajectory analysis over shards of a TrajectoryTable
+
+    Trajectories are independent, so the table is cut into contiguous
+    shards of whole trajectories with roughly equal row counts. Each shard
+    is sent as a compact (traj_ids, offsets, xy_data) tuple of arrays:
+    the IDs of its trajectories, their start offsets into xy_data (plus
+    the final stop), and the selected coordinate columns.
+
+    Parameters:
+    shard_func       : function
+                       module-level function called as
+                       shard_func(shard, *args), returning a list
+    table            : TrajectoryTable
+                       trajectories to analyze
+    result_columns   : list
+                       columns to send to the workers
+    workers          : int
+                       number of processes. With workers=1 everything runs
+                       in this process on a single shard
+    args             : extra arguments passed to shard_func
+
+    Outputs:
+    results          : the shard results concatenated in trajectory order
+    '''
+
+    n_shards = 1 if workers <= 1 else 4 * workers  # a few per worker
+    shards = _trajectory_shards(table, result_columns, n_shards)
+
+    if workers <= 1 or len(shards) <= 1:
+        shard_results = [shard_func(shard, *args) for shard in shards]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map returns results in submission, i.e. trajectory, order
+            shard_results = list(executor.map(
+                shard_func, shards, *[repeat(arg, len(shards))
+                                      for arg in args]))
+
+    return [row for shard_result in shard_results for row in shard_result]
+
+
+def _trajectory_shards(table, result_columns, n_shards):
+    ''' Cut a table into shards of whole trajectories
+
+    Parameters:
+    table            : TrajectoryTable
+    result_columns   : list of columns to keep in each shard
+    n_shards         : maximum number of shards
+
+    Outputs:
+    shards           : list of (traj_ids, offsets, xy_data) tuples
+    '''
+
+    selector = _column_selector(result_columns)
+    # split at trajectory starts closest to equal row counts
+    cuts = np.searchsorted(table.starts,
+                           np.linspace(0, len(table), n_shards + 1)[1:-1])
+    cuts = np.unique(np.concatenate(([0], cuts, [len(table.traj_ids)])))
+
+    shards = []
+    for first, last in zip(cuts[:-1], cuts[1:]):
+        row_start = table.starts[first]
+        row_stop = table.stops[last - 1]
+        offsets = np.append(table.starts[first:last],
+                            row_stop) - row_start
+        shards.append((table.traj_ids[first:last], offsets,
+                       table.data[row_start:row_stop, selector]))
+
+    return shards
+
+
+def iter_trajectory_chunks(file_in, query_column=1, chunk_rows=100000,
+                           delimiter=','):
+    """ Read a trajectory file in chunks of complete trajectories
+
+    The file is read chunk_rows rows at a time. The rows of the last
+    trajectory in a chunk may continue in the next chunk, so they are held
+    back and prepended to it; every other trajectory in the chunk is
+    complete and is yielded straight away. Memory use is bounded by the
+    chunk size plus the trajectory still open, not by the file size.
+
+    The rows of each trajectory must be contiguous, as in btrack's exports
+    (rows need not be sorted by ID). A trajectory that reappears after it
+    was yielded is an error.
+
+    Parameters:
+    file_in      : str
+                   trajectory file, CSV or binary (.npy, read through a
+                   memory map)
+    query_column : int
+                   column containing the trajectory IDs
+    chunk_rows   : int
+                   number of rows read at a time
+    delimiter    : str
+                   CSV column separator
+
+    Outputs:
+    tables       : generator of TrajectoryTables, each holding only
+                   complete trajectories
+    """
+
+    if file_in.endswith('.npy'):
+        columns, data = read_table(file_in)
+        chunks = (data[i:i + chunk_rows]
+                  for i in range(0, len(data), chunk_rows))
+    else:
+        try:
+            traj_file = open(file_in, 'r')
+        except FileNotFoundError:
+            print("Could not find file " + file_in)
+            sys.exit(1)
+        header = traj_file.readline()
+        columns = [name.strip() for name in header.split(delimiter)]
+        chunks = _csv_chunks(traj_file, len(columns), chunk_rows, delimiter)
+
+    return _complete_trajectories(chunks, columns, query_column)
+
+
+def _csv_chunks(traj_file, n_columns, chunk_rows, delimiter):
+    """ Parse an open CSV chunk_rows lines at a time """
+
+    with traj_file:
+        while True:
+            lines = list(islice(traj_file, chunk_rows))
+            if lines == []:
+                return
+            yield np.loadtxt(lines, delimiter=delimiter,
+                             ndmin=2).reshape(-1, n_columns)
+
+
+def _complete_trajectories(chunks, columns, query_column):
+    """ Regroup chunks of rows into tables of complete trajectories """
+
+    carry = np.zeros((0, len(columns)))
+    finished = set()
+    for chunk in chunks:
+        data = np.concatenate((carry, chunk))
+        traj_ids = data[:, query_column]
+        # the trailing run of the last ID may continue in the next chunk
+        open_from = len(data)
+        while open_from > 0 and traj_ids[open_from - 1] == traj_ids[-1]:
+            open_from = open_from - 1
+        carry = data[open_from:]
+        if open_from > 0:
+            yield _checked_table(columns, data[:open_from], query_column,
+                                 finished)
+
+    if len(carry) > 0:
+        yield _checked_table(columns, carry, query_column, finished)
+
+
+def _checked_table(columns, data, query_column, finished):
+    """ Table of complete trajectories, checking none were seen before """
+
+    table = TrajectoryTable(columns, data, query_column)
+    traj_ids = table.traj_ids.tolist()
+    # one run per ID, or a trajectory was split within the chunk
+    runs = 1 + np.count_nonzero(np.diff(data[:, query_column]))
+    if runs != len(traj_ids) or not finished.isdisjoint(traj_ids):
+        print("Trajectory rows must be contiguous to be streamed")
         sys.exit(1)
+    finished.update(traj_ids)
+
+    return table
+
+
+@profiled('stream_diffusion')
+def stream_diffusion(file_in, query_column, result_columns, deltaT=0.1,
+                     chunk_rows=100000, delimiter=','):
+    """ Streaming calc_diffusion: yields [trajectory ID, diffusion coeff]
+    rows as soon as each trajectory has been read
+
+    See iter_trajectory_chunks for how the file is read.
+    """
+
+    for table in iter_trajectory_chunks(file_in, query_column, chunk_rows,
+                                        delimiter):
+        yield from calc_diffusion(table, query_column, result_columns,
+                                  'all', deltaT)[1]
+
 
-    # begin analyzing trajectories
+@profiled('stream_dwelltimes')
+def stream_dwelltimes(file_in, query_column, result_columns, max_disp,
+                      min_bound_frames, frame_rate=0.1, chunk_rows=100000,
+                      delimiter=','):
+    """ Streaming calc_all_dwelltimes: yields [trajectory ID, dwell time]
+    rows as soon as each trajectory has been read
 
-    header = None
-    diffusion_coeffs = []  # initialize empty list to store diffusion coeffs
+    See iter_trajectory_chunks for how the file is read.
+    """
+
+    for table in iter_trajectory_chunks(file_in, query_column, chunk_rows,
+                                        delimiter):
+        yield from calc_all_dwelltimes(table, query_column, result_columns,
+                                       max_disp, min_bound_frames,
+                                       frame_rate)
+
+
+class EnsembleStats:
+    """ Fixed-memory accumulators of population-level trajectory statistics
+
+    Accumulates, over every trajectory added:
+    - the ensemble-averaged MSD(tau) for lags 1 to max_lag: the sum of the
+      squared displacements and the number of displacements at each lag
+    - a histogram of the single-frame jump distances, on fixed bins
+
+    Memory depends only on max_lag and the number of bins, however many
+    trajectories are added. Accumulators filled from different parts of a
+    file (e.g. by parallel workers) are combined with merge.
+
+    Attributes:
+    max_lag        : largest lag accumulated, in frames
+    deltaT         : time delay between frames, in seconds
+    jump_edges     : jump distance bin edges, in um
+    msd_sum        : sum of squared displacements (um^2) at lags 0..max_lag
+    msd_count      : number of displacements at lags 0..max_lag
+    jump_counts    : number of jumps in each bin
+    jump_overflow  : number of jumps beyond the last bin edge
+    n_trajectories : number of trajectories added
+    """
+
+    def __init__(self, max_lag=20, deltaT=0.1, jump_edges=None):
+        if jump_edges is None:
+            jump_edges = np.linspace(0, 2, 401)  # 5 nm bins up to 2 um
+        self.max_lag = int(max_lag)
+        self.deltaT = float(deltaT)
+        self.jump_edges = np.asarray(jump_edges, dtype=np.float64)
+        self.msd_sum = np.zeros(self.max_lag + 1)
+        self.msd_count = np.zeros(self.max_lag + 1, dtype=np.int64)
+        self.jump_counts = np.zeros(len(self.jump_edges) - 1,
+                                    dtype=np.int64)
+        self.jump_overflow = 0
+        self.n_trajectories = 0
+
+    def add(self, trajectory, xy_data):
+        """ Accumulate trajectories given row by row
+
+        Parameters:
+        trajectory : array of trajectory IDs, one per row; the rows of each
+                     trajectory must be contiguous and in time order
+        xy_data    : (N, 2) array of coordinates, in um
+        """
+
+        trajectory = np.asarray(trajectory)
+        xy_data = np.asarray(xy_data, dtype=np.float64)
+        if len(trajectory) == 0:
+            return
+        self.n_trajectories += 1 + np.count_nonzero(np.diff(trajectory))
+
+        for lag in range(1, min(self.max_lag, len(xy_data) - 1) + 1):
+            # pairs that straddle two trajectories are not displacements
+            same = trajectory[lag:] == trajectory[:-lag]
+            sq = np.sum((xy_data[lag:] - xy_data[:-lag])**2, axis=1)[same]
+            self.msd_sum[lag] += sq.sum()
+            self.msd_count[lag] += len(sq)
+            if lag == 1:
+                counts, _ = np.histogram(np.sqrt(sq), self.jump_edges)
+                self.jump_counts += counts
+                self.jump_overflow += int(np.count_nonzero(
+                    sq >= self.jump_edges[-1]**2))
+
+    def add_table(self, table, result_columns=(3, 4)):
+        """ Accumulate every trajectory of a TrajectoryTable (nm coords) """
+
+        self.add(table.trajectory,
+                 table.data[:, _column_selector(result_columns)] / 1000)
+
+    def merge(self, other):
+        """ Add the accumulators of another EnsembleStats into this one """
+
+        if self.max_lag != other.max_lag or self.deltaT != other.deltaT or \
+                not np.array_equal(self.jump_edges, other.jump_edges):
+            raise ValueError('Cannot merge EnsembleStats with different '
+                             'lags, deltaT or jump bins')
+        self.msd_sum += other.msd_sum
+        self.msd_count += other.msd_count
+        self.jump_counts += other.jump_counts
+        self.jump_overflow += other.jump_overflow
+        self.n_trajectories += other.n_trajectories
+
+        return self
+
+    def msd(self):
+        """ Ensemble MSD curve
+
+        Outputs:
+        lags       : lags 1..max_lag, in seconds
+        msd        : ensemble-averaged MSD at each lag, in um^2 (NaN for
+                     lags no trajectory reached)
+        counts     : number of displacements averaged at each lag
+        """
+
+        counts = self.msd_count[1:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            msd = self.msd_sum[1:] / counts
+        msd[counts == 0] = np.nan
+
+        return np.arange(1, self.max_lag + 1) * self.deltaT, msd, counts
+
+    def fit_msd(self, n_lags=4):
+        """ D and alpha of the ensemble MSD, fit as in fit_msd """
+
+        lags, msd, counts = self.msd()
+        valid = (counts > 0)[None, :n_lags]
+        tau = lags[None, :n_lags]
+        y = msd[None, :n_lags]
+        D = _masked_slope(tau, np.where(valid, y, 0), valid)[0] / 4
+        positive = valid & (y > 0)
+        alpha = _masked_slope(np.log(tau), np.log(np.where(positive, y, 1)),
+                              positive)[0]
+
+        return float(D), float(alpha)
+
+    def jump_distribution(self):
+        """ Jump distance probability density
+
+        Outputs:
+        centers    : bin centers, in um
+        density    : probability density (1/um); jumps past the last bin
+                     count towards the normalization
+        """
+
+        centers = (self.jump_edges[1:] + self.jump_edges[:-1]) / 2
+        total = self.jump_counts.sum() + self.jump_overflow
+        density = self.jump_counts / (max(total, 1) *
+                                      np.diff(self.jump_edges))
+
+        return centers, density
+
+    def fit_jump_distances(self, n_components=2, n_iter=1000, tol=1e-10):
+        """ Fit a mixture of 2D diffusive populations to the jump distances
+
+        Each population i contributes a fraction f_i of the jumps, with
+        distances distributed as
+            p_i(r) = r / (2 D_i tau) * exp(-r^2 / (4 D_i tau))
+        The fractions and coefficients are found by expectation
+        maximization on the binned histogram.
+
+        Outputs:
+        D          : diffusion coefficient of each population (um^2/s),
+                     ascending
+        fractions  : fraction of jumps in each population
+        """
+
+        r = (self.jump_edges[1:] + self.jump_edges[:-1]) / 2
+        counts = self.jump_counts.astype(np.float64)
+        total = counts.sum()
+        tau = self.deltaT
+        if total == 0:
+            return (np.full(n_components, np.nan),
+                    np.full(n_components, np.nan))
+
+        # start from populations spread around the mean squared jump
+        D_mean = np.sum(counts * r**2) / (4 * tau * total)
+        D = D_mean * np.logspace(-1, 1, n_components)
+        fractions = np.full(n_components, 1 / n_components)
+        for _ in range(n_iter):
+            p = fractions[:, None] * r / (2 * D[:, None] * tau) * \
+                np.exp(-r**2 / (4 * D[:, None] * tau))
+            weights = counts * p / np.maximum(p.sum(axis=0), 1e-300)
+            n_i = np.maximum(weights.sum(axis=1), 1e-300)
+            D_new = np.sum(weights * r**2, axis=1) / (4 * tau * n_i)
+            fractions = n_i / total
+            converged = np.max(np.abs(D_new - D) / D) < tol
+            D = D_new
+            if converged:
+                break
+
+        order = np.argsort(D)
+        return D[order], fractions[order]
+
+
+@profiled('ensemble_stats')
+def ensemble_stats(file_in, query_column, result_columns, deltaT=0.1,
+                   max_lag=20, jump_edges=None, chunk_rows=100000,
+                   workers=1):
+    """ Accumulate EnsembleStats over a trajectory file in one pass
+
+    The file is streamed in chunks of whole trajectories (see
+    iter_trajectory_chunks), so neither the file nor any per-trajectory
+    list is held in memory. With workers > 1 the chunks are accumulated
+    on a process pool and the partial accumulators are merged.
+
+    Parameters:
+    file_in          : trajectory file to process, or a TrajectoryTable
+    query_column     : column containing the trajectory IDs
+    result_columns   : columns containing the X and Y coordinates (nm)
+    deltaT           : time delay between frames, in seconds
+    max_lag          : largest lag of the ensemble MSD, in frames
+    jump_edges       : jump distance histogram bin edges, in um
+    chunk_rows       : number of rows read at a time
+    workers          : number of processes
+
+    Outputs:
+    stats            : EnsembleStats
+    """
+
+    stats = EnsembleStats(max_lag, deltaT, jump_edges)
+    if isinstance(file_in, TrajectoryTable):
+        chunks = [file_in.group_by(query_column)]
+    else:
+        chunks = iter_trajectory_chunks(file_in, query_column, chunk_rows)
+
+    selector = _column_selector(result_columns)
+    # only IDs and coordinates are sent to the workers
+    parts = ((table.trajectory, table.data[:, selector] / 1000)
+             for table in chunks)
+    for partial in _threaded_map(_ensemble_chunk, parts, workers, max_lag,
+                                 deltaT, stats.jump_edges,
+                                 executor_class=ProcessPoolExecutor):
+        stats.merge(partial)
+    PROFILER.count('trajectories', stats.n_trajectories)
+
+    return stats
+
+
+def _ensemble_chunk(part, max_lag, deltaT, jump_edges):
+    """ EnsembleStats of one (trajectory IDs, xy in um) chunk """
+
+    stats = EnsembleStats(max_lag, deltaT, jump_edges)
+    stats.add(*part)
+    return stats
+
+
+class LiveTrajectoryStats:
+    """ Per-trajectory diffusion coefficients and dwell times, updated as
+    rows arrive
+
+    Rows can be added in any number of batches, in the order they are
+    written; the rows of a trajectory need not be contiguous. Each
+    trajectory keeps:
+    - the running sum of its squared lag-1 steps, so its diffusion
+      coefficient is that of calc_diffusion for the rows seen so far
+    - its positions and, for every position, the number of positions within
+      max_disp of it. A new position only needs its distances to the
+      positions of its own trajectory, and the dwell times follow from these
+      counts exactly as in calc_dwelltime
+
+    Attributes:
+    deltaT           : time delay between frames, in seconds
+    max_disp         : see calc_dwelltime
+    min_bound_frames : see calc_dwelltime
+    query_column     : column containing the trajectory IDs
+    result_columns   : columns containing the X and Y coordinates (nm)
+    trajectories     : trajectory ID -> _LiveTrajectory
+    n_rows           : number of rows added
+    """
 
-    if traj_ID == 'all':
-        all_trajs = []  # initialize empty list for trajectory IDs
+    def __init__(self, deltaT=0.1, max_disp=200, min_bound_frames=10,
+                 query_column=1, result_columns=(3, 4)):
+        self.deltaT = float(deltaT)
+        self.max_disp = max_disp
+        self.min_bound_frames = min_bound_frames
+        self.query_column = query_column
+        self.result_columns = result_columns
+        self.trajectories = {}
+        self.n_rows = 0
+
+    @profiled('LiveTrajectoryStats.add_rows')
+    def add_rows(self, data):
+        """ Add a batch of rows (as read from the trajectory file)
+
+        Outputs:
+        changed    : IDs of the trajectories that received rows
+        """
+
+        if len(data) == 0:
+            return np.zeros(0, dtype=np.int64)
+        data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+        PROFILER.count('rows', len(data))
+        self.n_rows = self.n_rows + len(data)
+
+        traj_ids = data[:, self.query_column].astype(np.int64)
+        xy_data = data[:, _column_selector(self.result_columns)]
+        # group the rows by trajectory, keeping each trajectory in order
+        order = np.argsort(traj_ids, kind='stable')
+        changed, starts = np.unique(traj_ids[order], return_index=True)
+        stops = np.append(starts[1:], len(order))
+        for traj_ID, start, stop in zip(changed, starts, stops):
+            trajectory = self.trajectories.get(int(traj_ID))
+            if trajectory is None:
+                trajectory = self.trajectories[int(traj_ID)] = \
+                    _LiveTrajectory()
+            trajectory.add(xy_data[order[start:stop]], self.max_disp)
+
+        return changed
+
+    def diffusion(self):
+        """ [trajectory ID, diffusion coeff] rows, as from calc_diffusion """
+
+        return [[traj_ID, float(trajectory.msd() / (4 * self.deltaT))]
+                for traj_ID, trajectory in sorted(self.trajectories.items())]
+
+    def dwelltimes(self):
+        """ [trajectory ID, dwell time] rows, as from calc_all_dwelltimes """
+
+        rows = []
+        for traj_ID, trajectory in sorted(self.trajectories.items()):
+            dwell_time = None
+            if self.max_disp > 0:
+                events = trajectory.events(self.min_bound_frames)
+                dwell_time = [self.deltaT * n_bound for n_bound in events]
+            rows.extend(_dwelltime_rows(traj_ID, dwell_time or None))
+
+        return rows
+
+    def summary(self, bins=20):
+        """ Summary statistics and histograms of the current results
+
+        Outputs:
+        summary    : dict of the number of rows, trajectories and binding
+                     events, the bound fraction, the mean and median of the
+                     diffusion coefficients and dwell times, and their
+                     histograms ('counts' and bin 'edges')
+        """
+
+        D = result_values(self.diffusion())
+        D = D[np.isfinite(D)]
+        dwell_times = result_values(self.dwelltimes())
+        n_trajectories = len(self.trajectories)
+        n_bound = sum(1 for trajectory in self.trajectories.values()
+                      if self.max_disp > 0 and
+                      trajectory.events(self.min_bound_frames))
+
+        summary = {'rows': self.n_rows,
+                   'trajectories': n_trajectories,
+                   'binding_events': len(dwell_times),
+                   'bound_fraction': n_bound / max(n_trajectories, 1)}
+        for name, values in [('diffusion_coeff', D),
+                             ('dwell_time', dwell_times)]:
+            counts, edges = np.histogram(values, bins)
+            summary[name] = {
+                'mean': float(np.mean(values)) if len(values) else None,
+                'median': float(np.median(values)) if len(values) else None,
+                'counts': counts.tolist(),
+                'edges': edges.tolist()}
+
+        return summary
+
+
+class _LiveTrajectory:
+    """ Growing positions and accumulators of one trajectory """
+
+    __slots__ = ('xy', 'counts', 'n', 'last_r', 'sum_sq', '_events')
+
+    def __init__(self):
+        self.xy = np.zeros((16, 2))
+        self.counts = np.zeros(16, dtype=np.int64)
+        self.n = 0
+        self.last_r = None
+        self.sum_sq = 0.0
+        self._events = None
+
+    def add(self, xy_data, max_disp):
+        """ Append positions (nm) in time order """
+
+        # lag-1 steps of r, as in _msd_by_trajectory (um)
+        um = xy_data / 1000
+        r = np.sqrt(um[:, 0]**2 + um[:, 1]**2)
+        if self.last_r is not None:
+            r = np.concatenate(([self.last_r], r))
+        self.sum_sq += float(np.sum(np.diff(r)**2))
+        self.last_r = r[-1]
+
+        n, k = self.n, len(xy_data)
+        if n + k > len(self.xy):
+            capacity = max(2 * len(self.xy), n + k)
+            self.xy = np.resize(self.xy, (capacity, 2))
+            self.counts = np.resize(self.counts, capacity)
+        self.xy[n:n + k] = xy_data
+        self.n = n + k
+        self._events = None
+
+        # distances of the new positions to every position so far; each
+        # pair is counted for both of its positions
+        xy_all = self.xy[:n + k]
+        block = max(1, 2**20 // (n + k))
+        for start in range(0, k, block):
+            rows = xy_all[n + start:n + start + block]
+            disp = np.sqrt(np.sum((xy_all[None, :, :] -
+                                   rows[:, None, :])**2, axis=2))
+            within = disp < max_disp
+            self.counts[n + start:n + start + len(rows)] = within.sum(axis=1)
+            self.counts[:n] += within[:, :n].sum(axis=0)
+
+    def msd(self):
+        """ Lag-1 MSD (um^2); NaN with fewer than two positions """
+
+        return self.sum_sq / (self.n - 1) if self.n > 1 else np.nan
+
+    def events(self, min_bound_frames):
+        """ Bound frames of each binding event, as in calc_dwelltime """
+
+        if self._events is None or self._events[0] != min_bound_frames:
+            self._events = (min_bound_frames, _binding_events(
+                self.counts[:self.n], min_bound_frames))
+
+        return self._events[1]
+
+
+async def tail_csv(file_in, delimiter=',', poll_interval=0.5,
+                   idle_timeout=None, stop=None):
+    """ Follow a growing CSV file, yielding the rows appended to it
+
+    The file is read from where the previous read stopped, so it is never
+    re-scanned. Only complete lines are parsed; a partly written last line
+    waits for the next poll. The header line is skipped.
 
-        # for loop to pull out all trajectory IDs
-        for line in traj_file:
-            if header is None:
-                header = line
-                continue
-            currLine = line.rstrip().split(',')
-            all_trajs.append(int(currLine[query_column]))
-
-        # convert to np array to use unique function
-        all_trajs = np.array(all_trajs)
-        all_trajs_unique = np.unique(all_trajs)  # yields only unique traj IDs
-
-        dataOut = []
-        for traj in np.nditer(all_trajs_unique):
-            traj_file.seek(0)  # reset file to the beginning!
-            for line in traj_file:
-                if header is None:
-                    header = line
-                    continue
-                currLine = line.rstrip().split(',')
-                if currLine[query_column] == str(traj):
-                    data = []
-                    for j in result_columns:
-                        data.append(currLine[j])
-                    dataOut.append(data)
-
-            # calculate mean squared displacement(MSD) for each trajectory:
-
-            # first, transform dataOut to numpy array to make it easier to index
-
-            dataOut2 = np.array(dataOut)
-            xdata = []
-            ydata = []
-            for i in range(len(dataOut2)):
-                xdata.append(float(dataOut2[i,0]))
-            for i in range(len(dataOut2)):
-                ydata.append(float(dataOut2[i,1]))
-
-            # convert back to np array (can't do below math on a list)
-            xdata = np.array(xdata)/1000  # converting from nm to um
-            ydata = np.array(ydata)/1000  # converting from nm to um
-            # now, calculate the displacements
-            r = np.sqrt(xdata**2 + ydata**2)
-            diff = np.diff(r)  # this calculates r(t + dt) - r(t)
-            diff_sq = diff**2
-            MSD = np.mean(diff_sq)
-
-            # diffusion can now be computed
-            traj_diff = (MSD)/(4 * deltaT)  # final trajectory diffusion
-
-            # append traj ID and diffusion coeff to final list
-            temp = [int(traj), traj_diff]
-            diffusion_coeffs.append(temp)
+    Parameters:
+    file_in       : str
+                    CSV file being written (it may not exist yet)
+    delimiter     : str
+                    column separator
+    poll_interval : float
+                    seconds between checks for new data
+    idle_timeout  : float
+                    stop after this many seconds without new data; None to
+                    follow the file until stop is set
+    stop          : asyncio.Event
+                    set to stop following the file
 
+    Outputs:
+    yields a (rows, columns) float array on every poll; empty when nothing
+    complete was appended
+    """
 
-    else:
-        # analyze a single trajectory
-        dataOut = []
-        for line in traj_file:
-            if header is None:
-                header = line
-                continue
-            currLine = line.rstrip().split(',')
-            if currLine[query_column] == str(traj_ID):
-                data = []
-                for j in result_columns:
-                    data.append(currLine[j])
-                dataOut.append(data)
-
-        # calculate mean squared displacement(MSD) for a single trajectory
-        # all equations / workflow are the same as above
-
-        dataOut2 = np.array(dataOut)
-        xdata = []
-        ydata = []
-        for i in range(len(dataOut2)):
-            xdata.append(float(dataOut2[i,0]))
-        for i in range(len(dataOut2)):
-            ydata.append(float(dataOut2[i,1]))
-
-        # convert back to np array (can't do below math on a list)
-        xdata = np.array(xdata)/1000  # converting from nm to um (convention)
-        ydata = np.array(ydata)/1000  # converting from nm to um (convention)
-        # now, calculate the displacements
-        r = np.sqrt(xdata**2 + ydata**2)
-        diff = np.diff(r) #this calculates r(t + dt) - r(t)
-        diff_sq = diff**2
-        MSD = np.mean(diff_sq)
-
-        # diffusion can now be computed
-        diffusion_coeffs = (MSD)/(4 * deltaT)
-
-    traj_file.close()
+    loop = asyncio.get_running_loop()
+    last_data = loop.time()
+    traj_file = None
+    columns = None
+    offset = 0
+    pending = b''
+    try:
+        while stop is None or not stop.is_set():
+            if traj_file is None and os.path.exists(file_in):
+                traj_file = open(file_in, 'rb')
+
+            chunk = b''
+            if traj_file is not None:
+                if os.path.getsize(file_in) < offset:
+                    print(file_in + ' was rewritten; stopped following it')
+                    return
+                chunk = await loop.run_in_executor(None, traj_file.read)
+                offset = offset + len(chunk)
+            PROFILER.count('bytes_read', len(chunk))
+
+            pending = pending + chunk
+            complete = pending[:pending.rfind(b'\n') + 1]
+            pending = pending[len(complete):]
+            if columns is None and complete:
+                header, complete = complete.split(b'\n', 1)
+                columns = header.decode().split(delimiter)
+
+            if complete.strip():
+                last_data = loop.time()
+                yield np.loadtxt(io.StringIO(complete.decode()),
+                                 delimiter=delimiter, ndmin=2)
+            else:
+                if idle_timeout is not None and \
+                        loop.time() - last_data > idle_timeout:
+                    return
+                yield np.zeros((0, len(columns or [])))
+                await asyncio.sleep(poll_interval)
+    finally:
+        if traj_file is not None:
+            traj_file.close()
 
-    return dataOut, diffusion_coeffs
 
+async def watch_trajectories(file_in, stats, publish, interval=5.0,
+                             poll_interval=0.5, idle_timeout=None, stop=None,
+                             delimiter=','):
+    """ Live analysis of a trajectory file while it is being written
 
-def calc_dwelltime(xy_data, max_disp, min_bound_frames, frame_rate=0.1):
-    """ Calculate particle dwell time
+    New rows are fed to stats as they appear (see tail_csv) and
+    publish(stats) is called at most every interval seconds when something
+    changed, and once more at the end.
 
-    Inputs:
-    ----
-    xy_data           : list
-                       list of xy coordinates for each particle
-    max_disp         : int
-                       maxium displacement a particle travels between frames
-    min_bound_frames : int
-                       minimum number of frames a particle can be bound for;
-                       removes spurrious binding events/false positives
-    frame_rate       : int
-                       time delay between each frame, in seconds.
-                       Defaults to 0.1 sec
+    Parameters:
+    file_in       : str
+                    trajectory CSV being written, e.g. by write_csv or
+                    btrack's export_CSV
+    stats         : LiveTrajectoryStats (or anything with add_rows)
+    publish       : function or coroutine function called with stats
+    interval      : float
+                    minimum seconds between two publications
+    poll_interval, idle_timeout, stop, delimiter : see tail_csv
 
     Outputs:
-    ----
-    dwell_times     : int
-                      particle dwell time
-
+    stats         : the final statistics
     """
 
-    bound_frames = []
-    curr_row = 0
-    done = False
-
-    # first, compute all displacements
-    all_displacements = squareform(pdist(xy_data))
-    # use a while loop to loop through the xydata
-    while done == False:
-        # find points that are less than the threshold distance
-        bound_states = []
-        for displacement in range(len(all_displacements)):
-            if all_displacements[displacement, curr_row] < max_disp:
-                state = 1  # particle is bound
-            else:
-                state = 0  # particle is unbound
-            bound_states.append(state)
-        bound_states = np.array(bound_states)
-
-        # get the index of the last unbound element;
-        # this allows us to compute how many frames the particle was bound
-        consec_ones = np.flatnonzero(bound_states == 1)
-        if len(consec_ones) > min_bound_frames:
-            is_bound = True
-            curr_row = len(consec_ones) + curr_row
-            bound_frames.append(consec_ones)
-        else:
-            curr_row = curr_row + 1
-
-        if curr_row >= len(xy_data):
-            done = True
+    async def call_publish():
+        result = publish(stats)
+        if inspect.isawaitable(result):
+            await result
 
-    # now, turn the length of the bound index into an actual dwell time
-    # first, convert bound_frames to array to use array indexing
-    # note - dtype argument removes numpy deprecation warning
-    bound_frames = np.array(bound_frames, dtype=object)
+    loop = asyncio.get_running_loop()
+    last_publish = loop.time()
+    changed = False
+    async for rows in tail_csv(file_in, delimiter, poll_interval,
+                               idle_timeout, stop):
+        if len(rows):
+            stats.add_rows(rows)
+            changed = True
+        if changed and loop.time() - last_publish >= interval:
+            await call_publish()
+            last_publish = loop.time()
+            changed = False
 
-    dwell_times = []
-    for event in range(len(bound_frames)):
-        dwell_time = frame_rate * len(bound_frames[event])
-        dwell_times.append(dwell_time)
+    await call_publish()
 
-    if dwell_times == []:
-        return None
-
-    return dwell_times
+    return stats
 
 
-def get_xy_coords(file_in, query_column, result_columns, traj_ID):
-    ''' Helper function for extracting a particle's XY coordinates
+@profiled('bootstrap_ci')
+def bootstrap_ci(values, statistic='mean', n_resamples=2000,
+                 confidence=0.95, seed=0, t_min=0, workers=1,
+                 batch_size=None, frame_rate=0):
+    """ Bootstrap confidence interval of a statistic of a distribution
 
-    With a given CSV file containing trajectory info, loop through all of the
-    tracks and extract their XY coordinates.
+    Resamples are drawn in batches as (batch_size, len(values)) index
+    matrices and each batch's statistics are computed in one vectorized
+    call. Each batch draws from its own seed, spawned from seed, so the
+    result depends only on seed (not on workers).
 
     Parameters:
-    file_in          : str
-                       trajectory file to process
-    query_column     : int
-                       column containing the trajectory IDs
-    result_columns   : int
-                       columns containing the X and Y coordinates, respectively
-    traj_ID          : int
-                       trajectory to analyze (note: unlike calc_diffusion, this
-                       only calls a signel trajectory at a time)
+    values       : array of values, e.g. diffusion coefficients or dwell
+                   times. NaNs are ignored
+    statistic    : 'mean', 'median', or 'k_off' (maximum likelihood off
+                   rate of an exponential dwell time distribution starting
+                   at t_min: 1 / (mean - t_min), or of its geometric
+                   per-frame form if frame_rate is given)
+    n_resamples  : number of bootstrap resamples
+    confidence   : confidence level of the (percentile) interval
+    seed         : seed of the random number generator
+    t_min        : shortest observable dwell time, for 'k_off'
+    workers      : number of processes to draw batches on
+    batch_size   : resamples per batch; by default, as many as fit in
+                   about 2**22 drawn values (which stay cache friendly)
+    frame_rate   : time between frames, for 'k_off' of dwell times counted
+                   in whole frames: log(1 + frame_rate / (mean - t_min)) /
+                   frame_rate. By default (0), dwell times are continuous
 
     Outputs:
-    xy_coords          : list
-                         X & Y coordinates of the particle while it exists
-    '''
-
-    # check that the file exists
-    try:
-        traj_file = open(file_in, 'r')  # open file with traj info
-    except FileNotFoundError:
-        print("Could not find file " + file_in)
-        sys.exit(1)
-
-    # begin analyzing trajectories
-    header = None
-    xy_coords = []
-    for line in traj_file:
-        if header is None:
-            header = line
-            continue
-        currLine = line.rstrip().split(',')
-        if currLine[query_column] == str(traj_ID):
-            data = []
-            for j in result_columns:
-                data.append(float(currLine[j]))
-            xy_coords.append(data)
+    estimate     : the statistic of values
+    low, high    : bounds of the confidence interval
+    """
 
-    traj_file.close()
+    values = np.asarray(values, dtype=np.float64)
+    values = np.sort(values[~np.isnan(values)])
+    if len(values) == 0:
+        return np.nan, np.nan, np.nan
+
+    estimate = _bootstrap_statistic(values[None, :], statistic, t_min,
+                                    frame_rate)[0]
+    if batch_size is None:
+        batch_size = max(1, min(n_resamples, 2**22 // len(values)))
+    sizes = [batch_size] * (n_resamples // batch_size)
+    if n_resamples % batch_size:
+        sizes.append(n_resamples % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    resampled = np.concatenate(list(_threaded_map(
+        _bootstrap_batch, zip(sizes, seeds), workers, values, statistic,
+        t_min, frame_rate, executor_class=ProcessPoolExecutor)))
+    PROFILER.count('resamples', n_resamples)
+    low, high = np.percentile(resampled, [50 * (1 - confidence),
+                                          50 * (1 + confidence)])
+
+    return float(estimate), float(low), float(high)
+
+
+def _bootstrap_batch(batch, values, statistic, t_min, frame_rate):
+    """ Statistics of one batch of bootstrap resamples """
+
+    size, seed = batch
+    rng = np.random.default_rng(seed)
+    index = rng.integers(0, len(values), (size, len(values)),
+                         dtype=np.int32)
+    if statistic == 'median':
+        # values are sorted, so sorting the (smaller, integer) indices
+        # puts the middle draws in the middle of each row
+        index.sort(axis=1)
+        middle = [(len(values) - 1) // 2, len(values) // 2]
+        return values[index[:, middle]].mean(axis=1)
+    return _bootstrap_statistic(values[index], statistic, t_min,
+                                frame_rate)
+
+
+def _bootstrap_statistic(samples, statistic, t_min, frame_rate=0):
+    """ Statistic of each row of a (resamples, values) matrix """
+
+    if statistic == 'mean':
+        return samples.mean(axis=1)
+    if statistic == 'median':
+        return np.median(samples, axis=1)
+    if statistic == 'k_off':
+        with np.errstate(divide='ignore'):
+            excess = samples.mean(axis=1) - t_min
+            if frame_rate > 0:
+                # dwells are whole frames: a geometric distribution
+                return np.log1p(frame_rate / excess) / frame_rate
+            return 1 / excess
+    raise ValueError('Unknown bootstrap statistic ' + str(statistic))
+
+
+def result_values(rows):
+    """ Numeric results of [trajectory ID, result] rows, as an array
+
+    Missing results (None) are dropped. For dwell times, each binding
+    event is counted once: the list row of a multi-event trajectory only
+    repeats the values of its decimal-ID rows.
+    """
 
-    return xy_coords
+    return np.array([value for _, value in rows
+                     if value is not None and not isinstance(value, list)],
+                    dtype=np.float64)
 
 
+@profiled('process_image')
 def process_image(file_name, blurIter=1, gBlur=True,
-                  out_name='out_processed.tif'):
+                  out_name='out_processed.tif', keep_frames=True, workers=1):
     '''Use image analysis algorithms to clean up signal from images
 
     Requirements:
@@ -353,44 +2410,165 @@ def process_image(file_name, blurIter=1, gBlur=True,
     tif stack: A virtual stack of tagged image files (tif) images 
                  : in this case it is likely to be a timeseries of fluorescence data
 
+    Frames are streamed one at a time from the input stack, through the
+    filters and into the output stack, so memory use does not grow with
+    the length of the movie (unless keep_frames is set).
+
     Parameters:
     file_name    :string: Name of the file to be processed
     blurIter    :integer: Number of iterations the gaussian blur should be applied
     gBlur    :boolean: Decider for gaussian blur application
+    out_name    :string: Name of the processed tif stack to write
+    keep_frames    :boolean: Keep and return the processed frames
+    workers    :integer: Number of threads filtering frames concurrently;
+                frames are still written in order
 
     Outputs:
-    results    :List of numpy arrays (frames) extracted from the given video file
+    results    :List of numpy arrays (frames) extracted from the given video
+                file, or the number of frames written if keep_frames is False
     '''
     results = []
+    n_frames = 0
 
     try:
-        images = read_tif(file_name)
-        for i in range(len(images)):
-            img = images[i]
-            if gBlur:
-                img = cv.GaussianBlur(img, (5, 5), blurIter)
-            img = cv.Laplacian(img, cv.CV_64F)
-            img = np.uint16(np.absolute(img))  #convert back to 16bit to save as a readable tif stack
-            print('.', end='')
-            results.append(img)
+        with tifffile.TiffWriter(out_name) as tif:
+            for img in filter_frames(iter_tif(file_name), blurIter, gBlur,
+                                     workers):
+                print('.', end='')
+                tif.write(img, contiguous=True)
+                n_frames = n_frames + 1
+                PROFILER.count('frames')
+                if keep_frames:
+                    results.append(img)
     except FileNotFoundError:
         print("Could not find file " + file_name)
         sys.exit(1)
-    finally:
-        with tifffile.TiffWriter(out_name) as tif:  # may want to refactor is used twice
-            for frame in results:
-                tif.save(frame, contiguous=True)
 
+    PROFILER.count_file('bytes_read', file_name)
+    PROFILER.count_file('bytes_written', out_name)
+    if not keep_frames:
+        return n_frames
 
     return results
 
 
-def extract_features(data, out_name='out_features.tif'):
+def filter_frames(frames, blurIter=1, gBlur=True, workers=1):
+    '''Lazily apply the process_image filters to a sequence of frames
+
+    Parameters:
+    frames    :iterable of numpy arrays: Frames to be processed
+    blurIter    :integer: Number of iterations the gaussian blur should be
+                applied
+    gBlur    :boolean: Decider for gaussian blur application
+    workers    :integer: Number of threads filtering frames concurrently
+
+    Yields:
+    img    :numpy array: Processed 16bit frame, one at a time, in input order
+    '''
+    return _threaded_map(_filter_frame, frames, workers, blurIter, gBlur)
+
+
+def _threaded_map(func, items, workers=1, *args,
+                  executor_class=ThreadPoolExecutor):
+    '''Lazily map func over items on a thread pool, keeping input order
+
+    OpenCV releases the GIL while it works, so threads filter frames in
+    parallel. At most 2 * workers items are in flight at once, which keeps
+    memory bounded when items is a stream of frames.
+
+    Parameters:
+    func    :function: Called as func(item, *args)
+    items    :iterable: Items to map over
+    workers    :integer: Number of threads; 1 runs func in this thread
+    executor_class    :class: ThreadPoolExecutor, or ProcessPoolExecutor
+                        for pure-Python work (func must then be picklable)
+
+    Yields:
+    func(item, *args) for every item, in order
+    '''
+    if workers <= 1:
+        for item in items:
+            yield func(item, *args)
+        return
+
+    with executor_class(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item, *args))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _filter_frame(img, blurIter=1, gBlur=True):
+    '''Gaussian blur + Laplacian of a single frame'''
+    if gBlur:
+        img = cv.GaussianBlur(img, (5, 5), blurIter)
+    img = cv.Laplacian(img, cv.CV_64F)
+    # convert back to 16bit to save as a readable tif stack
+    return np.uint16(np.absolute(img))
+
+
+@profiled('process_and_extract_features')
+def process_and_extract_features(file_name, blurIter=1, gBlur=True,
+                                 processed_name=None,
+                                 out_name='out_features.tif', workers=1):
+    '''Process a tif stack and extract its features in one pass
+
+    Frames flow straight from the filters of process_image into the blob
+    detection of extract_features, one at a time, without writing the
+    processed stack and reading it back.
+
+    Parameters:
+    file_name    :string: Name of the tif stack to be processed
+    blurIter    :integer: Number of iterations the gaussian blur should be
+                applied
+    gBlur    :boolean: Decider for gaussian blur application
+    processed_name    :string: If given, also write the processed stack
+                       (as process_image would) to this file
+    out_name    :string: Name of the annotated tif stack to write
+    workers    :integer: Number of threads for filtering and detection
+
+    Outputs:
+    results    :Feature table, as returned by extract_features
+    '''
+    try:
+        frames = filter_frames(iter_tif(file_name), blurIter, gBlur, workers)
+        if processed_name is None:
+            return extract_features(frames, out_name, workers)
+        with tifffile.TiffWriter(processed_name) as tif:
+            return extract_features(_write_through(frames, tif), out_name,
+                                    workers)
+    except FileNotFoundError:
+        print("Could not find file " + file_name)
+        sys.exit(1)
+
+
+def _write_through(frames, tif):
+    '''Write every frame to an open TiffWriter before passing it on'''
+    for frame in frames:
+        tif.write(frame, contiguous=True)
+        yield frame
+
+
+@profiled('extract_features')
+def extract_features(data, out_name='out_features.tif', workers=1):
     '''
     Ues opencv blob detection to find features from numpy arrays
-    
+
+    Frames are consumed one at a time and each annotated frame is written
+    as soon as it is done, so data can be a generator (see iter_tif and
+    filter_frames) and memory use stays bounded.
+
+    With workers > 1, frames are detected concurrently on a thread pool,
+    each thread using its own SimpleBlobDetector; keypoints are merged and
+    frames written in frame order, so the results are unchanged.
+
     Inputs:
-    data - List of numpy arrays (frames)
+    data - List, array or iterator of numpy arrays (frames)
+    out_name - :string: Name of the annotated tif stack to write
+    workers - :integer: Number of threads detecting frames concurrently
 
     Outputs:
     results    :Array of arrays with structure as follows
@@ -401,81 +2579,553 @@ def extract_features(data, out_name='out_features.tif'):
         print('No data passed to detect features.')
         sys.exit(1)
     results = [['t', 'x', 'y', 'z']]
-    params = cv.SimpleBlobDetector_Params()
-    params.minArea = 0
-    params.maxArea = 10000
-    detector = cv.SimpleBlobDetector_create(params)
-    i = 0
-    out_frames = []
-    for frame in data:
-        # Detect blobs by thresholding converting to 8bit and using cv blob detector.
-        # Ret is a return that is the threshold used.
-        ret, thresh = cv.threshold(frame, 5, 100, cv.THRESH_BINARY)
-        img8 = thresh.astype('uint8')
-        keypoints = detector.detect(img8)
-        out = frame
-        for kp in keypoints:
-            results.append([i, int(kp.pt[0]), int(kp.pt[1]), 0])
-            cv.circle(out, (int(kp.pt[0]), int(kp.pt[1])), int(kp.size/4), (255, 0 ,0), 2)
-        out_frames.append(out)
-        i = i + 1
-
     with tifffile.TiffWriter(out_name) as tif:
-        for frame in out_frames:
-            tif.save(frame, contiguous=True)
+        detected = _threaded_map(_detect_blobs, data, workers)
+        for i, (frame, keypoints) in enumerate(detected):
+            out = frame
+            if not out.flags.writeable:
+                # e.g. a frame memory-mapped read-only by memmap_tif
+                out = frame.copy()
+            for kp in keypoints:
+                results.append([i, int(kp.pt[0]), int(kp.pt[1]), 0])
+                cv.circle(out, (int(kp.pt[0]), int(kp.pt[1])),
+                          int(kp.size/4), (255, 0, 0), 2)
+            tif.write(out, contiguous=True)
+            PROFILER.count('frames')
+            PROFILER.count('features', len(keypoints))
+    PROFILER.count_file('bytes_written', out_name)
 
     return results
 
 
-def track_csv(file_name='results.csv', out='track_results.csv'):
-    # NOTE(arl): This should be from your image segmentation code
-    objects = import_CSV(file_name)
+# blob detection settings used by extract_features
+BLOB_DETECTOR_PARAMS = {'threshold': 5, 'max_value': 100,
+                        'minArea': 0, 'maxArea': 10000}
+
+# one blob detector per thread; detectors are not shared between threads
+_detectors = threading.local()
+
+
+def _detect_blobs(frame):
+    '''Detect blobs in a single frame with this thread's detector
+
+    Returns the frame and its keypoints.
+    '''
+    detector = getattr(_detectors, 'detector', None)
+    if detector is None:
+        params = cv.SimpleBlobDetector_Params()
+        params.minArea = BLOB_DETECTOR_PARAMS['minArea']
+        params.maxArea = BLOB_DETECTOR_PARAMS['maxArea']
+        detector = cv.SimpleBlobDetector_create(params)
+        _detectors.detector = detector
+
+    # Detect blobs by thresholding converting to 8bit and using cv blob
+    # detector. Ret is a return that is the threshold used.
+    ret, thresh = cv.threshold(frame, BLOB_DETECTOR_PARAMS['threshold'],
+                               BLOB_DETECTOR_PARAMS['max_value'],
+                               cv.THRESH_BINARY)
+    img8 = thresh.astype('uint8')
+    keypoints = detector.detect(img8)
+
+    return frame, keypoints
+
+
+@profiled('track_csv')
+def track_csv(file_name='results.csv', out='track_results.csv',
+              config='config_test.json', window=None, overlap=10,
+              volume=None, tiles=None, tile_overlap=20, workers=None):
+    """ Link features into tracks with btrack
+
+    By default the whole movie is tracked in one btrack session and
+    written by btrack's export_CSV, with btrack's track IDs. Long movies
+    can instead be tracked in overlapping time windows, and wide fields of
+    view in overlapping spatial tiles (or both); each window or tile is
+    tracked on its own, in parallel over workers processes, and the tracks
+    are joined across the overlaps into global IDs (see _track_regions).
+    These tracks are numbered in the order they start, so regions that
+    find the same tracks write the same file whatever the windows, tiles
+    or workers.
+
+    Windows and tiles bound what btrack holds, not the whole run: each
+    btrack session (its objects, hypotheses and optimizer) only covers one
+    region, and at most workers sessions run at once. The features table,
+    the tracks returned by every region and the joined tracks are still
+    held in memory for the whole movie, so memory stays linear in the
+    number of features; what windows and tiles remove is the cost of one
+    btrack session over every feature.
+
+    Parameters:
+    file_name    : str
+                   features CSV (t, x, y[, z][, label] columns with a header)
+    out          : str
+                   tracks CSV, in btrack's export_CSV format
+    config       : str
+                   btrack configuration file
+    window       : int
+                   frames per tracking window; None for the whole movie
+    overlap      : int
+                   frames shared by consecutive windows
+    volume       : tuple
+                   ((x0, x1), (y0, y1), (z0, z1)) imaging volume. By default
+                   it is the bounding box of the features
+    tiles        : tuple
+                   (nx, ny) grid of spatial tiles; None for the whole field
+    tile_overlap : float
+                   width (pixels) of the strip shared by neighbouring tiles;
+                   should exceed the distance a particle moves in a frame
+    workers      : int
+                   number of processes tracking windows / tiles at once.
+                   Giving it (even 1) tracks the movie as a single region
+                   through _track_regions
+    """
+
+    columns, data = _read_csv_table(file_name)
+    if volume is None:
+        volume = _infer_volume(columns, data)
+
+    if window is None and tiles is None and workers is None:
+        # a single btrack session, with the objects import_CSV would read
+        tracks = _track_window(_track_objects(columns, data,
+                                              np.arange(len(data))),
+                               config, volume)
+        if tracks:
+            btrack.dataio.export_CSV(out, tracks)
+        else:
+            _write_tracks(out, np.zeros((0, len(
+                btrack.constants.DEFAULT_EXPORT_PROPERTIES))))
+        n_tracks = len(tracks)
+    else:
+        if window is not None and not 0 <= overlap < window:
+            raise ValueError('overlap must be smaller than the window')
+        # without windows or tiles, this is a single region: the whole movie
+        regions = _tracking_regions(columns, data, volume, window, overlap,
+                                    tiles, tile_overlap)
+        n_tracks = _track_regions(columns, data, regions, out, config,
+                                  workers or 1)
+
+    PROFILER.count('features', len(data))
+    PROFILER.count('trajectories', n_tracks)
+    PROFILER.count_file('bytes_read', file_name)
+    PROFILER.count_file('bytes_written', out)
+
+
+def _infer_volume(columns, data):
+    """ btrack volume ((x0, x1), (y0, y1), (z0, z1)) bounding the features
+
+    2D data (a single z) gets a z range of 1, as btrack expects.
+    """
+
+    volume = []
+    for axis in ['x', 'y', 'z']:
+        if axis in columns and len(data):
+            values = data[:, columns.index(axis)]
+            low, high = math.floor(values.min()), math.ceil(values.max())
+        else:
+            low, high = 0, 0
+        volume.append((low, max(high, low + 1)))
+
+    return tuple(volume)
+
+
+def _track_objects(columns, data, rows):
+    """ btrack objects of some rows of a features table, as import_CSV """
+
+    objects = []
+    for i, row in enumerate(rows):
+        properties = dict(zip(columns, data[row].tolist()))
+        properties['ID'] = i
+        objects.append(btrack.btypes.PyTrackObject.from_dict(properties))
+
+    return objects
+
+
+def _track_window(objects, config, volume):
+    """ Run btrack (tracking and global optimization) over some objects """
 
     # initialise a tracker session using a context manager
     with btrack.BayesianTracker() as tracker:
 
-      # configure the tracker using a config file
-      tracker.configure_from_file('config_test.json')
+        # configure the tracker using a config file
+        tracker.configure_from_file(config)
+
+        # append the objects to be tracked
+        tracker.append(objects)
+
+        # set the volume (Z axis volume is set very large for 2D data)
+        tracker.volume = volume
+
+        # track them (in interactive mode)
+        tracker.track_interactive(step_size=100)
+
+        # generate hypotheses and run the global optimizer
+        tracker.optimize()
+
+        # get the tracks as a python list
+        return tracker.tracks
+
+
+@functools.lru_cache()
+def _btrack_drops_objects(config):
+    """ Whether btrack leaves appended objects out of its tracks
 
-      # append the objects to be tracked
-      tracker.append(objects)
+    btrack 0.4.0 leaves objects of the last frame out of every track.
+    Two particles are tracked over four frames with config, and any object
+    missing from the tracks means objects are dropped.
+    """
+
+    columns = ['t', 'x', 'y', 'z']
+    data = np.array([[t, x + 2 * t, 50, 0] for t in range(4)
+                     for x in [20, 80]], dtype=np.float64)
+    tracks = _track_window(_track_objects(columns, data,
+                                          np.arange(len(data))),
+                           config, _infer_volume(columns, data))
+    refs = {ref for track in tracks for ref in track.refs}
+
+    return not set(range(len(data))) <= refs
+
+
+def _tracking_regions(columns, data, volume, window=None, overlap=10,
+                      tiles=None, tile_overlap=20):
+    """ Cut the features into overlapping time windows x spatial tiles
+
+    Along each axis (t, x, y), the range is cut into consecutive intervals
+    that are extended to overlap their neighbours. Each feature lies in the
+    core (non-extended part) of exactly one interval: overlaps are split
+    down the middle, so every part of the data comes from the region where
+    it is furthest from the region's edges.
+
+    Outputs:
+    regions      : list of (rows, volume, core) tuples: the rows of the
+                   features in the extended region, the btrack volume of
+                   the region, and its core as ((t0, t1), (x0, x1), (y0, y1))
+                   half-open intervals
+    """
+
+    frames = data[:, columns.index('t')]
+    if window is None or len(data) == 0:
+        t_intervals = [(-np.inf, np.inf, -np.inf, np.inf)]
+    else:
+        first, last = int(frames.min()), int(frames.max())
+        t_intervals = []
+        for start in range(first, max(last - overlap, first) + 1,
+                           window - overlap):
+            stop = start + window
+            t_intervals.append((
+                start, stop,
+                start + overlap // 2 if start > first else -np.inf,
+                stop - overlap + overlap // 2 if stop <= last else np.inf))
+
+    nx, ny = tiles if tiles is not None else (1, 1)
+    space_intervals = []
+    for n, (low, high) in zip([nx, ny], volume[:2]):
+        edges = np.linspace(low, high, int(n) + 1)
+        half = tile_overlap / 2 if n > 1 else 0
+        # the outer edges are open, as the features may touch the volume
+        space_intervals.append([
+            (edges[i] - half if i > 0 else -np.inf,
+             edges[i + 1] + half if i < n - 1 else np.inf,
+             edges[i] if i > 0 else -np.inf,
+             edges[i + 1] if i < n - 1 else np.inf) for i in range(int(n))])
+
+    x = data[:, columns.index('x')]
+    y = data[:, columns.index('y')]
+    regions = []
+    for t0, t1, t_core0, t_core1 in t_intervals:
+        in_window = (frames >= t0) & (frames < t1)
+        for x0, x1, x_core0, x_core1 in space_intervals[0]:
+            for y0, y1, y_core0, y_core1 in space_intervals[1]:
+                rows = np.flatnonzero(in_window & (x >= x0) & (x < x1) &
+                                      (y >= y0) & (y < y1))
+                if len(rows) == 0:
+                    continue
+                region_volume = (
+                    (math.floor(max(volume[0][0], x0)),
+                     math.ceil(min(volume[0][1], x1))),
+                    (math.floor(max(volume[1][0], y0)),
+                     math.ceil(min(volume[1][1], y1))),
+                    volume[2])
+                regions.append((rows, region_volume,
+                                ((t_core0, t_core1), (x_core0, x_core1),
+                                 (y_core0, y_core1))))
+
+    return regions
+
+
+def _track_region(region, columns, config, drops_objects=False):
+    """ Track one region, given as (rows, features of these rows, volume)
+
+    With drops_objects (see _btrack_drops_objects), a copy of an object of
+    the last frame is appended one frame later. It is then the only object
+    of the last frame, and is the one btrack leaves out, so no feature of
+    the region is lost.
 
-      # set the volume (Z axis volume is set very large for 2D data)
-      tracker.volume=((0,400),(0,400),(0,1))
+    Outputs:
+    tracks       : list of (track ID, rows of its objects, export_CSV array)
+                   tuples; dummy objects have negative rows
+    """
+
+    rows, data, volume = region
+    objects = _track_objects(columns, data, np.arange(len(rows)))
+    if drops_objects:
+        last = int(np.argmax(data[:, columns.index('t')]))
+        objects.append(_track_objects(columns, data, [last])[0])
+        objects[-1].t = objects[-1].t + 1
+    properties = btrack.constants.DEFAULT_EXPORT_PROPERTIES
+
+    tracks = []
+    for track in _track_window(objects, config, volume):
+        # btrack numbers the objects in the order they were appended;
+        # dummy objects (inserted for missed detections) are negative and
+        # the appended copy, if btrack kept it, is len(rows)
+        refs = np.array(track.refs, dtype=np.int64)
+        keep = refs != len(rows)
+        if not keep.any():
+            continue
+        refs = refs[keep]
+        refs[refs >= 0] = rows[refs[refs >= 0]]
+        tracks.append((track.ID, refs, track.to_array(properties)[keep]))
 
-      # track them (in interactive mode)
-      tracker.track_interactive(step_size=100)
+    return tracks
 
-      # generate hypotheses and run the global optimizer
-      tracker.optimize()
 
-      # get the tracks as a python list
-      tracks = tracker.tracks
-        
-      # export tracks in CSV format
-      btrack.dataio.export_CSV(out, tracks)
+def _track_regions(columns, data, regions, out, config, workers=1):
+    """ Track regions independently and join their tracks into one CSV
 
+    Two regions that overlap see the same objects (features) there. For
+    every pair of overlapping regions, their tracks are matched one to one,
+    the pairs sharing the most objects first; matched tracks are then
+    joined, across any number of regions, into global track IDs. Each row
+    of the output is taken from the region whose core contains it. Tracks
+    are numbered by their first (t, x, y), so the IDs do not depend on how
+    the movie was cut into regions.
+
+    The tracks of every region are collected before they are joined, so
+    this holds about one export_CSV row per object of the movie (plus the
+    overlaps) at once, as well as the features table itself.
+
+    Outputs:
+    n_tracks     : number of tracks written
+    """
 
-def read_tif(path):
+    properties = btrack.constants.DEFAULT_EXPORT_PROPERTIES
+    id_columns = [properties.index(name) for name in ['ID', 'parent', 'root']]
+    core_columns = [properties.index(name) for name in ['t', 'x', 'y']]
+
+    # each worker only receives the features of its region
+    drops_objects = len(regions) > 0 and _btrack_drops_objects(config)
+    results = list(_threaded_map(_track_region,
+                                 ((rows, data[rows], volume)
+                                  for rows, volume, _ in regions),
+                                 workers, columns, config, drops_objects,
+                                 executor_class=ProcessPoolExecutor))
+
+    # objects seen by more than one region: count the objects each pair of
+    # tracks (region, track ID) shares
+    nodes = [(k, track_ID) for k, tracks in enumerate(results)
+             for track_ID, _, _ in tracks]
+    refs = [refs for tracks in results for _, refs, _ in tracks]
+    owner = np.repeat(np.arange(len(nodes)), [len(r) for r in refs])
+    refs = np.concatenate(refs) if refs else np.zeros(0, dtype=np.int64)
+    real = refs >= 0  # btrack's dummy objects have negative IDs
+    order = np.argsort(refs[real], kind='stable')
+    refs, owner = refs[real][order], owner[real][order]
+    shared = {}
+    for group in np.split(owner, np.flatnonzero(np.diff(refs)) + 1):
+        for i in range(len(group)):
+            for j in range(i + 1, len(group)):
+                pair = (group[i], group[j])
+                shared[pair] = shared.get(pair, 0) + 1
+
+    # one to one matching within each pair of regions, most shared first;
+    # matched tracks are merged with a union-find
+    parent = list(range(len(nodes)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    used = set()
+    for (i, j), n in sorted(shared.items(), key=lambda item: -item[1]):
+        key_i = (nodes[i], nodes[j][0])
+        key_j = (nodes[j], nodes[i][0])
+        if key_i in used or key_j in used:
+            continue
+        used.update([key_i, key_j])
+        parent[find(j)] = find(i)
+
+    global_IDs = {}
+    track_IDs = {}
+    for i, node in enumerate(nodes):
+        root = find(i)
+        if root not in global_IDs:
+            global_IDs[root] = len(global_IDs) + 1
+        track_IDs[node] = global_IDs[root]
+
+    # keep the rows in the core of each region, with global IDs
+    kept = []
+    for k, (tracks, (_, _, core)) in enumerate(zip(results, regions)):
+        for _, _, array in tracks:
+            keep = np.ones(len(array), dtype=bool)
+            for column, (low, high) in zip(core_columns, core):
+                keep &= (array[:, column] >= low) & (array[:, column] < high)
+            array = array[keep]
+            for column in id_columns:
+                array[:, column] = [track_IDs.get((k, int(ID)), 0)
+                                    for ID in array[:, column]]
+            kept.append(array)
+
+    tracks = np.concatenate(kept) if kept else \
+        np.zeros((0, len(properties)), dtype=np.float32)
+    tracks = tracks[np.lexsort((tracks[:, core_columns[0]], tracks[:, 0]))]
+
+    # renumber the tracks in the order they start
+    IDs, first = np.unique(tracks[:, 0], return_index=True)
+    starts = tracks[first][:, core_columns]
+    new_IDs = np.zeros(len(IDs), dtype=tracks.dtype)
+    new_IDs[np.lexsort(starts.T[::-1])] = np.arange(1, len(IDs) + 1)
+    for column in id_columns:
+        index = np.minimum(np.searchsorted(IDs, tracks[:, column]),
+                           max(len(IDs) - 1, 0))
+        tracks[:, column] = np.where(IDs[index] == tracks[:, column],
+                                     new_IDs[index], 0)
+    tracks = tracks[np.lexsort((tracks[:, core_columns[0]], tracks[:, 0]))]
+    _write_tracks(out, tracks)
+
+    return len(np.unique(tracks[:, 0]))
+
+
+def _write_tracks(out, tracks):
+    """ Write an array of tracks in btrack's export_CSV format """
+
+    with open(out, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file, delimiter=' ')
+        writer.writerow(btrack.constants.DEFAULT_EXPORT_PROPERTIES)
+        writer.writerows(tracks.tolist())
+
+
+@profiled('read_tif')
+def read_tif(path, mmap=False):
     """
     Read a tif stack and return numpy arrays
     
     Inputs:
     path - :string: Path to the tif stack 
-    
+    mmap - :boolean: Open the stack lazily instead of decoding every frame
+           (see memmap_tif)
+
     Returns:
     a numpy array of numpy arrays (tif stack frames)
     
     """
+    if mmap:
+        return memmap_tif(path)
+
     img = Image.open(path)
-    images = []
+    images = None
     for i in range(img.n_frames):
         img.seek(i)
-        images.append(np.array(img))
+        frame = np.asarray(img)
+        if images is None:
+            # fill a single preallocated stack instead of copying a list
+            images = np.empty((img.n_frames,) + frame.shape, frame.dtype)
+        images[i] = frame
+    PROFILER.count('frames', img.n_frames)
+    PROFILER.count_file('bytes_read', path)
+
+    return images
+
+
+def iter_tif(path):
+    """
+    Read a tif stack one frame at a time
 
-    return np.array(images)
+    Inputs:
+    path - :string: Path to the tif stack
+
+    Returns:
+    an iterator of numpy arrays (tif stack frames), one at a time, so only
+    the current frame is held in memory. The file is opened right away, so
+    a missing file raises FileNotFoundError here rather than on first use
+    """
+    img = Image.open(path)
+
+    def frames():
+        for i in range(img.n_frames):
+            img.seek(i)
+            yield np.array(img)
+
+    return frames()
+
+
+def memmap_tif(path):
+    """
+    Open a tif stack without reading its frames into memory
+
+    Contiguous, uncompressed stacks (such as the ones written by
+    process_image and extract_features) are memory-mapped, so the result is
+    a read-only (frames, y, x) array and every frame is a zero-copy view of
+    the file. Other stacks fall back to a TifFrames reader that decodes a
+    frame only when it is indexed. Either way, opening a multi-GB stack is
+    near-instant and random access by frame index is O(1).
+
+    Inputs:
+    path - :string: Path to the tif stack
+
+    Returns:
+    a numpy memmap, or a TifFrames reader
+    """
+    try:
+        return tifffile.memmap(path, mode='r')
+    except FileNotFoundError:
+        print("Could not find file " + path)
+        sys.exit(1)
+    except ValueError:
+        # compressed or non-contiguous image data can't be mapped
+        return TifFrames(path)
+
+
+class TifFrames:
+    """
+    Lazily indexed frames of a tif stack
+
+    The page index of the file is read once when it is opened; after that
+    indexing a frame seeks straight to it and decodes only that frame.
+    Supports len(), integer indexing (including negative indices) and
+    iteration, like the array returned by read_tif.
+    """
 
+    def __init__(self, path):
+        self._tif = tifffile.TiffFile(path)
+        self._pages = self._tif.pages
+        self._n_frames = len(self._pages)  # walks the page index once
 
+    def __len__(self):
+        return self._n_frames
+
+    def __getitem__(self, index):
+        if index < 0:
+            index = index + self._n_frames
+        if not 0 <= index < self._n_frames:
+            raise IndexError('frame index out of range')
+        return self._pages[index].asarray()
+
+    def __iter__(self):
+        for index in range(self._n_frames):
+            yield self[index]
+
+    def close(self):
+        self._tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@profiled('write_csv')
 def write_csv(data, file_name='results.csv'):
     '''
     Write a simple CSV file with given data and name
@@ -491,9 +3141,288 @@ def write_csv(data, file_name='results.csv'):
     '''
     with open(file_name, mode='w') as csv_file:
         try:
-            for row in data:
-                wr = csv.writer(csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                wr.writerow(row)
+            wr = csv.writer(csv_file, delimiter=',', quotechar='"',
+                            quoting=csv.QUOTE_MINIMAL)
+            wr.writerows(data)
         except FileNotFoundError:
             print('Could not open subdirectory \'out\'')
             sys.exit(1)
+
+
+def write_table(file_name, columns, data):
+    """ Write a numeric table (features, tracks, results) as binary .npy
+
+    The rows are stored as a numpy structured array with one float64 field
+    per column, so the file is typed, self-describing and can be memory
+    mapped. Unnamed columns (e.g. the index column of btrack's CSVs) get
+    numpy's default field name, f<column index>.
+
+    Parameters:
+    file_name   : str
+                  output .npy file
+    columns     : list of column names
+    data        : (N, len(columns)) array or list of rows
+    """
+
+    data = np.ascontiguousarray(data, dtype=np.float64)
+    data = data.reshape(-1, len(columns))
+    dtype = np.dtype([(name, np.float64) for name in columns])
+    np.save(file_name, data.view(dtype).reshape(-1))
+
+
+def read_table(file_name, mmap=True):
+    """ Read a table written by write_table
+
+    Parameters:
+    file_name   : str
+                  .npy file to read
+    mmap        : bool
+                  memory-map the file instead of reading it into memory
+
+    Outputs:
+    columns     : list of column names
+    data        : (N, len(columns)) float64 array; a view of the memory
+                  map when mmap is True
+    """
+
+    try:
+        table = np.load(file_name, mmap_mode='r' if mmap else None)
+    except FileNotFoundError:
+        print("Could not find file " + file_name)
+        sys.exit(1)
+
+    columns = ['' if name == 'f' + str(i) else name
+               for i, name in enumerate(table.dtype.names)]
+    data = table.view(np.float64).reshape(len(table), len(columns))
+
+    return columns, data
+
+
+def csv_to_npy(file_in, file_out=None, delimiter=','):
+    """ Convert a features, tracks or results CSV to the binary format
+
+    Outputs:
+    file_out    : str
+                  the written .npy file (file_in with .npy by default)
+    """
+
+    if file_out is None:
+        file_out = os.path.splitext(file_in)[0] + '.npy'
+
+    try:
+        with open(file_in, 'r') as table_file:
+            is_results = table_file.readline().startswith('Trajectory_ID')
+    except FileNotFoundError:
+        print("Could not find file " + file_in)
+        sys.exit(1)
+
+    if is_results:
+        # results may hold empty cells and lists of dwell times
+        header, rows = read_traj_results(file_in)
+        write_results(rows, file_out, header)
+    else:
+        # rows are kept in file order
+        write_table(file_out, *_read_csv_table(file_in, delimiter))
+
+    return file_out
+
+
+def npy_to_csv(file_in, file_out=None, delimiter=','):
+    """ Convert a binary table back to the CSV layout it came from
+
+    Outputs:
+    file_out    : str
+                  the written CSV file (file_in with .csv by default)
+    """
+
+    if file_out is None:
+        file_out = os.path.splitext(file_in)[0] + '.csv'
+
+    columns, data = read_table(file_in)
+    if columns[0] == 'Trajectory_ID':
+        write_csv([columns] + _results_from_array(data), file_out)
+        return file_out
+
+    # whole numbers (IDs, frames, pixel positions) are written as ints
+    rows = [[int(v) if v.is_integer() else v for v in row]
+            for row in data.tolist()]
+    with open(file_out, mode='w') as csv_file:
+        wr = csv.writer(csv_file, delimiter=delimiter)
+        wr.writerow(columns)
+        wr.writerows(rows)
+
+    return file_out
+
+
+class ArtifactCache:
+    """ Content-hash cache of intermediate pipeline artifacts
+
+    Each pipeline stage is keyed on the content hash of its input files plus
+    the parameters it was run with. When a stage is re-run with the same
+    inputs and parameters, its output files are restored from the cache
+    instead of being recomputed. Downstream stages key on the content of
+    those outputs, so a change anywhere only re-runs the stages after it.
+
+    Entries are whole directories under cache_dir, written atomically. The
+    least recently used entries are evicted once the cache grows past
+    max_bytes.
+
+    Parameters:
+    cache_dir   : str
+                  directory holding the cache
+    max_bytes   : int
+                  size limit of the cache, in bytes
+    """
+
+    def __init__(self, cache_dir='.spt_cache', max_bytes=10 * 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, 'hashes'), exist_ok=True)
+
+    def file_hash(self, file_name):
+        """ SHA-256 of a file's content
+
+        The digest is remembered on disk next to the file's size and
+        modification time, so unchanged (large) inputs are only read once.
+        """
+
+        stat = os.stat(file_name)
+        memo_name = self._memo_name(file_name)
+        try:
+            with open(memo_name, 'r') as memo_file:
+                memo = json.load(memo_file)
+            if memo['size'] == stat.st_size and \
+                    memo['mtime_ns'] == stat.st_mtime_ns:
+                return memo['digest']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        digest = hashlib.sha256()
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+
+        self._remember_hash(file_name, digest, stat)
+        return digest
+
+    def _memo_name(self, file_name):
+        return os.path.join(self.cache_dir, 'hashes', hashlib.sha256(
+            os.path.abspath(file_name).encode()).hexdigest() + '.json')
+
+    def _remember_hash(self, file_name, digest, stat=None):
+        """ Record the digest of a file as of its current size and mtime """
+        if stat is None:
+            stat = os.stat(file_name)
+        _atomic_write_json(self._memo_name(file_name),
+                           {'size': stat.st_size,
+                            'mtime_ns': stat.st_mtime_ns,
+                            'digest': digest})
+
+    def key(self, stage, inputs, params):
+        """ Cache key of a stage run on the given input files and params """
+
+        key = hashlib.sha256(stage.encode())
+        for file_name in inputs:
+            key.update(self.file_hash(file_name).encode())
+        key.update(json.dumps(params, sort_keys=True).encode())
+        return stage + '-' + key.hexdigest()
+
+    def fetch(self, key, outputs):
+        """ Restore the output files of a cached stage
+
+        Returns True on a cache hit, False otherwise. The digests of the
+        restored files are recorded, so stages keyed on them do not read
+        them again.
+        """
+
+        entry = os.path.join(self.cache_dir, key)
+        cached = [os.path.join(entry, str(i)) for i in range(len(outputs))]
+        if not all(os.path.exists(name) for name in cached):
+            return False
+        try:
+            with open(os.path.join(entry, 'digests.json'), 'r') as f:
+                digests = json.load(f)
+        except (FileNotFoundError, ValueError):
+            digests = []  # hashed again when needed
+        try:
+            for cached_name, file_name in zip(cached, outputs):
+                shutil.copy2(cached_name, file_name)
+            os.utime(entry)  # mark as recently used
+        except FileNotFoundError:
+            return False  # evicted by another process meanwhile
+        for file_name, digest in zip(outputs, digests):
+            self._remember_hash(file_name, digest)
+        return True
+
+    def store(self, key, outputs):
+        """ Add the output files of a stage to the cache
+
+        A stage that did not write all of its outputs (e.g. btrack found
+        no tracks) is not cached. Returns True if the entry was stored.
+        """
+
+        missing = [name for name in outputs if not os.path.exists(name)]
+        if missing:
+            print('Not caching ' + key + ': missing ' + ', '.join(missing))
+            return False
+
+        entry = os.path.join(self.cache_dir, key)
+        tmp_entry = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        for i, file_name in enumerate(outputs):
+            shutil.copy2(file_name, os.path.join(tmp_entry, str(i)))
+        # downstream stages hash these outputs anyway
+        _atomic_write_json(os.path.join(tmp_entry, 'digests.json'),
+                           [self.file_hash(name) for name in outputs])
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+        return True
+
+    def run(self, stage, inputs, params, outputs, func, *args):
+        """ Run func(*args) unless the stage's outputs are cached
+
+        Returns True if the stage was skipped (cache hit).
+        """
+
+        key = self.key(stage, inputs, params)
+        if self.fetch(key, outputs):
+            return True
+        func(*args)
+        self.store(key, outputs)
+        return False
+
+    def evict(self):
+        """ Drop least recently used entries until under max_bytes """
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name == 'hashes' or name.startswith('.tmp-'):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f))
+                           for f in os.listdir(entry)
+                           if f != 'digests.json')
+                entries.append((os.path.getmtime(entry), size, entry))
+            except FileNotFoundError:
+                continue
+            total = total + size
+
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total = total - size
+
+
+def _atomic_write_json(file_name, data):
+    """ Write a small JSON file so readers never see a partial file """
+    tmp_name = file_name + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_name, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_name, file_name)
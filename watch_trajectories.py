@@ -0,0 +1,177 @@
+""" Watch Trajectories
+
+Live analysis during an acquisition: follow a trajectory CSV while it is
+being written (e.g. by write_csv or btrack's export_CSV) and keep the
+diffusion coefficients and dwell times of every trajectory up to date. Only
+the bytes appended since the last poll are parsed; the file is never
+re-scanned.
+
+Every --interval seconds (when new rows arrived), the following are
+rewritten:
+<name>_live_diffusion_coeffs.csv  : diffusion coefficients so far
+<name>_live_dwell_times.csv       : dwell times so far
+<name>_live_summary.json          : summary statistics and histograms
+<name>_live_hist.png              : histograms of D and the dwell times
+
+Usage:
+python watch_trajectories.py --file sample_traj.csv --delta_T 0.1 \
+    --bound_frames 10 --max_disp 200 --idle_timeout 60
+
+"""
+
+import utils
+import argparse
+import asyncio
+import json
+import os
+import matplotlib.pyplot as plt
+
+
+def main():
+
+    """ Main function for watching a trajectory file
+
+    Arguements are defined at the command line via argparse
+
+    utils.watch_trajectories  : follows the file and publishes results
+    utils.LiveTrajectoryStats : per-trajectory accumulators
+
+    """
+    parser = argparse.ArgumentParser(description='Analyze a trajectory file '
+                                                 'while it is being written')
+
+    parser.add_argument('--file',
+                        dest='file_in',
+                        type=str,
+                        required=True,
+                        help="Trajectory file to follow")
+    parser.add_argument('--delta_T',
+                        dest='deltaT',
+                        type=float,
+                        default=0.1,
+                        help="Time between frames, in seconds")
+    parser.add_argument('--bound_frames',
+                        dest='min_bound_frames',
+                        type=int,
+                        required=True,
+                        help="How many frames to consider a particle bound")
+    parser.add_argument('--max_disp',
+                        dest='max_disp',
+                        type=int,
+                        required=True,
+                        help="Max distance a particle can travel while bound")
+    parser.add_argument('--interval',
+                        dest='interval',
+                        type=float,
+                        default=5,
+                        help="Seconds between updates of the results")
+    parser.add_argument('--poll',
+                        dest='poll_interval',
+                        type=float,
+                        default=0.5,
+                        help="Seconds between checks for new rows")
+    parser.add_argument('--idle_timeout',
+                        dest='idle_timeout',
+                        type=float,
+                        default=None,
+                        help="Stop after this many seconds without new "
+                             "rows (default: follow until interrupted)")
+    parser.add_argument('--delimiter',
+                        dest='delimiter',
+                        type=str,
+                        default=',',
+                        help="CSV column separator (btrack's tracks use ' ')")
+    parser.add_argument('--id_column',
+                        dest='query_column',
+                        type=int,
+                        default=1,
+                        help="Column of the trajectory IDs (0 for btrack)")
+    parser.add_argument('--xy_columns',
+                        dest='result_columns',
+                        type=int,
+                        nargs=2,
+                        default=[3, 4],
+                        help="Columns of the X and Y coordinates (2 3 for "
+                             "btrack)")
+    parser.add_argument('--bins',
+                        dest='bins',
+                        type=int,
+                        default=20,
+                        help="Number of histogram bins")
+    utils.add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.profile:
+        utils.PROFILER.enable(args.cprofile)
+
+    stats = utils.LiveTrajectoryStats(args.deltaT,
+                                      args.max_disp,
+                                      args.min_bound_frames,
+                                      args.query_column,
+                                      args.result_columns)
+
+    def publish(stats):
+        write_live_results(stats, args.file_in[:-4] + '_live', args.bins)
+
+    try:
+        asyncio.run(utils.watch_trajectories(args.file_in,
+                                             stats,
+                                             publish,
+                                             args.interval,
+                                             args.poll_interval,
+                                             args.idle_timeout,
+                                             delimiter=args.delimiter))
+    except KeyboardInterrupt:
+        # keep what was read so far
+        publish(stats)
+
+    if args.profile:
+        utils.PROFILER.write_report(args.file_in[:-4] + '_profile.json')
+
+
+def write_live_results(stats, prefix, bins=20):
+    """ Write the current results; each file is replaced in one step, so
+    readers never see a partly written file """
+
+    diffusion_out = prefix + '_diffusion_coeffs.csv'
+    utils.write_csv([['Trajectory_ID', 'Diffusion_Coeff (um^2/s)']] +
+                    stats.diffusion(), diffusion_out + '.tmp')
+    os.replace(diffusion_out + '.tmp', diffusion_out)
+
+    dwell_out = prefix + '_dwell_times.csv'
+    utils.write_csv([['Trajectory_ID', 'Dwell_Times (s)']] +
+                    stats.dwelltimes(), dwell_out + '.tmp')
+    os.replace(dwell_out + '.tmp', dwell_out)
+
+    summary = stats.summary(bins)
+    with open(prefix + '_summary.json.tmp', 'w') as f:
+        json.dump(summary, f, indent=1)
+    os.replace(prefix + '_summary.json.tmp', prefix + '_summary.json')
+
+    print('{rows} rows, {trajectories} trajectories, {binding_events} '
+          'binding events'.format(**summary) +
+          ''.join('; median {} {:.4g}'.format(name, summary[name]['median'])
+                  for name in ['diffusion_coeff', 'dwell_time']
+                  if summary[name]['median'] is not None))
+
+    # histograms of D and the dwell times
+    width = 6
+    height = 3
+    fig = plt.figure(figsize=(width, height), dpi=150)
+    for i, (name, label) in enumerate([('diffusion_coeff',
+                                        'Diffusion Coeff (um^2/s)'),
+                                       ('dwell_time', 'Dwell Time (s)')]):
+        ax = fig.add_subplot(1, 2, i + 1)
+        edges = summary[name]['edges']
+        ax.hist(edges[:-1], edges, weights=summary[name]['counts'],
+                color='grey')
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.set_xlabel(label)
+    plt.savefig(prefix + '_hist.png.tmp', bbox_inches='tight', format='png')
+    plt.close(fig)
+    os.replace(prefix + '_hist.png.tmp', prefix + '_hist.png')
+
+
+if __name__ == '__main__':
+
+    main()